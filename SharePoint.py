@@ -1,11 +1,14 @@
 import msal
 import requests
 from pathlib import Path
+from urllib.parse import quote
 import json
 from functools import cache
 import pprint as pp
 import ipdb
 
+from resilience import resilient_session
+
 class SharePointAccessClass:
     # 初期化
     def __init__(self, client_id, client_secret, tenant_id):
@@ -18,6 +21,8 @@ class SharePointAccessClass:
         self.authority = f"https://login.microsoftonline.com/{tenant_id}" 
         self.scope = ["https://graph.microsoft.com/.default"]
         self.access_token: None | str = None
+        # Graph API の呼び出しで共有するセッション (429 / 503 は Retry-After に従って再試行する)
+        self.session = resilient_session("graph")
         self.get_access_token()
 
 
@@ -47,20 +52,34 @@ class SharePointAccessClass:
         Get data from Graph API using the endpoint
         """
         if self.access_token is not None:
-            graph_data = requests.get(
+            graph_data = self.session.get(
                 endpoint,
                 headers={'Authorization': 'Bearer ' + self.access_token})
             return graph_data
         else:
             raise Exception("No access token available")
         
-        # Graph APIを使用してデータを送信する汎用PUTメソッド
+        # Graph APIを使用してデータを取得する汎用GETメソッド (キャッシュなし)
+    def graph_api_get_uncached(self, endpoint: str) -> requests.models.Response:
+        """
+        Get data from Graph API without caching the response (file contents, paged listings)
+        """
+        if self.access_token is not None:
+            graph_data = self.session.get(
+                endpoint,
+                headers={'Authorization': 'Bearer ' + self.access_token},
+                timeout=120)
+            return graph_data
+        else:
+            raise Exception("No access token available")
+
+    # Graph APIを使用してデータを送信する汎用PUTメソッド
     def graph_api_put(self, endpoint: str, data) -> requests.models.Response | None:
         """
         Post data to Graph API using the endpoint
         """
         if self.access_token is not None:
-            graph_data = requests.put(
+            graph_data = self.session.put(
                 url=endpoint,
                 headers={'Authorization': 'Bearer ' + self.access_token},
                 data=data)
@@ -75,7 +94,7 @@ class SharePointAccessClass:
         Delete data from Graph API using the endpoint
         """
         if self.access_token is not None:
-            graph_data = requests.delete(
+            graph_data = self.session.delete(
                 endpoint,
                 headers={'Authorization': 'Bearer ' + self.access_token})
             return graph_data
@@ -88,7 +107,7 @@ class SharePointAccessClass:
         Post data to Graph API using the endpoint
         """
         if self.access_token is not None:
-            graph_data = requests.post(
+            graph_data = self.session.post(
                 url=endpoint,
                 headers={'Authorization': 'Bearer ' + self.access_token},
                 json=data)  # Use json parameter instead of data for POST requests
@@ -97,6 +116,21 @@ class SharePointAccessClass:
             raise Exception("No access token available")
         
 
+    # Graph APIを使用してデータを更新する汎用PATCHメソッド
+    def graph_api_patch(self, endpoint: str, data) -> requests.models.Response | None:
+        """
+        Patch data to Graph API using the endpoint
+        """
+        if self.access_token is not None:
+            graph_data = self.session.patch(
+                url=endpoint,
+                headers={'Authorization': 'Bearer ' + self.access_token},
+                json=data)
+            return graph_data
+        else:
+            raise Exception("No access token available")
+
+
     # サイト一覧を取得する
     def get_sites(self):
         """
@@ -405,3 +439,69 @@ class SharePointAccessClass:
             return graph_data
         else:
             return "Folder not found"
+
+
+    # 指定フォルダ以下のファイルを再帰的に列挙する
+    def list_files_recursive(self, site_id, folder_id='root'):
+        """
+        List all files under the folder (including subfolders) of the site's default drive.
+        Yields driveItem dictionaries of files. Paging (@odata.nextLink) is followed.
+        """
+        pending = [folder_id]
+        while pending:
+            current_folder_id = pending.pop()
+            endpoint = f'https://graph.microsoft.com/v1.0/sites/{site_id}/drive/items/{current_folder_id}/children'
+            while endpoint:
+                response = self.graph_api_get_uncached(endpoint)
+                response.raise_for_status()
+                data = response.json()
+                for item in data.get("value", []):
+                    if "folder" in item:
+                        pending.append(item["id"])
+                    elif "file" in item:
+                        yield item
+                endpoint = data.get("@odata.nextLink")
+
+    # ファイルの内容をダウンロードする (キャッシュなし)
+    def download_item_content(self, site_id, item_id) -> bytes:
+        """
+        Download the content of a file using the site_id and the item_id
+        """
+        response = self.graph_api_get_uncached(
+            f'https://graph.microsoft.com/v1.0/sites/{site_id}/drive/items/{item_id}/content')
+        response.raise_for_status()
+        return response.content
+
+    # ファイルの情報 (driveItem) を ID またはドライブのルートからの相対パスで取得する
+    def get_drive_item(self, site_id, item_id=None, path=None):
+        """
+        Get a driveItem using the item_id or the path relative to the drive root (e.g. "Folder/Sub/file.pdf").
+        Returns None if the item is not found.
+        """
+        if item_id:
+            endpoint = f'https://graph.microsoft.com/v1.0/sites/{site_id}/drive/items/{item_id}'
+        else:
+            endpoint = f'https://graph.microsoft.com/v1.0/sites/{site_id}/drive/root:/{quote(path.strip("/"))}'
+        response = self.graph_api_get_uncached(endpoint)
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.json()
+
+    # ドライブの変更 (delta) を取得する
+    def get_drive_changes(self, site_id, delta_link=None):
+        """
+        Get changed driveItems since the delta_link. Returns (items, new_delta_link).
+        Without a delta_link, only the current delta_link is returned (token=latest) and no items.
+        """
+        endpoint = delta_link or f'https://graph.microsoft.com/v1.0/sites/{site_id}/drive/root/delta?token=latest'
+        items = []
+        while True:
+            response = self.graph_api_get_uncached(endpoint)
+            response.raise_for_status()
+            data = response.json()
+            items.extend(data.get("value", []))
+            if "@odata.nextLink" in data:
+                endpoint = data["@odata.nextLink"]
+            else:
+                return items, data.get("@odata.deltaLink")
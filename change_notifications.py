@@ -0,0 +1,242 @@
+import os
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+
+from SharePoint import SharePointAccessClass
+from indexing_service import ProjectIndexingService, get_project_index_name
+from push_pipeline import PushIndexingPipeline
+from search_profiles import IndexStorageProfile
+from utils import get_project_by_name, get_site_info_by_url, patch_project_fields
+
+# 環境変数等の取得
+# Graph からの通知を受け取る URL (例: https://{関数アプリ}.azurewebsites.net/notifications/sharepoint). 未設定の場合はサブスクリプションを作成しない
+notification_url = os.getenv("GRAPH_NOTIFICATION_URL")
+# 通知が自分のサブスクリプションからのものか確認するための値
+notification_client_state = os.getenv("GRAPH_CLIENT_STATE", "")
+# 最初の通知からこの秒数の間に届いた通知を 1 回の再インデックスにまとめる
+debounce_seconds = float(os.getenv("CHANGE_DEBOUNCE_SECONDS", "60"))
+# 変更の反映方法 ("indexer": インデクサーを実行, "push": インデックスに登録済みの変更されたファイルのみ push 型パイプラインで登録し、
+# 新しいファイルはインデクサーに任せる). どちらの場合も削除されたファイルのチャンクは直接削除する
+change_reindex_mode = os.getenv("CHANGE_REINDEX_MODE", "indexer")
+
+# driveItem のサブスクリプションの有効期限の上限は 42300 分 (約 29 日)
+SUBSCRIPTION_LIFETIME = timedelta(minutes=42000)
+# 有効期限までの残りがこれを下回ったら更新する
+SUBSCRIPTION_RENEW_BEFORE = timedelta(days=3)
+GRAPH_SUBSCRIPTIONS_URL = "https://graph.microsoft.com/v1.0/subscriptions"
+
+
+def parse_graph_datetime(value: str) -> datetime:
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def format_graph_datetime(value: datetime) -> str:
+    return value.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.0000000Z")
+
+
+class ChangeNotificationProcessor:
+    """
+    SharePoint (ドライブ) の変更通知を受け取り、プロジェクトごとにまとめて再インデックスする.
+    通知には変更されたファイルが含まれないため、まとめた後に delta クエリで変更分のみを取得する.
+    サブスクリプションと delta リンクはプロジェクトのレコード (change_tracking) に保存する.
+    """
+    def __init__(self, sharepoint: SharePointAccessClass, container, search_indexing: ProjectIndexingService):
+        self.sharepoint = sharepoint
+        self.container = container
+        self.search_indexing = search_indexing
+        self.debounce_seconds = debounce_seconds
+        self._tasks: dict[str, asyncio.Task] = {}
+        # 処理待ちの間、または処理中に追加の通知を受け取ったプロジェクト
+        self._dirty: set[str] = set()
+        self.stats: dict[str, dict] = {}
+
+    def _get_site_id(self, project: dict) -> str | None:
+        site = get_site_info_by_url(self.sharepoint.get_sites(), project["spo_url"])
+        return site["id"] if site else None
+
+    # --- サブスクリプション ---
+
+    async def ensure_subscription(self, project: dict) -> dict:
+        """
+        プロジェクトのドライブのサブスクリプションを作成または更新し、更新後のレコードを返す.
+        """
+        if not notification_url:
+            return project
+        tracking = project.setdefault("change_tracking", {})
+        expiration = format_graph_datetime(datetime.now(timezone.utc) + SUBSCRIPTION_LIFETIME)
+
+        if tracking.get("subscription_id"):
+            expires_at = parse_graph_datetime(tracking["expiration"])
+            if expires_at - datetime.now(timezone.utc) > SUBSCRIPTION_RENEW_BEFORE:
+                return project
+            response = await asyncio.to_thread(
+                self.sharepoint.graph_api_patch,
+                f"{GRAPH_SUBSCRIPTIONS_URL}/{tracking['subscription_id']}",
+                {"expirationDateTime": expiration},
+            )
+            if response.status_code == 200:
+                tracking["expiration"] = response.json()["expirationDateTime"]
+                patch_project_fields(self.container, project, "change_tracking")
+                logging.info(f"プロジェクト '{project['project_name']}' のサブスクリプションを更新しました")
+                return project
+            # 期限切れなどで更新できない場合は作り直す
+            logging.warning(f"サブスクリプションを更新できませんでした ({response.status_code}): {response.text}")
+
+        site_id = await asyncio.to_thread(self._get_site_id, project)
+        if site_id is None:
+            logging.error(f"サイト '{project['spo_url']}' が見つかりませんでした")
+            return project
+        # 現時点以降の変更のみを取得するよう、delta リンクを先に取得しておく
+        if not tracking.get("delta_link"):
+            _, tracking["delta_link"] = await asyncio.to_thread(self.sharepoint.get_drive_changes, site_id)
+        response = await asyncio.to_thread(self.sharepoint.graph_api_post, GRAPH_SUBSCRIPTIONS_URL, {
+            "changeType": "updated",
+            "notificationUrl": notification_url,
+            "resource": f"/sites/{site_id}/drive/root",
+            "expirationDateTime": expiration,
+            "clientState": notification_client_state,
+        })
+        if response.status_code != 201:
+            logging.error(f"サブスクリプションの作成に失敗しました ({response.status_code}): {response.text}")
+            return project
+        subscription = response.json()
+        tracking.update({
+            "subscription_id": subscription["id"],
+            "expiration": subscription["expirationDateTime"],
+            "site_id": site_id,
+        })
+        patch_project_fields(self.container, project, "change_tracking")
+        logging.info(f"プロジェクト '{project['project_name']}' のサブスクリプションを作成しました: {subscription['id']}")
+        return project
+
+    async def renew_subscriptions(self):
+        """
+        全プロジェクトのサブスクリプションを確認し、期限が近いものを更新する (タイマーから定期的に呼び出す).
+        """
+        if not notification_url:
+            logging.info("GRAPH_NOTIFICATION_URL が未設定のため、サブスクリプションの更新をスキップします")
+            return
+        # アクセストークンの有効期限切れを避けるため取り直す
+        await asyncio.to_thread(self.sharepoint.get_access_token)
+        for project in list(self.container.read_all_items()):
+            try:
+                await self.ensure_subscription(project)
+            except Exception as e:
+                logging.error(f"プロジェクト '{project.get('project_name')}' のサブスクリプション更新エラー: {e}")
+
+    async def delete_subscription(self, project: dict):
+        subscription_id = project.get("change_tracking", {}).get("subscription_id")
+        if subscription_id:
+            await asyncio.to_thread(self.sharepoint.graph_api_delete, f"{GRAPH_SUBSCRIPTIONS_URL}/{subscription_id}")
+
+    # --- 通知の受信とまとめ処理 ---
+
+    def _find_project_name(self, subscription_id: str) -> str | None:
+        results = list(self.container.query_items(
+            query="SELECT c.project_name FROM c WHERE c.change_tracking.subscription_id = @subscription_id",
+            parameters=[{"name": "@subscription_id", "value": subscription_id}],
+            enable_cross_partition_query=True,
+        ))
+        return results[0]["project_name"] if results else None
+
+    async def handle_notifications(self, payload: dict) -> int:
+        """
+        Graph から受け取った通知を検証し、対象プロジェクトの再インデックスを予約する. 受け付けた通知数を返す.
+        """
+        accepted = 0
+        for notification in payload.get("value", []):
+            if notification.get("clientState", "") != notification_client_state:
+                logging.warning(f"clientState が一致しない通知を破棄しました: {notification.get('subscriptionId')}")
+                continue
+            project_name = await asyncio.to_thread(self._find_project_name, notification.get("subscriptionId"))
+            if project_name is None:
+                logging.warning(f"未登録のサブスクリプションからの通知です: {notification.get('subscriptionId')}")
+                continue
+            self.schedule(project_name)
+            accepted += 1
+        return accepted
+
+    def schedule(self, project_name: str):
+        """
+        再インデックスを予約する. 処理待ち・処理中のプロジェクトは、処理後にもう一度だけ実行する.
+        """
+        stats = self.stats.setdefault(project_name, {"notifications": 0, "batches": 0, "last_batch": None})
+        stats["notifications"] += 1
+        task = self._tasks.get(project_name)
+        if task is None or task.done():
+            self._tasks[project_name] = asyncio.create_task(self._run(project_name))
+        else:
+            self._dirty.add(project_name)
+
+    async def _run(self, project_name: str):
+        while True:
+            await asyncio.sleep(self.debounce_seconds)
+            # ここまでに届いた通知はこのバッチで処理される
+            self._dirty.discard(project_name)
+            try:
+                self.stats[project_name]["last_batch"] = await self.process_changes(project_name)
+                self.stats[project_name]["batches"] += 1
+            except Exception as e:
+                logging.error(f"プロジェクト '{project_name}' の変更の反映に失敗しました: {e}")
+            if project_name not in self._dirty:
+                return
+
+    async def process_changes(self, project_name: str) -> dict:
+        """
+        delta クエリで前回以降に変更されたファイルを取得し、変更分のみを再インデックスする.
+        """
+        project = await get_project_by_name(project_name)
+        if project is None:
+            return {"skipped": "project not found"}
+        tracking = project.setdefault("change_tracking", {})
+        site_id = tracking.get("site_id") or await asyncio.to_thread(self._get_site_id, project)
+
+        await asyncio.to_thread(self.sharepoint.get_access_token)
+        changes, delta_link = await asyncio.to_thread(self.sharepoint.get_drive_changes, site_id, tracking.get("delta_link"))
+        # 同じファイルの複数回の変更は 1 件にまとめる (最後の状態を使用)
+        latest = {item["id"]: item for item in changes if "folder" not in item and "root" not in item}
+        deleted_ids = [item_id for item_id, item in latest.items() if "deleted" in item]
+        changed_ids = [item_id for item_id, item in latest.items() if "deleted" not in item and "file" in item]
+
+        result = {"changed": len(changed_ids), "deleted": len(deleted_ids), "mode": change_reindex_mode}
+        if tracking.get("delta_link") is None:
+            # 初回は変更の基準となる delta リンクの取得のみ
+            result = {"initialized": True}
+        else:
+            index_profile = IndexStorageProfile(**project.get("index_profile", {}))
+            # 稼働中のインデックスにはインデクサーも登録するため、push ではインデクサーの parent_id を引き継ぐ (indexer_managed)
+            pipeline = PushIndexingPipeline(
+                project_name, site_id, self.sharepoint, self.search_indexing,
+                dedupe_text_fields=index_profile.dedupe_text_fields,
+                index_name=get_project_index_name(project),
+                indexer_managed=True,
+            )
+            if deleted_ids:
+                # インデクサーを実行しても削除されたファイルのチャンクは残るため、直接削除する
+                result["deleted_chunks"] = await pipeline.delete_document_chunks(deleted_ids)
+            run_indexer = bool(changed_ids)
+            if change_reindex_mode == "push" and changed_ids:
+                # delta の結果にはパスが含まれないため、フォルダ名の取得用にファイルの情報を取り直す
+                items = await asyncio.gather(*[
+                    asyncio.to_thread(self.sharepoint.get_drive_item, site_id, item_id) for item_id in changed_ids
+                ])
+                items = [item for item in items if item]
+                await pipeline.run(items=items)
+                result["removed_chunks"] = await pipeline.remove_stale_chunks([item["id"] for item in items])
+                result["failed"] = [item["id"] for item in items if pipeline.document_status(item["id"])["status"] == "failed"]
+                result["deferred"] = list(pipeline.deferred)
+                # インデックスに未登録のファイルはインデクサーで登録する
+                run_indexer = bool(pipeline.deferred)
+            if run_indexer:
+                try:
+                    await self.search_indexing.run_project_indexer(project_name)
+                except Exception as e:
+                    # 実行中の場合は、その実行で変更が取り込まれる
+                    logging.warning(f"インデクサーを実行できませんでした: {e}")
+
+        # 途中で例外が発生した場合は delta リンクを進めず、次回の通知で再処理する
+        tracking.update({"delta_link": delta_link, "site_id": site_id})
+        patch_project_fields(self.container, project, "change_tracking")
+        logging.info(f"プロジェクト '{project_name}' の変更を反映しました: {result}")
+        return result
@@ -0,0 +1,134 @@
+import os
+import re
+import logging
+
+from langchain.schema import Document
+
+from chunker import count_tokens
+from indexing_service import KEY_FIELD
+
+# 環境変数等の取得
+# 検索でヒットしたチャンクの前後それぞれ何チャンクまで展開するか (0 の場合は展開しない)
+chunk_expansion_window = int(os.getenv("CHUNK_EXPANSION_WINDOW", "0"))
+# 展開後のコンテキスト (すべてのパッセージの合計) のトークン数の上限. ヒットしたチャンクは上限を超えても残す
+chunk_expansion_max_tokens = int(os.getenv("CHUNK_EXPANSION_MAX_TOKENS", "3000"))
+
+# チャンクのキーの末尾の位置 ("{parent_id}_pages_3", インデックスプロジェクションの "..._chunks_3" など)
+# インデックスプロジェクションのキーはセクション (markdownDocument の要素) ごとに接頭辞が異なるため、
+# 前後のチャンクの展開は同じセクション内に限られる (セクションをまたいだ文脈は含めない. 意図した動作)
+CHUNK_KEY_PATTERN = re.compile(r"^(.+_)(\d+)$")
+# 連続するチャンクの重複 (チャンク間のオーバーラップ) を探す最大文字数
+OVERLAP_MAX_CHARS = 2000
+
+
+def parse_chunk_key(key: str) -> tuple[str, int] | None:
+    """
+    チャンクのキーを (接頭辞, 位置) に分ける. 接頭辞が同じチャンクは同じ親ドキュメント (セクション) の連続したチャンク.
+    """
+    match = CHUNK_KEY_PATTERN.match(key or "")
+    return (match.group(1), int(match.group(2))) if match else None
+
+
+def neighbor_positions(position: int, window: int) -> list[int]:
+    """
+    前後 window 個の位置を、近い順 (+1, -1, +2, -2, ...) に返す.
+    """
+    positions = []
+    for distance in range(1, window + 1):
+        positions += [p for p in (position + distance, position - distance) if p >= 0]
+    return positions
+
+
+def strip_overlap(previous: str, text: str) -> str:
+    """
+    text の先頭のうち、直前のチャンク previous の末尾と重複する部分を取り除く.
+    """
+    for size in range(min(len(previous), len(text), OVERLAP_MAX_CHARS), 0, -1):
+        if previous.endswith(text[:size]):
+            return text[size:]
+    return text
+
+
+def merge_chunks(chunks: dict[int, str]) -> str:
+    """
+    位置ごとのチャンクを 1 つのパッセージにまとめる. 連続するチャンクは重複を除いて連結し、間が空く場合は区切りを入れる.
+    """
+    passage, last_position = "", None
+    for position, text in sorted(chunks.items()):
+        if last_position is None:
+            passage = text
+        elif position == last_position + 1:
+            passage += strip_overlap(passage, text)
+        else:
+            passage += f"\n…\n{text}"
+        last_position = position
+    return passage
+
+
+async def expand_documents(retriever, index_name: str, docs: list[Document], window: int = None, max_tokens: int = None) -> list[Document]:
+    """
+    検索でヒットしたチャンクの前後のチャンクを、ヒットした親ドキュメント (parent_id) を指定したクエリでまとめて取得し、
+    同じ親ドキュメントのチャンクを連続したパッセージにまとめて返す (順序は最初にヒットしたチャンクの順位).
+    前後のチャンクは近いものから、コンテキスト全体が max_tokens を超えない範囲で追加する.
+    """
+    window = chunk_expansion_window if window is None else window
+    max_tokens = chunk_expansion_max_tokens if max_tokens is None else max_tokens
+    if window <= 0 or not docs:
+        return docs
+
+    hits = [(doc, parse_chunk_key(doc.metadata.get("id"))) for doc in docs]
+    hit_keys = {doc.metadata.get("id") for doc in docs}
+    wanted = []
+    for _, parsed in hits:
+        if parsed is not None:
+            prefix, position = parsed
+            wanted += [f"{prefix}{p}" for p in neighbor_positions(position, window) if f"{prefix}{p}" not in hit_keys]
+    wanted = list(dict.fromkeys(wanted))
+    if not wanted:
+        return docs
+
+    parent_ids = list(dict.fromkeys(
+        doc.metadata["parent_id"] for doc, parsed in hits if parsed is not None and doc.metadata.get("parent_id")
+    ))
+    chunks = await retriever.fetch_chunks(index_name, parent_ids, wanted)
+    contents = {item[KEY_FIELD]: item.get("content", "") for item in chunks}
+
+    # 親ドキュメントごとのパッセージ (キーを解釈できないチャンクはそのまま 1 つのパッセージにする)
+    passages: dict = {}
+    for rank, (doc, parsed) in enumerate(hits):
+        prefix, position = parsed if parsed is not None else (rank, 0)
+        passage = passages.setdefault(prefix, {"doc": doc, "score": 0, "chunks": {}, "ids": []})
+        passage["chunks"][position] = doc.page_content
+        passage["ids"].append(doc.metadata.get("id"))
+        passage["score"] = max(passage["score"], doc.metadata.get("@search.score") or 0)
+
+    budget = max_tokens - sum(count_tokens(doc.page_content) for doc in docs)
+    added = 0
+    # 各ヒットの近い位置から順に (距離 1 をすべてのヒットに追加してから距離 2 へ) 追加する
+    for distance in range(1, window + 1):
+        for doc, parsed in hits:
+            if parsed is None:
+                continue
+            prefix, position = parsed
+            passage = passages[prefix]
+            for p in (position + distance, position - distance):
+                key = f"{prefix}{p}"
+                if p in passage["chunks"] or key not in contents:
+                    continue
+                tokens = count_tokens(contents[key])
+                if tokens > budget:
+                    continue
+                budget -= tokens
+                passage["chunks"][p] = contents[key]
+                passage["ids"].append(key)
+                added += 1
+
+    expanded = [
+        Document(
+            page_content=merge_chunks(passage["chunks"]),
+            metadata={**passage["doc"].metadata, "@search.score": passage["score"], "chunk_ids": passage["ids"]},
+        )
+        for passage in passages.values()
+    ]
+    logging.info(f"前後のチャンクを展開しました: ヒット {len(docs)} 件 + 前後 {added} 件 → パッセージ {len(expanded)} 件")
+    return expanded
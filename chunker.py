@@ -0,0 +1,251 @@
+import os
+import re
+import asyncio
+from functools import cache
+from concurrent.futures import ProcessPoolExecutor
+
+import tiktoken
+
+# 環境変数等の取得
+chunk_max_tokens = int(os.getenv("CHUNK_MAX_TOKENS", "512"))
+chunk_overlap_tokens = int(os.getenv("CHUNK_OVERLAP_TOKENS", "64"))
+chunk_process_workers = int(os.getenv("CHUNK_PROCESS_WORKERS", str(os.cpu_count() or 1)))
+
+# text-embedding-ada-002 / gpt-4o 系のトークナイザー
+ENCODING_NAME = "cl100k_base"
+
+HEADING_PATTERN = re.compile(r"^(#{1,3})\s+(.*?)\s*#*\s*$")
+FENCE_PATTERN = re.compile(r"^\s*(```|~~~)")
+# 文の区切り (句点・感嘆符・疑問符・改行の直後)
+SENTENCE_PATTERN = re.compile(r"[^。！？!?\n]*(?:[。！？!?]+|\n|$)")
+
+
+@cache
+def get_encoding():
+    return tiktoken.get_encoding(ENCODING_NAME)
+
+
+def count_tokens(text: str) -> int:
+    return len(get_encoding().encode(text, disallowed_special=()))
+
+
+def split_sections(markdown: str) -> list[tuple[dict, str]]:
+    """
+    Markdown を h1〜h3 の見出しで分割し、(見出し, 本文) のリストを返す.
+    見出しは {"header_1": ..., "header_2": ..., "header_3": ...} の形式 (Layout スキルの sections/h1〜h3 に相当).
+    コードブロック内の "#" は見出しとして扱わない.
+    """
+    headers = {"header_1": "", "header_2": "", "header_3": ""}
+    sections, lines = [], []
+    in_fence = False
+    for line in markdown.splitlines():
+        if FENCE_PATTERN.match(line):
+            in_fence = not in_fence
+        match = None if in_fence else HEADING_PATTERN.match(line)
+        if match is None:
+            lines.append(line)
+            continue
+        if "\n".join(lines).strip():
+            sections.append((dict(headers), "\n".join(lines)))
+        lines = []
+        level = len(match.group(1))
+        headers[f"header_{level}"] = match.group(2)
+        # 上位の見出しが変わったら下位の見出しはリセットする
+        for lower in range(level + 1, 4):
+            headers[f"header_{lower}"] = ""
+    if "\n".join(lines).strip():
+        sections.append((dict(headers), "\n".join(lines)))
+    return sections
+
+
+def split_blocks(text: str) -> list[tuple[str, bool]]:
+    """
+    本文を段落・表・コードブロックに分割し、(テキスト, 分割不可か) のリストを返す.
+    表 (Markdown の "|" 形式と Layout が出力する <table>) とコードブロックは分割不可として 1 ブロックにまとめる.
+    """
+    blocks, current = [], []
+    kind = None  # None: 段落, "table": Markdown の表, "html": <table>, "fence": コードブロック
+
+    def flush(atomic: bool):
+        if "\n".join(current).strip():
+            blocks.append(("\n".join(current), atomic))
+        current.clear()
+
+    for line in text.splitlines():
+        stripped = line.strip()
+        if kind == "fence":
+            current.append(line)
+            if FENCE_PATTERN.match(line):
+                flush(True)
+                kind = None
+            continue
+        if kind == "html":
+            current.append(line)
+            if "</table>" in stripped:
+                flush(True)
+                kind = None
+            continue
+        if kind == "table" and not stripped.startswith("|"):
+            flush(True)
+            kind = None
+
+        if kind is None:
+            if FENCE_PATTERN.match(line):
+                flush(False)
+                kind = "fence"
+            elif stripped.startswith("<table"):
+                flush(False)
+                kind = "html"
+                if "</table>" in stripped:
+                    current.append(line)
+                    flush(True)
+                    kind = None
+                    continue
+            elif stripped.startswith("|"):
+                flush(False)
+                kind = "table"
+            elif not stripped:
+                flush(False)
+                continue
+        current.append(line)
+    flush(kind is not None)
+    return blocks
+
+
+def split_table_rows(table: str, max_tokens: int) -> list[str]:
+    """
+    max_tokens を超える表を行単位で分割する. 各部分には表のヘッダー行を付与する.
+    """
+    if "<tr" in table:
+        rows = re.findall(r"<tr.*?</tr>", table, flags=re.S)
+        header, rows, prefix, suffix = rows[:1], rows[1:], "<table>", "</table>"
+        separator = ""
+    else:
+        lines = table.splitlines()
+        header, rows, prefix, suffix = lines[:2], lines[2:], "", ""
+        separator = "\n"
+    parts, current = [], []
+    for row in rows:
+        candidate = prefix + separator.join(header + current + [row]) + suffix
+        if current and count_tokens(candidate) > max_tokens:
+            parts.append(prefix + separator.join(header + current) + suffix)
+            current = []
+        current.append(row)
+    if current or not parts:
+        parts.append(prefix + separator.join(header + current) + suffix)
+    return parts
+
+
+def split_units(block: str, atomic: bool, max_tokens: int) -> list[tuple[str, int, bool]]:
+    """
+    ブロックをチャンクの構成単位 (テキスト, トークン数, 分割不可か) に分解する.
+    段落は文単位、文が max_tokens を超える場合はトークン単位で分割する.
+    """
+    if atomic:
+        tokens = count_tokens(block)
+        if tokens <= max_tokens or not (block.lstrip().startswith("|") or "<tr" in block):
+            return [(block, tokens, True)]
+        return [(part, count_tokens(part), True) for part in split_table_rows(block, max_tokens)]
+
+    units = []
+    for sentence in SENTENCE_PATTERN.findall(block):
+        if not sentence:
+            continue
+        tokens = count_tokens(sentence)
+        if tokens <= max_tokens:
+            units.append((sentence, tokens, False))
+            continue
+        encoded = get_encoding().encode(sentence, disallowed_special=())
+        for start in range(0, len(encoded), max_tokens):
+            piece = get_encoding().decode(encoded[start:start + max_tokens])
+            units.append((piece, count_tokens(piece), False))
+    return units
+
+
+def chunk_markdown(markdown: str, max_tokens: int = None, overlap_tokens: int = None) -> list[dict]:
+    """
+    Markdown を h1〜h3 の見出し単位で区切り、各セクションを max_tokens トークン以下のチャンクに分割する.
+    チャンク間では直前のチャンク末尾の文を overlap_tokens トークンまで重複させる (表は重複させない).
+    戻り値: [{"content", "header_1", "header_2", "header_3", "tokens"}, ...]
+    """
+    max_tokens = max_tokens or chunk_max_tokens
+    overlap_tokens = chunk_overlap_tokens if overlap_tokens is None else overlap_tokens
+    chunks = []
+    for headers, body in split_sections(markdown):
+        units = []
+        for block, atomic in split_blocks(body):
+            block_units = split_units(block, atomic, max_tokens)
+            # 段落の区切りを保持する
+            text, tokens, unit_atomic = block_units[-1]
+            block_units[-1] = (text.rstrip("\n") + "\n\n", tokens, unit_atomic)
+            units.extend(block_units)
+
+        current, current_tokens = [], 0
+        for unit in units:
+            if current and current_tokens + unit[1] > max_tokens:
+                chunks.append({**headers, "content": "".join(text for text, _, _ in current).strip(), "tokens": current_tokens})
+                # 末尾の文を重複部分として次のチャンクに引き継ぐ
+                overlap, overlap_total = [], 0
+                for previous in reversed(current):
+                    if previous[2] or overlap_total + previous[1] > overlap_tokens or overlap_total + previous[1] + unit[1] > max_tokens:
+                        break
+                    overlap.insert(0, previous)
+                    overlap_total += previous[1]
+                current, current_tokens = overlap, overlap_total
+            current.append(unit)
+            current_tokens += unit[1]
+        if current and "".join(text for text, _, _ in current).strip():
+            chunks.append({**headers, "content": "".join(text for text, _, _ in current).strip(), "tokens": current_tokens})
+    return chunks
+
+
+def _chunk_worker(args: tuple[str, int, int]) -> list[dict]:
+    markdown, max_tokens, overlap_tokens = args
+    return chunk_markdown(markdown, max_tokens, overlap_tokens)
+
+
+_executor: ProcessPoolExecutor | None = None
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    """
+    チャンク分割用に共有するプロセスプール (初回呼び出し時に生成).
+    """
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=chunk_process_workers)
+    return _executor
+
+
+def shutdown_process_pool():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(cancel_futures=True)
+        _executor = None
+
+
+class MarkdownChunker:
+    """
+    chunk_markdown の設定を保持し、プロセスプールで並列にチャンク分割する.
+    ドキュメント数が parallel_threshold 未満の場合はプロセス間のコピーを避けて同じプロセスで実行する.
+    """
+    def __init__(self, max_tokens: int = None, overlap_tokens: int = None, parallel_threshold: int = 4):
+        self.max_tokens = max_tokens or chunk_max_tokens
+        self.overlap_tokens = chunk_overlap_tokens if overlap_tokens is None else overlap_tokens
+        self.parallel_threshold = parallel_threshold
+
+    def chunk(self, markdown: str) -> list[dict]:
+        return chunk_markdown(markdown, self.max_tokens, self.overlap_tokens)
+
+    def chunk_many(self, documents: list[str]) -> list[list[dict]]:
+        if len(documents) < self.parallel_threshold:
+            return [self.chunk(markdown) for markdown in documents]
+        args = [(markdown, self.max_tokens, self.overlap_tokens) for markdown in documents]
+        return list(get_process_pool().map(_chunk_worker, args, chunksize=max(1, len(args) // (chunk_process_workers * 4))))
+
+    async def achunk(self, markdown: str) -> list[dict]:
+        """
+        イベントループを塞がないよう、プロセスプールでチャンク分割する.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_process_pool(), _chunk_worker, (markdown, self.max_tokens, self.overlap_tokens))
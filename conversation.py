@@ -0,0 +1,281 @@
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+
+import numpy as np
+from azure.cosmos import PartitionKey, exceptions
+from langchain.schema import Document
+
+from chunker import count_tokens, get_encoding
+from generate_answer import embed_query, get_llm
+from routing import answer_fast_deployment
+
+# 環境変数等の取得
+# メモリに保持する会話の数 (超えた場合は最も長く使われていない会話から破棄する)
+conversation_cache_size = int(os.getenv("CONVERSATION_CACHE_SIZE", "1000"))
+# 最後のやり取りからこの秒数を過ぎた会話は破棄する (Cosmos DB のコンテナーの既定の TTL にも使用する)
+conversation_ttl_seconds = int(os.getenv("CONVERSATION_TTL_SECONDS", "86400"))
+# 会話を保存する Cosmos DB のコンテナー名 (未設定の場合はメモリのみ. 複数インスタンスで会話を共有する場合に設定する)
+conversation_cosmos_container = os.getenv("CONVERSATION_COSMOS_CONTAINER")
+# 要約せずにそのまま LLM に渡す直近のやり取りの数
+conversation_recent_turns = int(os.getenv("CONVERSATION_RECENT_TURNS", "3"))
+# 古いやり取りをまとめた要約のトークン数の上限
+conversation_summary_max_tokens = int(os.getenv("CONVERSATION_SUMMARY_MAX_TOKENS", "400"))
+# LLM に渡す履歴 (要約 + 直近のやり取り) 全体のトークン数の上限
+conversation_history_max_tokens = int(os.getenv("CONVERSATION_HISTORY_MAX_TOKENS", "1500"))
+# 前回の検索クエリとのコサイン類似度がこれ以上の場合は、検索せずに前回のチャンクを再利用する
+conversation_reuse_min_similarity = float(os.getenv("CONVERSATION_REUSE_MIN_SIMILARITY", "0.9"))
+
+SUMMARY_PROMPT = """次の会話の要約と新しいやり取りを、{max_tokens} トークン以内の日本語の要約 1 つにまとめてください。
+質問の対象 (資料名・フォルダ・固有名詞) と、回答で示された結論・数値を優先して残してください。
+
+これまでの要約:
+{summary}
+
+新しいやり取り:
+{turns}
+
+要約:"""
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """
+    text を先頭から max_tokens トークンまでに切り詰める.
+    """
+    tokens = get_encoding().encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return get_encoding().decode(tokens[:max_tokens]).rstrip() + "…"
+
+
+def cosine_similarity(a: list[float], b: list[float]) -> float:
+    a, b = np.asarray(a, dtype=np.float32), np.asarray(b, dtype=np.float32)
+    norm = float(np.linalg.norm(a) * np.linalg.norm(b))
+    return float(a @ b) / norm if norm else 0.0
+
+
+def new_conversation(conversation_id: str, scope: list) -> dict:
+    """
+    会話のレコード. scope はプロジェクト・フォルダの絞り込み (変わった場合は前回の検索結果を再利用しない).
+    """
+    return {
+        "id": conversation_id,
+        "scope": scope,
+        "summary": "",
+        "summarized_turns": 0,
+        "turns": [],  # 直近のやり取り (question, answer, document_ids, usage, latency_ms)
+        "retrieval": None,  # 前回の検索 (query, vector, documents)
+        "updated_at": time.time(),
+    }
+
+
+def format_turns(turns: list[dict]) -> str:
+    return "\n".join(f"ユーザー: {turn['question']}\nアシスタント: {turn['answer']}" for turn in turns)
+
+
+def format_history(conversation: dict) -> str | None:
+    """
+    LLM に渡す履歴 (要約 + 直近のやり取り). CONVERSATION_HISTORY_MAX_TOKENS を超える場合は古いやり取りから省く.
+    """
+    turns = list(conversation["turns"])
+    summary = f"(要約) {conversation['summary']}" if conversation["summary"] else ""
+    while turns:
+        history = "\n".join(part for part in (summary, format_turns(turns)) if part)
+        if count_tokens(history) <= conversation_history_max_tokens:
+            return history
+        turns.pop(0)
+    return summary or None
+
+
+def retrieval_query(conversation: dict, user_question: str) -> str:
+    """
+    検索クエリ. 「それの期限は？」のような追加の質問でも検索できるよう、直前の質問を前に付ける.
+    """
+    if not conversation["turns"]:
+        return user_question
+    return f"{conversation['turns'][-1]['question']}\n{user_question}"
+
+
+def serialize_documents(docs: list[Document]) -> list[dict]:
+    return [{"page_content": doc.page_content, "metadata": doc.metadata} for doc in docs]
+
+
+def deserialize_documents(items: list[dict]) -> list[Document]:
+    return [Document(page_content=item["page_content"], metadata=item["metadata"]) for item in items]
+
+
+class ConversationStore:
+    """
+    conversation_id ごとの会話を保持する (メモリの LRU + CONVERSATION_COSMOS_CONTAINER を設定した場合は Cosmos DB).
+    """
+    def __init__(self, database=None, capacity: int = None):
+        self.capacity = capacity or conversation_cache_size
+        self._entries: OrderedDict[str, dict] = OrderedDict()
+        self._locks: dict[str, asyncio.Lock] = {}
+        self.container = None
+        if database is not None and conversation_cosmos_container:
+            self.container = database.create_container_if_not_exists(
+                id=conversation_cosmos_container,
+                partition_key=PartitionKey(path="/id"),
+                default_ttl=conversation_ttl_seconds,
+            )
+        self.hits = 0
+        self.misses = 0
+        self.reused = 0
+        self.searched = 0
+
+    def lock(self, conversation_id: str) -> asyncio.Lock:
+        """
+        同じ会話の質問を 1 件ずつ処理するためのロック (前のやり取りを履歴に含めるため).
+        """
+        return self._locks.setdefault(conversation_id, asyncio.Lock())
+
+    async def get(self, conversation_id: str) -> dict | None:
+        conversation = self._entries.get(conversation_id)
+        if conversation is None and self.container is not None:
+            try:
+                conversation = await asyncio.to_thread(self.container.read_item, conversation_id, conversation_id)
+            except exceptions.CosmosResourceNotFoundError:
+                conversation = None
+            except exceptions.CosmosHttpResponseError as e:
+                logging.warning(f"会話 '{conversation_id}' の読み込みに失敗しました: {e}")
+                conversation = None
+        if conversation is None or time.time() - conversation["updated_at"] > conversation_ttl_seconds:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._remember(conversation)
+        return conversation
+
+    def _remember(self, conversation: dict):
+        self._entries[conversation["id"]] = conversation
+        self._entries.move_to_end(conversation["id"])
+        while len(self._entries) > self.capacity:
+            evicted, _ = self._entries.popitem(last=False)
+            lock = self._locks.get(evicted)
+            if lock is not None and not lock.locked():
+                del self._locks[evicted]
+
+    async def save(self, conversation: dict):
+        conversation["updated_at"] = time.time()
+        self._remember(conversation)
+        if self.container is not None:
+            record = {key: value for key, value in conversation.items() if not key.startswith("_")}
+            try:
+                await asyncio.to_thread(self.container.upsert_item, record)
+            except exceptions.CosmosHttpResponseError as e:
+                # 保存に失敗しても回答は返す (このインスタンスのメモリには残る)
+                logging.warning(f"会話 '{conversation['id']}' の保存に失敗しました: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "conversations": len(self._entries),
+            "persistent": self.container is not None,
+            "hits": self.hits,
+            "misses": self.misses,
+            "reused_retrievals": self.reused,
+            "searches": self.searched,
+        }
+
+
+async def prepare_turn(store: ConversationStore, conversation_id: str, scope: list, user_question: str, search) -> dict:
+    """
+    会話の 1 回分の質問の準備. 会話を読み込み、検索クエリをベクトル化して、前回の検索クエリと十分に近ければ
+    前回のチャンクを再利用し (検索を省略)、そうでなければ search(query, vector) で検索する.
+    返り値の turn は record_turn に渡す.
+    """
+    started = time.monotonic()
+    conversation = await store.get(conversation_id)
+    if conversation is None:
+        conversation = new_conversation(conversation_id, scope)
+    elif conversation["scope"] != scope:
+        conversation["scope"], conversation["retrieval"] = scope, None
+
+    query = retrieval_query(conversation, user_question)
+    vector = await embed_query(query)
+    previous = conversation["retrieval"]
+    similarity = cosine_similarity(vector, previous["vector"]) if previous else None
+    if similarity is not None and similarity >= conversation_reuse_min_similarity and previous["documents"]:
+        store.reused += 1
+        docs = deserialize_documents(previous["documents"])
+        reused = True
+        logging.info(f"会話 '{conversation_id}': 前回の検索結果を再利用します (類似度 {similarity:.3f})")
+    else:
+        store.searched += 1
+        docs = await search(query, vector)
+        reused = False
+        conversation["retrieval"] = {"query": query, "vector": vector, "documents": serialize_documents(docs)}
+
+    return {
+        "conversation": conversation,
+        "documents": docs,
+        "history": format_history(conversation),
+        "reused_documents": reused,
+        "similarity": similarity,
+        "retrieval_ms": round((time.monotonic() - started) * 1000, 1),
+    }
+
+
+async def summarize_turns(summary: str, turns: list[dict]) -> str:
+    """
+    要約と新しいやり取りを、CONVERSATION_SUMMARY_MAX_TOKENS 以内の要約にまとめる.
+    LLM (ANSWER_FAST_DEPLOYMENT があればそちら) で要約し、失敗した場合は切り詰めて連結する.
+    """
+    prompt = SUMMARY_PROMPT.format(
+        max_tokens=conversation_summary_max_tokens, summary=summary or "(なし)", turns=format_turns(turns)
+    )
+    try:
+        message = await get_llm("fast" if answer_fast_deployment else "full").ainvoke(prompt)
+        new_summary = message.content.strip()
+    except Exception as e:
+        logging.warning(f"会話の要約に失敗したため、切り詰めて保存します: {e}")
+        new_summary = "\n".join(part for part in (summary, format_turns(turns)) if part)
+    return truncate_tokens(new_summary, conversation_summary_max_tokens)
+
+
+async def record_turn(store: ConversationStore, turn: dict, user_question: str, answer: dict, llm_ms: float) -> dict:
+    """
+    やり取りを会話に追加して保存し、このやり取りのレポート (レイテンシ・トークン数) を返す.
+    """
+    conversation = turn["conversation"]
+    report = {
+        "conversation_id": conversation["id"],
+        "turn": conversation["summarized_turns"] + len(conversation["turns"]) + 1,
+        "reused_documents": turn["reused_documents"],
+        "history_tokens": count_tokens(turn["history"]) if turn["history"] else 0,
+        "usage": answer.get("usage"),
+        "latency_ms": {"retrieval": turn["retrieval_ms"], "llm": round(llm_ms, 1)},
+    }
+    conversation["turns"].append({
+        "question": user_question,
+        "answer": answer.get("answer", ""),
+        "document_ids": [doc.metadata.get("id") for doc in turn["documents"]],
+        "usage": answer.get("usage"),
+        "latency_ms": report["latency_ms"],
+    })
+    await store.save(conversation)
+    logging.info(f"会話のやり取り: {report}")
+    return report
+
+
+async def compact_conversation(store: ConversationStore, conversation_id: str):
+    """
+    CONVERSATION_RECENT_TURNS を超えた古いやり取りを要約にまとめる.
+    応答を返した後 (BackgroundTasks) に実行し、次の質問はこの処理が終わるまで待つ.
+    """
+    async with store.lock(conversation_id):
+        conversation = await store.get(conversation_id)
+        if conversation is None or len(conversation["turns"]) <= conversation_recent_turns:
+            return
+        folded = conversation["turns"][:-conversation_recent_turns]
+        started = time.monotonic()
+        conversation["summary"] = await summarize_turns(conversation["summary"], folded)
+        conversation["summarized_turns"] += len(folded)
+        conversation["turns"] = conversation["turns"][-conversation_recent_turns:]
+        await store.save(conversation)
+        logging.info(
+            f"会話 '{conversation_id}': {len(folded)} 件のやり取りを要約しました "
+            f"({count_tokens(conversation['summary'])} トークン, {(time.monotonic() - started) * 1000:.0f} ms)"
+        )
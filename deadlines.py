@@ -0,0 +1,123 @@
+import os
+import time
+import asyncio
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# 環境変数等の取得
+# リクエストの処理時間の上限 (秒). クライアントは X-Request-Timeout ヘッダー (秒) でこれより短い値を指定できる
+request_deadline_seconds = float(os.getenv("REQUEST_DEADLINE_SECONDS", "30"))
+# X-Request-Timeout で指定できる上限 (秒)
+request_deadline_max_seconds = float(os.getenv("REQUEST_DEADLINE_MAX_SECONDS", "120"))
+
+DEADLINE_HEADER = "X-Request-Timeout"
+
+
+class DeadlineExceeded(Exception):
+    """
+    リクエストの残り時間がなくなったため、ステージ stage を開始しなかった・打ち切ったことを表す.
+    """
+    def __init__(self, stage: str):
+        super().__init__(f"リクエストの処理時間の上限に達しました (stage: {stage})")
+        self.stage = stage
+
+
+class Deadline:
+    """
+    リクエスト 1 件の処理期限. 各ステージはこの残り時間からタイムアウトを決める.
+    """
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def stage_timeout(self, cap: float = None, reserve: float = 0.0) -> float:
+        """
+        ステージに割り当てるタイムアウト. 後続のステージのために reserve 秒を残し、cap 秒を超えないようにする.
+        """
+        timeout = self.remaining() - reserve
+        return min(timeout, cap) if cap is not None else timeout
+
+    def extend(self, expires_at: float):
+        """
+        期限を expires_at (time.monotonic() の値) まで延ばす (短くはしない). 1 つの処理を複数のリクエストで共有する場合に使用する.
+        """
+        self.expires_at = max(self.expires_at, expires_at)
+
+
+_current_deadline: ContextVar[Deadline | None] = ContextVar("request_deadline", default=None)
+
+
+def current_deadline() -> Deadline | None:
+    return _current_deadline.get()
+
+
+def remaining_seconds() -> float | None:
+    """
+    現在のリクエストの残り時間 (期限のないバックグラウンド処理などでは None).
+    """
+    deadline = _current_deadline.get()
+    return deadline.remaining() if deadline is not None else None
+
+
+def deadline_from_headers(headers) -> float:
+    """
+    X-Request-Timeout ヘッダー (秒) からリクエストの処理時間を決める (未指定・不正な値の場合は既定値).
+    """
+    value = headers.get(DEADLINE_HEADER)
+    if not value:
+        return request_deadline_seconds
+    try:
+        seconds = float(value)
+    except ValueError:
+        logging.warning(f"{DEADLINE_HEADER} の値が不正なため既定値を使用します: {value}")
+        return request_deadline_seconds
+    return min(max(seconds, 0.0), request_deadline_max_seconds)
+
+
+@contextmanager
+def deadline_scope(seconds: float):
+    """
+    with ブロック内 (そこから呼び出す coroutine・タスクを含む) の処理期限を設定する.
+    """
+    token = _current_deadline.set(Deadline(seconds))
+    try:
+        yield _current_deadline.get()
+    finally:
+        _current_deadline.reset(token)
+
+
+@contextmanager
+def use_deadline(deadline: Deadline | None):
+    """
+    with ブロック内の処理期限を、既存の Deadline オブジェクト (呼び出し元と共有して延長できる) にする.
+    """
+    token = _current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current_deadline.reset(token)
+
+
+async def run_stage(stage: str, awaitable, cap: float = None, reserve: float = 0.0):
+    """
+    awaitable を残り時間 (cap 秒以下、後続のために reserve 秒を残す) 以内で実行する.
+    時間内に終わらない場合はキャンセルし (HTTP 呼び出しも中断され、同時実行数の枠を解放する)、DeadlineExceeded を送出する.
+    期限が設定されていない場合は cap のみを適用する.
+    """
+    deadline = _current_deadline.get()
+    timeout = deadline.stage_timeout(cap, reserve) if deadline is not None else cap
+    if timeout is not None and timeout <= 0:
+        if asyncio.iscoroutine(awaitable):
+            awaitable.close()
+        raise DeadlineExceeded(stage)
+    try:
+        return await asyncio.wait_for(awaitable, timeout=timeout)
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded(stage) from None
@@ -0,0 +1,121 @@
+import os
+import sqlite3
+import asyncio
+import hashlib
+import logging
+import tempfile
+import threading
+import numpy as np
+
+# 環境変数等の取得
+# (Functions では作業ディレクトリが読み取り専用のため、既定は一時ディレクトリ)
+embedding_cache_path = os.getenv("EMBEDDING_CACHE_PATH") or os.path.join(tempfile.gettempdir(), "embedding_cache.sqlite3")
+
+
+def embedding_key(model_name: str, text: str) -> str:
+    """
+    埋め込みモデル名とチャンク本文から、キャッシュのキー (SHA-256) を生成する.
+    モデルを変更した場合は別のキーになるため、古いベクトルが再利用されることはない.
+    """
+    return hashlib.sha256(f"{model_name}\n{text}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingStore:
+    """
+    チャンク単位の埋め込みベクトルを保存する SQLite ストア (キー: embedding_key, 値: float32 のバイト列).
+    """
+    def __init__(self, path: str = None):
+        self.path = path or embedding_cache_path
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+        self._connection.commit()
+        self._lock = threading.Lock()
+
+    def get_many(self, keys: list[str]) -> dict[str, list[float]]:
+        found = {}
+        with self._lock:
+            # SQLite のパラメータ数の上限を超えないよう分割して検索する
+            for start in range(0, len(keys), 500):
+                part = keys[start:start + 500]
+                rows = self._connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(part))})", part
+                ).fetchall()
+                for key, vector in rows:
+                    found[key] = np.frombuffer(vector, dtype=np.float32).tolist()
+        return found
+
+    def put_many(self, items: dict[str, list[float]]):
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                [(key, np.asarray(vector, dtype=np.float32).tobytes()) for key, vector in items.items()],
+            )
+            self._connection.commit()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class CachedEmbedder:
+    """
+    EmbeddingStore に保存済みのチャンクはベクトルを再利用し、新しいチャンクのみ埋め込み API を呼び出す.
+    1 回のインデックス作成ごとに生成し、キャッシュのヒット率と削減できた API 呼び出し数を集計する.
+    """
+    def __init__(self, embedding_model, store: EmbeddingStore, model_name: str = None):
+        self.embedding_model = embedding_model
+        self.store = store
+        self.model_name = model_name or getattr(embedding_model, "deployment", None) or embedding_model.model
+        self.hits = 0  # キャッシュから取得したチャンク数
+        self.misses = 0  # API でベクトル化したチャンク数
+        self.requests = 0  # 実際に行った API 呼び出し数
+        self.requests_saved = 0  # 全チャンクがキャッシュにあり、呼び出しを省略できた回数
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        keys = [embedding_key(self.model_name, text) for text in texts]
+        cached = await asyncio.to_thread(self.store.get_many, list(set(keys)))
+
+        # 同じバッチ内の重複チャンクは 1 回だけベクトル化する
+        missing = {key: text for key, text in zip(keys, texts) if key not in cached}
+        self.hits += len(texts) - sum(1 for key in keys if key in missing)
+        self.misses += sum(1 for key in keys if key in missing)
+
+        if missing:
+            vectors = await self.embedding_model.aembed_documents(list(missing.values()))
+            self.requests += 1
+            new_vectors = dict(zip(missing.keys(), vectors))
+            await asyncio.to_thread(self.store.put_many, new_vectors)
+            cached.update(new_vectors)
+        else:
+            self.requests_saved += 1
+
+        return [cached[key] for key in keys]
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "chunks": total,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            "embedding_requests": self.requests,
+            "embedding_requests_saved": self.requests_saved,
+        }
+
+
+_store: EmbeddingStore | None = None
+
+
+def get_embedding_store() -> EmbeddingStore:
+    """
+    プロセス内で共有する EmbeddingStore を返す (初回呼び出し時に生成).
+    """
+    global _store
+    if _store is None:
+        _store = EmbeddingStore()
+        logging.info(f"埋め込みキャッシュを開きました: {_store.path}")
+    return _store
@@ -0,0 +1,83 @@
+import os
+import time
+import logging
+
+from fastapi import HTTPException
+
+from indexing_service import ProjectIndexingService, get_project_index_name, project_filter
+
+# 環境変数等の取得
+# フォルダ一覧の取得元 ("index": インデックスの folderPath のファセット, "graph": SharePoint の Graph API)
+folder_listing_source = os.getenv("FOLDER_LISTING_SOURCE", "graph")
+# インデックスから取得したフォルダ一覧をキャッシュする秒数 (インデクサーの実行が完了した場合はそれより前に取り直す)
+folder_listing_cache_ttl = int(os.getenv("FOLDER_LISTING_CACHE_TTL", "3600"))
+# ファセットとして取得する folderPath の値の上限 (フォルダ・サブフォルダの数がこれを超える場合は増やす)
+folder_facet_max = int(os.getenv("FOLDER_FACET_MAX", "5000"))
+
+
+def build_folder_tree(prefixes) -> dict[str, list[str]]:
+    """
+    folderPath の値 ("A", "A/B", "A/B/C" ...) から、フォルダ名とサブフォルダ名の一覧 ({"A": ["B"]}) を作成する.
+    """
+    tree: dict[str, set[str]] = {}
+    for prefix in prefixes:
+        parts = prefix.split("/")
+        if len(parts) == 1:
+            tree.setdefault(parts[0], set())
+        elif len(parts) == 2:
+            tree.setdefault(parts[0], set()).add(parts[1])
+    return {folder: sorted(subfolders) for folder, subfolders in sorted(tree.items())}
+
+
+def last_indexed_at(project: dict) -> str | None:
+    """
+    プロジェクトのレコードの実行履歴 (indexer_monitor が保存した indexing_history) から、最後に完了した実行の終了時刻を返す.
+    """
+    end_times = [run["end_time"] for run in project.get("indexing_history", []) if run.get("end_time")]
+    return max(end_times) if end_times else None
+
+
+class FolderListingCache:
+    """
+    インデックスに登録されたフォルダ・サブフォルダの一覧を、プロジェクトごとに 1 回のファセット検索で取得してキャッシュする.
+    稼働中のインデックス名とインデクサーの最後の実行の終了時刻が変わった場合 (再構築の切り替え・実行の完了) は取り直す.
+    """
+    def __init__(self, search_indexing: ProjectIndexingService):
+        self.search_indexing = search_indexing
+        self._entries: dict[str, dict] = {}
+
+    async def fetch_folder_tree(self, project: dict) -> dict[str, list[str]]:
+        project_name = project["project_name"]
+        response = await self.search_indexing.http_client.post(
+            f"/indexes('{get_project_index_name(project)}')/docs/search.post.search",
+            params={"api-version": self.search_indexing.api_version},
+            json={
+                "search": "*",
+                "filter": project_filter(project_name),
+                "facets": [f"folderPath,count:{folder_facet_max}"],
+                "top": 0,
+            },
+        )
+        if response.status_code != 200:
+            raise HTTPException(status_code=response.status_code, detail=f"フォルダ一覧の取得に失敗しました: {response.text}")
+        facets = response.json().get("@search.facets", {}).get("folderPath", [])
+        if len(facets) >= folder_facet_max:
+            logging.warning(f"プロジェクト '{project_name}' の folderPath のファセットが上限 ({folder_facet_max}) に達しました")
+        return build_folder_tree(facet["value"] for facet in facets)
+
+    async def get_folder_tree(self, project: dict) -> dict[str, list[str]]:
+        project_name = project["project_name"]
+        marker = (get_project_index_name(project), last_indexed_at(project))
+        entry = self._entries.get(project_name)
+        if entry is not None and entry["marker"] == marker and time.monotonic() - entry["fetched_at"] < folder_listing_cache_ttl:
+            return entry["tree"]
+
+        tree = await self.fetch_folder_tree(project)
+        self._entries[project_name] = {"marker": marker, "fetched_at": time.monotonic(), "tree": tree}
+        return tree
+
+    def invalidate(self, project_name: str = None):
+        if project_name is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(project_name, None)
@@ -1,5 +1,26 @@
 import azure.functions as func
 
-from function_rag import app as fastapi_app
+import logging
 
-app = func.AsgiFunctionApp(app=fastapi_app, http_auth_level=func.AuthLevel.ANONYMOUS)
\ No newline at end of file
+from function_rag import app as fastapi_app, change_notifications, indexer_monitor, index_rebuilder
+
+app = func.AsgiFunctionApp(app=fastapi_app, http_auth_level=func.AuthLevel.ANONYMOUS)
+
+
+# SharePoint の変更通知のサブスクリプションを 12 時間ごとに確認し、期限が近いものを更新する
+@app.timer_trigger(schedule="0 0 */12 * * *", arg_name="timer", run_on_startup=False)
+async def renew_graph_subscriptions(timer: func.TimerRequest) -> None:
+    await change_notifications.renew_subscriptions()
+    logging.info("変更通知のサブスクリプションを確認しました")
+
+
+# 全プロジェクトのインデクサーの実行状況を 5 分ごとに取得し、実行履歴を記録する
+@app.timer_trigger(schedule="0 */5 * * * *", arg_name="timer", run_on_startup=False)
+async def poll_indexer_status(timer: func.TimerRequest) -> None:
+    await indexer_monitor.poll_all()
+
+
+# 再構築中のインデックスの投入状況を 5 分ごとに確認し、完了していれば検証して切り替える
+@app.timer_trigger(schedule="30 */5 * * * *", arg_name="timer", run_on_startup=False)
+async def advance_index_rebuilds(timer: func.TimerRequest) -> None:
+    await index_rebuilder.advance_all()
@@ -1,12 +1,18 @@
 import azure.functions as func
 
 import openai
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 import os
+import time
+import json
+import asyncio
 import logging
 import uuid
+import hmac
 from azure.core.exceptions import ResourceExistsError
+from typing import Literal
 from pydantic import BaseModel
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents.indexes import SearchIndexClient
@@ -14,10 +20,28 @@ from azure.search.documents.indexes import SearchIndexerClient
 from azure.cosmos import CosmosClient, exceptions
 
 #import mylibraly
-from generate_answer import generate_answer, generate_answer_all
-from utils import check_spo_url, get_spo_url_by_project_name, get_site_info_by_url, fetch_folders, delete_project_resources, fetch_subfolders
+from generate_answer import generate_answer, generate_answer_all, retrieve_documents, retrieve_all_documents, stream_answer, answer_or_degrade
+from utils import check_spo_url, get_spo_url_by_project_name, get_project_by_name, get_site_info_by_url, fetch_folders, delete_project_resources, fetch_subfolders
 from SharePoint import SharePointAccessClass
-from indexing_service import ProjectIndexingService
+from indexing_service import ProjectIndexingService, get_index_name, get_project_index_name, shared_index_name, folder_path_prefixes, skill_api_key, SKILL_KEY_HEADER
+from retrievers import close_retrievers
+from push_pipeline import PushIndexingPipeline, to_drive_relative_path
+from embedding_cache import CachedEmbedder, get_embedding_store
+from layout_cache import close_layout_store
+from chunker import shutdown_process_pool
+from change_notifications import ChangeNotificationProcessor
+from indexer_monitor import IndexerMonitor
+from index_rebuild import IndexRebuilder
+from folder_listing import FolderListingCache, folder_listing_source
+from resilience import record_cosmos_response, upstream_stats, is_throttled_error, unwrap_error, CircuitOpenError
+from deadlines import DeadlineExceeded, deadline_from_headers, deadline_scope, run_stage
+from singleflight import SingleFlight, answer_key
+from routing import route_metrics
+from openai_pool import pool_stats
+from conversation import ConversationStore, prepare_turn, record_turn, compact_conversation
+from generate_answer import get_embedding_model
+from search_profiles import IndexStorageProfile, VectorAlgorithmProfile, IndexingPerformanceProfile
+from indexing_estimate import crawl_site_files, estimate_indexing, baseline_docs_per_minute
 
 # 環境変数から設定を取得
 intelligence_key = os.getenv("DOCUMENT_INTELLIGENCE_API_KEY")
@@ -44,21 +68,69 @@ sharepoint = SharePointAccessClass(client_id, client_secret, tenant_id)
 # indexingクラスの初期化
 search_indexing = ProjectIndexingService()
 
+# push 型インデックス作成の実行状況 (プロジェクト名 -> パイプライン)
+push_runs: dict[str, PushIndexingPipeline] = {}
+
 # FastAPI アプリケーションの初期化
 app = FastAPI()
 
+@app.on_event("shutdown")
+async def close_clients():
+    """
+    アプリケーション終了時に共有 HTTP クライアントをクローズする。
+    """
+    await search_indexing.aclose()
+    await close_retrievers()
+    await close_layout_store()
+    shutdown_process_pool()
+
 # リクエストボディのスキーマ定義
 class AnswerRequest(BaseModel):
     user_question: str
     project_name: str
     folder_name:str = None  # オプション項目（指定がない場合はNone）
     subfolder_name:str = None  # オプション項目（指定がない場合はNone）
-    conversation_id: str = None  # オプション項目（指定がない場合はNone）
+    folder_path:str = None  # 任意の階層のフォルダ ("フォルダ/サブフォルダ/..."). 指定した場合は folder_name, subfolder_name より優先する (PATH_PREFIX_SKILL_URI の設定が必要)
+    conversation_id: str = None  # 会話の ID (指定した場合は同じ ID の過去のやり取りを踏まえて回答する)
 
 class RegisterProjectRequest(BaseModel):
     project_name: str
     spo_url: str
     include_root_files:bool
+    index_profile: IndexStorageProfile = IndexStorageProfile()  # ベクトル圧縮・重複排除の設定
+    vector_profile: VectorAlgorithmProfile = VectorAlgorithmProfile()  # HNSW のパラメータ・全件探索の設定
+    performance_profile: IndexingPerformanceProfile = IndexingPerformanceProfile()  # インデクサーのバッチサイズ・失敗の許容数・対象とする拡張子の設定
+    estimate: bool = False  # True の場合、SharePoint をクロールしてインデックス作成の件数・所要時間の見積もりを返す
+    answer_route: Literal["auto", "fast", "full"] = "auto"  # 回答に使用するデプロイメント (auto: 質問の難しさで振り分ける, fast/full: 固定)
+
+class PushIndexRequest(BaseModel):
+    download_workers: int = 8
+    chunk_workers: int = 4
+    embed_workers: int = 4
+    upload_workers: int = 2
+    embed_batch_size: int = 16
+    upload_batch_size: int = 1000  # mergeOrUpload 1 回あたりの件数 (上限 1000)
+    max_chunk_tokens: int = None  # チャンクの最大トークン数 (未指定の場合は CHUNK_MAX_TOKENS)
+    chunk_overlap_tokens: int = None  # チャンク間で重複させるトークン数 (未指定の場合は CHUNK_OVERLAP_TOKENS)
+
+class ReindexRequest(BaseModel):
+    document_paths: list[str] = []  # documentPath ("/sites/{サイト}/{ライブラリ}/...") またはドキュメントの URL
+    document_ids: list[str] = []  # インデックスの documentId (reset / push 共通. 未登録のファイルは document_paths で指定する)
+    mode: Literal["reset", "push"] = "reset"  # reset: インデクサーの resetdocs, push: push 型パイプラインで直接登録
+
+class RebuildIndexRequest(BaseModel):
+    mode: Literal["pull", "push"] = "pull"  # pull: インデクサーで投入, push: push 型パイプラインで投入
+    index_profile: IndexStorageProfile = None  # 新しいインデックスの設定 (未指定の場合は /resist_project で保留した設定、なければ現在の設定)
+    vector_profile: VectorAlgorithmProfile = None
+    sample_query: str = None  # 切り替え前に新しいインデックスで実行し、結果が返ることを確認するクエリ
+    min_count_ratio: float = None  # 切り替えに必要な、稼働中のインデックスに対するドキュメント数の比率 (未指定の場合は REBUILD_MIN_COUNT_RATIO)
+
+class SkillRecord(BaseModel):
+    recordId: str
+    data: dict
+
+class SkillRequest(BaseModel):
+    values: list[SkillRecord]
 
 class DeleteProjectRequest(BaseModel):
     project_name: str
@@ -75,9 +147,39 @@ index_client = SearchIndexClient(azure_search_endpoint, AzureKeyCredential(azure
 indexer_client = SearchIndexerClient(azure_search_endpoint, AzureKeyCredential(azure_search_key))
 
 # Cosmos DB クライアントの初期化
-cosmos_client = CosmosClient(cosmos_endpoint, cosmos_key)
+cosmos_client = CosmosClient(cosmos_endpoint, cosmos_key, raw_response_hook=record_cosmos_response)
 database = cosmos_client.get_database_client(cosmos_database_name)
 container = database.get_container_client(cosmos_container_name)
+# conversation_id ごとの会話の履歴 (CONVERSATION_COSMOS_CONTAINER を設定した場合は Cosmos DB にも保存する)
+conversations = ConversationStore(database)
+
+# 変更通知の処理 (サブスクリプション管理と再インデックスのまとめ処理)
+change_notifications = ChangeNotificationProcessor(sharepoint, container, search_indexing)
+
+# インデクサーの実行状況の監視
+indexer_monitor = IndexerMonitor(search_indexing, container)
+
+# インデックスのブルーグリーン方式の再構築
+index_rebuilder = IndexRebuilder(search_indexing, container, sharepoint)
+
+# インデックスのファセットから取得したフォルダ一覧のキャッシュ (FOLDER_LISTING_SOURCE=index の場合に使用)
+folder_listing = FolderListingCache(search_indexing)
+
+async def get_indexed_folder_tree(project_name: str) -> dict[str, list[str]] | None:
+    """
+    インデックスに登録されたフォルダ・サブフォルダの一覧を返す.
+    FOLDER_LISTING_SOURCE=index でない場合や、取得に失敗した・インデックスが空の場合は None を返し、Graph API で取得させる.
+    """
+    if folder_listing_source != "index":
+        return None
+    try:
+        project = await get_project_by_name(project_name)
+        if project is None:
+            return None
+        return await folder_listing.get_folder_tree(project) or None
+    except Exception as e:
+        logging.warning(f"インデックスからのフォルダ一覧の取得に失敗したため、SharePoint から取得します: {e}")
+        return None
 
 @app.post("/get_spo_folders")
 async def get_spo_folders(request:GetSpoFoldersRequest):
@@ -85,15 +187,21 @@ async def get_spo_folders(request:GetSpoFoldersRequest):
     SPOのURLから、それに対応したサイト名を検索し、そのサイト内のフォルダ一覧を返すエンドポイント。
     """
     try:
-        # サイトIDを取得
+        # インデックスに登録されたフォルダのみを返す (ファセット検索 1 回、キャッシュ済みの場合は検索しない)
         project_name = request.project_name
+        folder_tree = await get_indexed_folder_tree(project_name)
+        if folder_tree is not None:
+            return JSONResponse(content={"folders": list(folder_tree)})
+
+        # サイトIDを取得
         spo_url = await get_spo_url_by_project_name(project_name)
-        sites_data = sharepoint.get_sites()
+        # Graph の呼び出しは同期 (再試行の待機を含む) のため、イベントループを止めないよう別スレッドで実行する
+        sites_data = await asyncio.to_thread(sharepoint.get_sites)
 
         # サイト一覧から 'webUrl' が target_url に一致するサイトを検索
         matching_site = get_site_info_by_url(sites_data, spo_url)
         site_name = matching_site["name"]
-        site_id = sharepoint.get_site_id(site_name)
+        site_id = await asyncio.to_thread(sharepoint.get_site_id, site_name)
 
         logging.info(f"サイト '{site_name}' のIDを取得しました")
         if not site_id:
@@ -102,7 +210,7 @@ async def get_spo_folders(request:GetSpoFoldersRequest):
 
         # フォルダ一覧を取得
         root_folder="root"
-        folder_list = fetch_folders(sharepoint, site_id, root_folder)
+        folder_list = await asyncio.to_thread(fetch_folders, sharepoint, site_id, root_folder)
 
         return JSONResponse(content={"folders": folder_list})
     
@@ -119,13 +227,17 @@ async def get_spo_subfolders(request:GetSpoSubFoldersRequest):
         # サイトIDを取得
         project_name = request.project_name
         folder_name = request.folder_name
+        folder_tree = await get_indexed_folder_tree(project_name)
+        if folder_tree is not None:
+            return JSONResponse(content={"subfolders": folder_tree.get(folder_name, [])})
+
         spo_url = await get_spo_url_by_project_name(project_name)
-        sites_data = sharepoint.get_sites()
+        sites_data = await asyncio.to_thread(sharepoint.get_sites)
 
         # サイト一覧から 'webUrl' が target_url に一致するサイトを検索
         matching_site = get_site_info_by_url(sites_data, spo_url)
         site_name = matching_site["name"]
-        subfolder_list = sharepoint.get_subfolders_in_folder(site_name, folder_name)
+        subfolder_list = await asyncio.to_thread(sharepoint.get_subfolders_in_folder, site_name, folder_name)
         return JSONResponse(content={"subfolders": subfolder_list})
     
     except Exception as e:
@@ -138,76 +250,423 @@ async def resist_project(request: RegisterProjectRequest):
     """
     ユーザーの入力からプロジェクトを登録し，対応するインデックスを作成．
     """
+    is_new_project = False
     try:
         project_name = request.project_name
         spo_url = request.spo_url
         include_root_files = request.include_root_files
+        index_profile = request.index_profile
+        vector_profile = request.vector_profile
+        performance_profile = request.performance_profile
         spo_url = await check_spo_url(spo_url)
 
         #index, indexerの名前
         project_name = project_name.lower() #プロジェクト名を小文字に変換
-        index_name = f"{project_name}-index"
-        indexer_name = f"{project_name}-indexer"
+        # 再構築でインデックスを切り替えている場合は、レコードが指す稼働中のインデックスを対象にする
+        existing_project = await get_project_by_name(project_name)
+        index_name = get_project_index_name(existing_project) if existing_project else get_index_name(project_name)
     
-        # インデックス名を取得してリストに保管
-        indexs = []
-        indexs = list(index_client.list_index_names())
-
-        if index_name in indexs:
-            # 既存インデックスの場合はインデクサーのみ実行
-            logging.warning(f"インデックス '{index_name}' は既に存在します。インデクサーのみ実行します。")
-            indexer_client.run_indexer(indexer_name)  # インデクサーを実行
+        if shared_index_name:
+            # 共有インデックスはプロジェクト間で共通のため、インデクサーの有無で新規プロジェクトかどうかを判定する
+            is_new_project = f"{project_name}-indexer" not in list(indexer_client.get_indexer_names())
         else:
-            # 新規インデックスを作成
-            logging.info(f"新規インデックス '{index_name}' を作成します。")
-           
-            # 非同期でdatasource作成
-            await search_indexing.create_project_data_source(project_name, spo_url)
-
-            # indexの作成
-            index = search_indexing.create_project_index(project_name)
-            index_client.delete_index(index)
-            index_client.create_or_update_index(index) # 指定したインデックス名が既存の場合上書きする
-
-            # # Skillsetの作成
-            # skillset = create_project_skillset(project_name, spo_url)
-            # indexer_client.create_or_update_skillset(skillset)
-
-            # 非同期でskillset作成
-            await search_indexing.create_project_skillset_layout(project_name)
-
-            # indexerの作成
-            if include_root_files == True:
-                indexer = search_indexing.create_project_indexer(project_name)
-            else:
-                indexer = search_indexing.create_project_folder_indexer(project_name)
-            
-            indexer_client.create_or_update_indexer(indexer)
-
-            # Cosmos DB にプロジェクトを保存
-            container.upsert_item({
-                "id": str(uuid.uuid4()),  # 一意の ID を生成
-                "project_name": project_name,
-                "spo_url": spo_url
-            }) 
+            # インデックス名を取得してリストに保管
+            indexs = []
+            indexs = list(index_client.list_index_names())
+            is_new_project = index_name not in indexs
+
+        if is_new_project:
+            logging.info(f"新規プロジェクト '{project_name}' のリソースを作成します (インデックス: '{index_name}')。")
+        else:
+            logging.warning(f"プロジェクト '{project_name}' のリソースは既に存在します。差分のみ反映します。")
+
+        # 現在の定義との差分を取り、必要なリソースのみ作成・更新する
+        # (datasource, index, skillset を並列に処理し、その後 indexer を処理)
+        actions = await search_indexing.reconcile_project_resources(
+            project_name, spo_url, include_root_files, index_profile, vector_profile,
+            performance_profile=performance_profile, index_name=index_name,
+        )
+        logging.info(f"リソースの反映結果: {actions}")
+
+        # Cosmos DB にプロジェクトを保存 (再登録時は既存のレコードを更新する)
+        project = existing_project or {
+            "id": str(uuid.uuid4()),  # 一意の ID を生成
+            "project_name": project_name,
+        }
+        project["spo_url"] = spo_url
+        if actions["index"] == "rebuild_required":
+            # 稼働中のインデックスは以前の設定のままのため、新しい設定は再構築 (POST /projects/{project_name}/rebuild) まで保留する
+            project["pending_index_profile"] = index_profile.model_dump()
+            project["pending_vector_profile"] = vector_profile.model_dump()
+        else:
+            project["index_profile"] = index_profile.model_dump()
+            project["vector_profile"] = vector_profile.model_dump()
+            project.pop("pending_index_profile", None)
+            project.pop("pending_vector_profile", None)
+        project["performance_profile"] = performance_profile.model_dump()
+        project["answer_route"] = request.answer_route
+        container.upsert_item(project)
+
+        # SharePoint の変更通知のサブスクリプションを作成する (GRAPH_NOTIFICATION_URL を設定した場合のみ)
+        try:
+            await change_notifications.ensure_subscription(project)
+        except Exception as e:
+            logging.error(f"変更通知のサブスクリプション作成エラー: {e}")
+
+        if not is_new_project and actions["indexer"] != "created":
+            # インデクサーは作成時にのみ自動実行されるため、既存の場合は明示的に実行する
+            # インデックスを再構築した場合は全ドキュメントを再処理する
+            await search_indexing.run_project_indexer(project_name, reset=actions["index"] == "rebuilt")
+
+        content = {"message": "プロジェクト登録とインデックス作成成功", "resources": actions}
+        if actions["index"] == "rebuild_required":
+            content["detail"] = f"インデックスの変更は保留されています. 反映するには POST /projects/{project_name}/rebuild で再構築してください"
+        if request.estimate:
+            # 見積もりに失敗しても登録は成功として返す
+            try:
+                site_id = await get_project_site_id(project)
+                files, truncated = await asyncio.to_thread(crawl_site_files, sharepoint, site_id)
+                content["estimate"] = estimate_indexing(
+                    files, performance_profile, baseline_docs_per_minute(project.get("indexing_history"))
+                )
+                content["estimate"]["truncated"] = truncated
+            except Exception as e:
+                logging.error(f"インデックス作成の見積もりエラー: {e}")
 
         logging.info("プロジェクト登録とインデックス作成に成功しました")
-        return JSONResponse(content={"message": "プロジェクト登録とインデックス作成成功"})
+        return JSONResponse(content=content)
     
     except ResourceExistsError:
         logging.warning(f"インデックス '{project_name}' は既に存在します")
         return JSONResponse(content={"message": f"プロジェクト '{project_name}' 登録済み"})
     except Exception as e:
         logging.error(f"プロジェクト登録エラー: {e}")
-        # 登録エラーが発生した場合には、プロジェクトに関する要素をすべて削除する
-        delete_project_resources(
-                project_name,
-                indexer_client,
-                index_client,
-                container
-            )
+        # 新規登録でエラーが発生した場合には、プロジェクトに関する要素をすべて削除する
+        # (既存プロジェクトの再登録時は、稼働中のインデックスを残す)
+        if is_new_project:
+            delete_project_resources(
+                    project_name,
+                    indexer_client,
+                    index_client,
+                    container
+                )
+            if shared_index_name:
+                try:
+                    await search_indexing.delete_project_documents(project_name)
+                except Exception as delete_error:
+                    logging.error(f"共有インデックスのチャンク削除エラー: {delete_error}")
         raise HTTPException(status_code=500, detail="プロジェクト登録中にエラーが発生しました")
 
+async def get_project_site_id(project: dict) -> str:
+    """
+    プロジェクトの SPO URL に対応するサイトの ID を返す.
+    """
+    matching_site = get_site_info_by_url(await asyncio.to_thread(sharepoint.get_sites), project["spo_url"])
+    if matching_site is None:
+        raise HTTPException(status_code=404, detail=f"サイト '{project['spo_url']}' が見つかりませんでした")
+    return matching_site["id"]
+
+@app.post("/projects/{project_name}/push_index", status_code=202)
+async def push_index(project_name: str, background_tasks: BackgroundTasks, request: PushIndexRequest = PushIndexRequest()):
+    """
+    SharePoint のファイルを直接読み込み、チャンク分割・埋め込みを行ってインデックスにアップロードする (push 型).
+    処理はバックグラウンドで実行し、進捗は GET /projects/{project_name}/push_index で確認する.
+    """
+    project_name = project_name.lower()
+    running = push_runs.get(project_name)
+    if running is not None and running.status == "running":
+        raise HTTPException(status_code=409, detail=f"プロジェクト '{project_name}' のインデックス作成は実行中です")
+
+    project = await get_project_by_name(project_name)
+    if project is None:
+        raise HTTPException(status_code=404, detail=f"プロジェクト '{project_name}' が見つかりませんでした")
+
+    try:
+        site_id = await get_project_site_id(project)
+        index_profile = IndexStorageProfile(**project.get("index_profile", {}))
+        pipeline = PushIndexingPipeline(
+            project_name,
+            site_id,
+            sharepoint,
+            search_indexing,
+            dedupe_text_fields=index_profile.dedupe_text_fields,
+            index_name=get_project_index_name(project),
+            **request.model_dump(),
+        )
+        push_runs[project_name] = pipeline
+        background_tasks.add_task(pipeline.run)
+        logging.info(f"プロジェクト '{project_name}' の push 型インデックス作成を開始しました")
+        return JSONResponse(status_code=202, content=pipeline.report())
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"push 型インデックス作成の開始エラー: {e}")
+        raise HTTPException(status_code=500, detail="インデックス作成の開始中にエラーが発生しました")
+
+@app.get("/projects/{project_name}/push_index")
+async def get_push_index_status(project_name: str):
+    """
+    push 型インデックス作成の進捗 (ステージごとの処理件数・スループット) を返す.
+    """
+    pipeline = push_runs.get(project_name.lower())
+    if pipeline is None:
+        raise HTTPException(status_code=404, detail=f"プロジェクト '{project_name}' のインデックス作成は実行されていません")
+    return JSONResponse(content=pipeline.report())
+
+@app.post("/projects/{project_name}/reindex")
+async def reindex_documents(project_name: str, request: ReindexRequest):
+    """
+    指定したファイルのみを再インデックスし、ファイルごとの結果を返す.
+    reset: インデックスからファイルのキー (parent_id) を特定し、resetdocs で再処理させたうえでインデクサーを実行する.
+    push: SharePoint からファイルを取得し、push 型パイプラインで直接インデックスに登録する (古いチャンクは削除する).
+    インデクサーの parent_id を引き継ぐため、インデックスに未登録のファイルはインデクサーの実行に任せる (deferred).
+    document_ids はどちらのモードでもインデックスの documentId を指定する.
+    """
+    project_name = project_name.lower()
+    if not request.document_paths and not request.document_ids:
+        raise HTTPException(status_code=400, detail="document_paths または document_ids を指定してください")
+    project = await get_project_by_name(project_name)
+    if project is None:
+        raise HTTPException(status_code=404, detail=f"プロジェクト '{project_name}' が見つかりませんでした")
+
+    index_name = get_project_index_name(project)
+    try:
+        if request.mode == "reset":
+            found = {}
+            for field, values in (("documentId", request.document_ids), ("documentPath", request.document_paths)):
+                if values:
+                    found.update({(field, value): document for value, document in
+                                  (await search_indexing.find_indexed_documents(project_name, field, values, index_name)).items()})
+            # URL で指定された場合は documentUrl で再検索する
+            urls = [value for (field, value), document in found.items() if document is None and value.startswith("http")]
+            if urls:
+                found.update({("documentPath", value): document for value, document in
+                              (await search_indexing.find_indexed_documents(project_name, "documentUrl", urls, index_name)).items()})
+
+            document_keys = sorted({document["parent_id"] for document in found.values() if document})
+            indexer_run = "skipped"
+            if document_keys:
+                await search_indexing.reset_project_documents(project_name, document_keys)
+                try:
+                    await search_indexing.run_project_indexer(project_name)
+                    indexer_run = "started"
+                except HTTPException as e:
+                    if e.status_code != 409:
+                        raise
+                    # 実行中の場合、リセットしたドキュメントは次回の実行で処理される
+                    indexer_run = "already_running"
+
+            results = [
+                {"input": value, "status": "reset", "document_key": document["parent_id"], "documentPath": document.get("documentPath")}
+                if document else
+                {"input": value, "status": "not_found", "detail": "インデックスに登録されていません (新しいファイルは mode=push を使用してください)"}
+                for (_, value), document in found.items()
+            ]
+            return JSONResponse(content={"mode": "reset", "indexer_run": indexer_run, "documents": results})
+
+        # push: SharePoint からファイルを取得して直接登録する
+        # documentId はインデックスの値のため、登録済みのチャンクの documentPath からファイルを特定する
+        site_id = await get_project_site_id(project)
+        indexed = await search_indexing.find_indexed_documents(project_name, "documentId", request.document_ids, index_name) if request.document_ids else {}
+        inputs = [(value, (indexed.get(value) or {}).get("documentPath")) for value in request.document_ids]
+        inputs += [(value, value) for value in request.document_paths]
+        items = await asyncio.gather(*[
+            asyncio.to_thread(sharepoint.get_drive_item, site_id, None, to_drive_relative_path(path)) if path else asyncio.sleep(0)
+            for _, path in inputs
+        ])
+        resolved = [item for item in items if item and "file" in item]
+
+        index_profile = IndexStorageProfile(**project.get("index_profile", {}))
+        pipeline = PushIndexingPipeline(
+            project_name, site_id, sharepoint, search_indexing, dedupe_text_fields=index_profile.dedupe_text_fields,
+            index_name=index_name, indexer_managed=True,
+        )
+        report = await pipeline.run(items=resolved)
+        removed_chunks = await pipeline.remove_stale_chunks([item["id"] for item in resolved])
+        indexer_run = "skipped"
+        if pipeline.deferred:
+            try:
+                await search_indexing.run_project_indexer(project_name)
+                indexer_run = "started"
+            except HTTPException as e:
+                if e.status_code != 409:
+                    raise
+                indexer_run = "already_running"
+
+        results = [
+            {"input": value, "status": "not_found", "detail": "ファイルが見つかりませんでした (document_ids はインデックスに登録済みのファイルのみ指定できます)"}
+            if not item or "file" not in item else
+            {"input": value, "documentId": pipeline.identities.get(item["id"], {}).get("documentId"), **pipeline.document_status(item["id"])}
+            for (value, _), item in zip(inputs, items)
+        ]
+        return JSONResponse(content={
+            "mode": "push",
+            "indexer_run": indexer_run,
+            "documents": results,
+            "removed_chunks": removed_chunks,
+            "layout_cache": report["layout_cache"],
+            "embedding_cache": report["embedding_cache"],
+        })
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"再インデックスエラー: {e}")
+        raise HTTPException(status_code=500, detail="再インデックス中にエラーが発生しました")
+
+@app.post("/projects/{project_name}/rebuild", status_code=202)
+async def rebuild_index(project_name: str, request: RebuildIndexRequest = RebuildIndexRequest()):
+    """
+    稼働中のインデックスを残したまま新しいバージョンのインデックス ({project}-index-vN) を作成・投入する.
+    投入の完了後にドキュメント数とサンプルクエリで検証し、問題がなければ検索対象を切り替える.
+    進捗は GET /projects/{project_name}/rebuild で確認する (タイマーでも定期的に進める).
+    """
+    project = await get_project_by_name(project_name.lower())
+    if project is None:
+        raise HTTPException(status_code=404, detail=f"プロジェクト '{project_name}' が見つかりませんでした")
+    try:
+        rebuild = await index_rebuilder.start(
+            project, request.mode, request.index_profile, request.vector_profile, request.sample_query, request.min_count_ratio
+        )
+        return JSONResponse(status_code=202, content={"active_index": get_project_index_name(project), "rebuild": rebuild})
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"インデックスの再構築の開始エラー: {e}")
+        raise HTTPException(status_code=500, detail="インデックスの再構築の開始中にエラーが発生しました")
+
+@app.get("/projects/{project_name}/rebuild")
+async def get_rebuild_status(project_name: str):
+    """
+    インデックスの再構築の状況を返す. 投入が完了していれば検証・切り替えまで進める.
+    """
+    project = await get_project_by_name(project_name.lower())
+    if project is None:
+        raise HTTPException(status_code=404, detail=f"プロジェクト '{project_name}' が見つかりませんでした")
+    rebuild = await index_rebuilder.advance(project)
+    return JSONResponse(content={
+        "active_index": get_project_index_name(project),
+        "previous_indexes": project.get("previous_indexes", []),
+        "rebuild": rebuild,
+    })
+
+@app.get("/projects/{project_name}/indexing")
+async def get_indexing_status(project_name: str):
+    """
+    インデクサーの実行状況 (実行中の処理件数・docs/min) と実行履歴を返す.
+    スループットが低下した実行・エラーが閾値を超えた実行は flagged_runs に含まれる.
+    """
+    project = await get_project_by_name(project_name)
+    if project is None:
+        raise HTTPException(status_code=404, detail=f"プロジェクト '{project_name}' が見つかりませんでした")
+    try:
+        return JSONResponse(content=await indexer_monitor.poll_project(project))
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"インデクサーの状態取得エラー: {e}")
+        raise HTTPException(status_code=500, detail="インデクサーの状態の取得中にエラーが発生しました")
+
+@app.post("/notifications/sharepoint")
+async def sharepoint_notifications(request: Request):
+    """
+    SharePoint (Graph) の変更通知を受け取るエンドポイント.
+    サブスクリプション作成時の検証要求には validationToken をそのまま返す.
+    通知は一定時間まとめてから、変更されたファイルのみを再インデックスする (応答は待たずに 202 を返す).
+    """
+    validation_token = request.query_params.get("validationToken")
+    if validation_token is not None:
+        return PlainTextResponse(content=validation_token, status_code=200)
+
+    try:
+        payload = await request.json()
+        accepted = await change_notifications.handle_notifications(payload)
+        return JSONResponse(status_code=202, content={"accepted": accepted})
+    except Exception as e:
+        # Graph は失敗した通知を再送するため、ここではログのみ残す
+        logging.error(f"変更通知の処理エラー: {e}")
+        return JSONResponse(status_code=202, content={"accepted": 0})
+
+@app.get("/notifications/sharepoint/status")
+async def sharepoint_notifications_status():
+    """
+    プロジェクトごとの受信した通知数と、まとめて処理した回数・直近の結果を返す.
+    """
+    return JSONResponse(content=change_notifications.stats)
+
+@app.get("/metrics/answers")
+async def get_answer_metrics():
+    """
+    /answer・/answer_stream の重複排除 (同じ質問の処理を共有した件数) と、ルート (fast / full) ごとの件数・判定理由・レイテンシを返す.
+    """
+    return JSONResponse(content={
+        "answer": answer_flights.stats(),
+        "answer_stream": answer_stream_flights.stats(),
+        "routes": route_metrics.stats(),
+        "conversations": conversations.stats(),
+    })
+
+@app.get("/metrics/upstreams")
+async def get_upstream_metrics():
+    """
+    外部サービス (OpenAI・AI Search・Graph・Cosmos DB) ごとの同時実行数の上限・再試行・スロットリング・レイテンシを返す.
+    """
+    return JSONResponse(content=upstream_stats())
+
+@app.get("/metrics/openai_pools")
+async def get_openai_pool_metrics():
+    """
+    Azure OpenAI のプールごとのフェイルオーバー・ヘッジの回数と、エンドポイントごとの実行中の件数・残りクォータを返す.
+    """
+    return JSONResponse(content=pool_stats())
+
+def verify_skill_key(http_request: Request):
+    """
+    カスタムスキルのエンドポイントは関数キーなしで公開されるため、WebApiSkill が httpHeaders で送る SKILL_API_KEY を検証する.
+    SKILL_API_KEY が未設定の場合は常に拒否する.
+    """
+    if not skill_api_key:
+        raise HTTPException(status_code=503, detail="SKILL_API_KEY が設定されていないため、カスタムスキルは使用できません")
+    if not hmac.compare_digest(http_request.headers.get(SKILL_KEY_HEADER, ""), skill_api_key):
+        raise HTTPException(status_code=401, detail="カスタムスキルのキーが正しくありません")
+
+@app.post("/skills/embeddings")
+async def embedding_skill(request: SkillRequest, http_request: Request):
+    """
+    スキルセットのカスタムスキル (WebApiSkill) 用のエンドポイント.
+    チャンク本文のハッシュで埋め込みキャッシュを参照し、新しいチャンクのみ埋め込み API でベクトル化する.
+    """
+    verify_skill_key(http_request)
+    embedder = CachedEmbedder(get_embedding_model(), get_embedding_store())
+    try:
+        texts = [record.data.get("text") or "" for record in request.values]
+        vectors = await embedder.aembed_documents(texts)
+    except Exception as e:
+        logging.error(f"埋め込みスキルエラー: {e}")
+        return JSONResponse(content={"values": [
+            {"recordId": record.recordId, "data": {}, "errors": [{"message": str(e)}], "warnings": []}
+            for record in request.values
+        ]})
+
+    logging.info(f"埋め込みスキル: {embedder.stats()}")
+    return JSONResponse(content={"values": [
+        {"recordId": record.recordId, "data": {"embedding": vector}, "errors": [], "warnings": []}
+        for record, vector in zip(request.values, vectors)
+    ]})
+
+@app.post("/skills/path_prefixes")
+async def path_prefix_skill(request: SkillRequest, http_request: Request):
+    """
+    スキルセットのカスタムスキル (WebApiSkill) 用のエンドポイント.
+    metadata_spo_item_path から親フォルダのパスの接頭辞 (["A", "A/B"]) を計算し、folderPath として返す.
+    """
+    verify_skill_key(http_request)
+    return JSONResponse(content={"values": [
+        {"recordId": record.recordId, "data": {"folderPath": folder_path_prefixes(record.data.get("path") or "")}, "errors": [], "warnings": []}
+        for record in request.values
+    ]})
+
 @app.get("/projects")
 async def get_projects():
     """
@@ -228,40 +687,212 @@ async def delete_item_by_project_name(request:DeleteProjectRequest):
     """
     try:
         project_name = request.project_name
+        project = await get_project_by_name(project_name)
+        if project is not None:
+            await change_notifications.delete_subscription(project)
+            await index_rebuilder.delete_versions(project)
+            folder_listing.invalidate(project["project_name"])
         delete_project_resources(
                 project_name,
                 indexer_client,
                 index_client,
                 container
             )
+        # 共有インデックスの場合は、インデクサーの削除後にプロジェクトのチャンクをまとめて削除する
+        if shared_index_name:
+            await search_indexing.delete_project_documents(project_name.lower())
 
     except exceptions.CosmosHttpResponseError as e:
         logging.error(f"プロジェクト削除エラー: {e}")
     except Exception as ex:
         print(f"プロジェクト削除中に予期せぬエラーが発生しました: {ex}")
 
+# 同じプロジェクト・フィルター・質問の /answer が同時に届いた場合は、1 回だけ処理して結果を共有する
+answer_flights = SingleFlight("answer")
+answer_stream_flights = SingleFlight("answer_stream")
+
+def answer_flight_key(request: AnswerRequest) -> tuple:
+    return answer_key(request.project_name, request.user_question, request.folder_name, request.subfolder_name, request.folder_path, request.conversation_id)
+
+def conversation_scope(request: AnswerRequest) -> list:
+    """
+    会話の検索範囲 (プロジェクト・フォルダの絞り込み). 変わった場合は前回の検索結果を再利用しない.
+    """
+    return [request.project_name.lower(), request.folder_name, request.subfolder_name, request.folder_path]
+
+def answer_error(e: Exception) -> HTTPException:
+    """
+    回答生成の例外を、クライアントに返すステータスコードに変換する.
+    """
+    # 検索側 (埋め込み・AI Search) のサーキットが開いている場合や、再試行してもスロットリングが解消しない場合は、
+    # クライアントが時間をおいて再試行できるよう 503 を返す
+    # (SDK が包んだ例外は、元の CircuitOpenError / DeadlineExceeded で判定する)
+    e = unwrap_error(e)
+    if isinstance(e, DeadlineExceeded):
+        return HTTPException(status_code=504, detail=f"処理時間の上限までに回答を生成できませんでした ({e.stage})")
+    if isinstance(e, CircuitOpenError):
+        return HTTPException(status_code=503, detail="検索サービスを一時的に利用できません", headers={"Retry-After": str(max(1, int(e.retry_after)))})
+    if is_throttled_error(e):
+        return HTTPException(status_code=503, detail="混雑しているため回答を生成できませんでした", headers={"Retry-After": "10"})
+    return HTTPException(status_code=500, detail="回答の生成に失敗")
+
+async def get_answer_project(project_name: str) -> dict:
+    """
+    プロジェクトのインデックス設定 (ベクトル圧縮時のオーバーサンプリング)・稼働中のインデックス・回答のルートの指定を取得する.
+    """
+    project = await get_project_by_name(project_name) or {}
+    return {
+        "oversampling": IndexStorageProfile(**project.get("index_profile", {})).query_oversampling,
+        "index_name": get_project_index_name(project) if project else None,
+        "route_mode": project.get("answer_route", "auto"),
+    }
+
+async def get_answer_settings(request: AnswerRequest) -> dict:
+    if request.project_name.lower() == "project_all":
+        return {"oversampling": None, "index_name": None, "route_mode": "auto"}
+    return await get_answer_project(request.project_name.lower())
+
+async def retrieve_for_request(request: AnswerRequest, settings: dict, query: str = None, user_vector: list[float] = None):
+    """
+    リクエストのプロジェクト・フィルターで検索する. query・user_vector は会話の履歴を含めた検索クエリ (未指定の場合は質問).
+    """
+    project_name = request.project_name.lower()
+    query = query or request.user_question
+    if project_name == "project_all":
+        return await retrieve_all_documents(query, container, user_vector=user_vector)
+    return await retrieve_documents(
+        query, project_name, request.folder_name, request.subfolder_name, settings["oversampling"],
+        index_name=settings["index_name"],
+        folder_path=request.folder_path,
+        user_vector=user_vector,
+    )
+
+async def prepare_conversation_turn(request: AnswerRequest, settings: dict) -> dict:
+    return await prepare_turn(
+        conversations, request.conversation_id, conversation_scope(request), request.user_question,
+        lambda query, user_vector: retrieve_for_request(request, settings, query, user_vector),
+    )
+
+async def compute_conversation_answer(request: AnswerRequest) -> dict:
+    """
+    会話の履歴 (要約と直近のやり取り) を踏まえて回答し、やり取りを会話に追加する.
+    前回の検索クエリと近い追加の質問は、検索せずに前回のチャンクで回答する. 回答の conversation にこのやり取りのレイテンシ・トークン数を含める.
+    """
+    settings = await get_answer_settings(request)
+    async with conversations.lock(request.conversation_id):
+        turn = await prepare_conversation_turn(request, settings)
+        started = time.monotonic()
+        answer = await answer_or_degrade(request.user_question, turn["documents"], route_mode=settings["route_mode"], history=turn["history"])
+        answer["conversation"] = await record_turn(conversations, turn, request.user_question, answer, (time.monotonic() - started) * 1000)
+    return answer
+
+def check_folder_path(request: AnswerRequest):
+    """
+    インデクサーで作成したチャンクの folderPath は PATH_PREFIX_SKILL_URI を設定した場合のみ登録されるため、
+    未設定の場合に folder_path を指定すると常に 0 件になる. その場合は 400 を返す.
+    """
+    if request.folder_path and not search_indexing.path_prefix_skill_uri:
+        raise HTTPException(status_code=400, detail="folder_path を使用するには PATH_PREFIX_SKILL_URI を設定してください")
+
+async def compute_answer(request: AnswerRequest) -> dict:
+    if request.conversation_id:
+        return await compute_conversation_answer(request)
+    project_name = request.project_name.lower() #プロジェクト名を小文字に変換
+
+    # プロジェクトが選択されていないときはすべてのプロジェクトを検索して回答する．
+    if project_name == "project_all":
+        return await generate_answer_all(request.user_question, container)
+    settings = await get_answer_project(project_name)
+    return await generate_answer(
+        request.user_question, project_name, request.folder_name, request.subfolder_name, settings["oversampling"],
+        index_name=settings["index_name"],
+        folder_path=request.folder_path,
+        route_mode=settings["route_mode"],
+    )
+
 @app.post("/answer")
-async def answer(request: AnswerRequest):
+async def answer(request: AnswerRequest, http_request: Request, background_tasks: BackgroundTasks):
     """
     質問に対する応答を生成し、フロントエンドに返す。
+    処理時間の上限は X-Request-Timeout ヘッダー (秒, 未指定の場合は REQUEST_DEADLINE_SECONDS) で決め、各ステージはその残り時間内で実行する.
+    conversation_id を指定した場合は、応答を返した後に古いやり取りを要約にまとめる.
     """
+    check_folder_path(request)
+    if request.conversation_id:
+        background_tasks.add_task(compact_conversation, conversations, request.conversation_id)
+    with deadline_scope(deadline_from_headers(http_request.headers)):
+        try:
+            # 同じ質問の処理が実行中であればその結果を待つ (待つ時間もこのリクエストの期限内に収める)
+            answer = await run_stage("answer", answer_flights.do(answer_flight_key(request), lambda: compute_answer(request)))
+            logging.info("質問への回答に成功しました")       
+            return JSONResponse(answer)
+
+        except Exception as e:
+            logging.error(f"回答生成エラー: {e}")
+            raise answer_error(e)
+
+async def stream_answer_events(request: AnswerRequest):
+    """
+    /answer_stream のイベントを生成する. 検索に失敗した場合は error イベントを返して終了する.
+    conversation_id を指定した場合は、done の前にこのやり取りのレポート (conversation イベント) を返す.
+    """
+    if not request.conversation_id:
+        async for event in stream_answer_turn(request):
+            yield event
+        return
+    async with conversations.lock(request.conversation_id):
+        async for event in stream_answer_turn(request):
+            yield event
+
+async def stream_answer_turn(request: AnswerRequest):
+    turn, history = None, None
     try:
-        user_question = request.user_question
-        project_name = request.project_name
-        folder_name = request.folder_name
-        subfolder_name = request.subfolder_name
-        project_name = project_name.lower() #プロジェクト名を小文字に変換
-
-        # プロジェクトが選択されていないときはすべてのプロジェクトを検索して回答する．
-        if project_name == "project_all":
-            answer = generate_answer_all(user_question, container)
+        settings = await get_answer_settings(request)
+        if request.conversation_id:
+            turn = await prepare_conversation_turn(request, settings)
+            retrieved_docs, history = turn["documents"], turn["history"]
         else:
-            answer = generate_answer(user_question, project_name, folder_name, subfolder_name)
-        logging.info("質問への回答に成功しました")       
-        return JSONResponse(answer)
-    
+            retrieved_docs = await retrieve_for_request(request, settings)
     except Exception as e:
         logging.error(f"回答生成エラー: {e}")
-        raise HTTPException(status_code=500, detail="回答の生成に失敗")
+        error = answer_error(e)
+        yield {"type": "error", "status_code": error.status_code, "detail": error.detail}
+        return
+    started = time.monotonic()
+    tokens, degraded = [], None
+    async for event in stream_answer(request.user_question, retrieved_docs, route_mode=settings["route_mode"], history=history):
+        if event["type"] == "token":
+            tokens.append(event["content"])
+        elif event["type"] == "degraded":
+            degraded = event
+        elif event["type"] == "done" and turn is not None:
+            # ストリーミングの応答にはトークン数が含まれないため usage は None になる
+            answer = degraded or {"answer": "".join(tokens)}
+            report = await record_turn(conversations, turn, request.user_question, answer, (time.monotonic() - started) * 1000)
+            yield {"type": "conversation", **report}
+        yield event
+
+@app.post("/answer_stream")
+async def answer_stream(request: AnswerRequest, http_request: Request, background_tasks: BackgroundTasks):
+    """
+    /answer のストリーミング版. generate_answer.stream_answer のイベントを 1 行 1 JSON (NDJSON) で返す.
+    同じ質問のストリームが実行中の場合は新たに生成せず、その出力を先頭から受け取る.
+    """
+    check_folder_path(request)
+    if request.conversation_id:
+        background_tasks.add_task(compact_conversation, conversations, request.conversation_id)
+    seconds = deadline_from_headers(http_request.headers)
+
+    async def lines():
+        # ストリームは応答を返した後に読み出されるため、期限もここで設定する
+        with deadline_scope(seconds):
+            try:
+                async for event in answer_stream_flights.stream(answer_flight_key(request), lambda: stream_answer_events(request)):
+                    yield json.dumps(event, ensure_ascii=False) + "\n"
+            except DeadlineExceeded:
+                # 共有するストリームより先にこのリクエストの期限が切れた場合
+                yield json.dumps({"type": "error", "reason": "deadline"}, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
 
 
@@ -1,336 +1,513 @@
 import os
+import time
+import asyncio
 import logging
-import requests
-import ipdb
+from collections.abc import AsyncIterator
+from functools import cache
 
 # LangChain / OpenAI 関連
+import httpx
 import openai
 from langchain.schema import Document
 from langchain_openai import AzureChatOpenAI, AzureOpenAIEmbeddings
-from langchain_community.vectorstores import AzureSearch
-from langchain import hub
+from langchain.prompts import ChatPromptTemplate
 from langchain.schema import StrOutputParser
-from langchain.schema.runnable import RunnablePassthrough, RunnableMap
+from langchain.schema.runnable import RunnableMap
 from operator import itemgetter
 
+from retrievers import SearchFilter, get_retriever
+from indexing_service import get_index_name, get_project_index_name, shared_index_name
+from resilience import CircuitOpenError, get_upstream, unwrap_error
+from openai_pool import openai_async_transport, openai_transport, upstream_unavailable
+from deadlines import Deadline, DeadlineExceeded, remaining_seconds, run_stage
+from routing import choose_route, route_deployment, route_upstream, route_metrics
+from chunk_expansion import chunk_expansion_window, expand_documents
+
 # 環境変数等の取得
 openai_embedding_key = os.getenv("AZURE_OPENAI_EMBEDDING_API_KEY")
 openai_embedding_endpoint = os.getenv("AZURE_OPENAI_EMBEDDING_ENDPOINT")
-azure_search_endpoint = os.getenv("AZURE_SEARCH_ENDPOINT") 
-azure_search_key = os.getenv("AZURE_SEARCH_ADMIN_KEY")
 openai.api_key = os.getenv("AZURE_OPENAI_API_KEY")
 openai.azure_endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
-service_name = "srch-rag-dev-001"
-
-
-def vector_search_with_filter(
-    service_name: str, 
-    index_name: str, 
-    api_key: str, 
-    user_query: str, 
-    filter_condition: str, 
-    vector_filter_mode: str = "preFilter",  # preFilter設定
-    top: int = 3
-):
+# LLM の応答を待つ上限 (秒). 超えた場合は検索結果の抜粋を返す (degraded)
+answer_llm_timeout = float(os.getenv("ANSWER_LLM_TIMEOUT", "20"))
+# リクエストの残り時間がこれより少ない場合は LLM を呼び出さずに検索結果の抜粋を返す (秒)
+answer_min_llm_seconds = float(os.getenv("ANSWER_MIN_LLM_SECONDS", "2"))
+# 検索のステージごとのタイムアウトの上限 (秒). リクエストの残り時間の方が短い場合はそちらを使用する
+embedding_stage_timeout = float(os.getenv("EMBEDDING_STAGE_TIMEOUT", "10"))
+search_stage_timeout = float(os.getenv("SEARCH_STAGE_TIMEOUT", "10"))
+# degraded の回答で 1 チャンクあたりに返す抜粋の文字数
+degraded_snippet_chars = int(os.getenv("DEGRADED_SNIPPET_CHARS", "400"))
+
+# RAG 用のプロンプト (LangChain Hub の "rlm/rag-prompt" と同じ内容).
+# hub.pull はタイムアウトのない同期のネットワーク呼び出しでイベントループを止めるため、リクエストごとに取得せず埋め込む
+RAG_PROMPT = ChatPromptTemplate.from_messages([(
+    "human",
+    "You are an assistant for question-answering tasks. Use the following pieces of retrieved context to answer the question. "
+    "If you don't know the answer, just say that you don't know. Use three sentences maximum and keep the answer concise.\n"
+    "Question: {question} \nContext: {context} \nAnswer:",
+)])
+
+
+@cache
+def get_embedding_model() -> AzureOpenAIEmbeddings:
     """
-    REST API を直接呼び出して、ベクトル検索 + フィルターを実行し、
-    ドキュメント (LangChain の Document) のリストを返す。
+    クエリのベクトル化に使用するモデル (HTTP クライアントを再利用するため 1 度だけ生成する)
+    再試行は SDK ではなく resilience のトランスポートで行う (上流 "openai-embeddings")
+    OPENAI_POOL_CONFIG にプールがある場合は、そのエンドポイントに振り分ける
     """
-
-    # 1. ユーザークエリをベクトル化 
-    embedding_model = AzureOpenAIEmbeddings(
+    return AzureOpenAIEmbeddings(
         azure_deployment="text-embedding-ada-002",
         openai_api_version="2023-05-15",
         openai_api_key=openai_embedding_key,
         azure_endpoint=openai_embedding_endpoint,
+        max_retries=0,
+        http_client=httpx.Client(transport=openai_transport("openai-embeddings")),
+        http_async_client=httpx.AsyncClient(transport=openai_async_transport("openai-embeddings")),
     )
-    user_vector = embedding_model.embed_query(user_query)
-
-    #  2. REST API 用 JSON ボディを構築 
-    body = {
-        "select": "folderName, content, documentUrl, documentName, last_modified", # 取得するフィールド名を指定する
-        "filter": filter_condition,        # OData フィルター 
-        "vectorFilterMode": vector_filter_mode,
-        "vectorQueries": [
-            {
-                "kind": "vector",
-                "fields": "content_vector",  # インデックスで定義したベクトルフィールド
-                "vector": user_vector,
-                "k": top
-            }
-        ]
-    }
 
-    url = f"https://{service_name}.search.windows.net/indexes/{index_name}/docs/search?api-version=2024-07-01"
-    headers = {
-        "Content-Type": "application/json",
-        "api-key": api_key
-    }
 
-    # 3. リクエスト送信 
-    response = requests.post(url, headers=headers, json=body)
-    response.raise_for_status()
-
-    # 4. 結果をパースして LangChain の Document に変換 
-    result_json = response.json()
-    docs = []
-    for item in result_json.get("value", []):
-        doc_content = item.get("content", "")
-        metadata = {
-            "documentUrl": item.get("documentUrl", ""),
-            "documentName": item.get("documentName", ""),
-            "last_modified": item.get("last_modified", ""),
-            "folderName": item.get("folderName", "")
+@cache
+def get_llm(route: str = "full") -> AzureChatOpenAI:
+    """
+    回答生成に使用する LLM (HTTP クライアントを再利用するため、ルートごとに 1 度だけ生成する)
+    route は routing.choose_route の結果 ("fast": ANSWER_FAST_DEPLOYMENT, "full": ANSWER_FULL_DEPLOYMENT)
+    再試行は SDK ではなく resilience のトランスポートで行う (上流 "openai-chat" / "openai-chat-fast")
+    OPENAI_POOL_CONFIG にプールがある場合は、そのエンドポイントに振り分ける (デプロイメント名もプールの設定で置き換える)
+    """
+    upstream = route_upstream(route)
+    return AzureChatOpenAI(
+        openai_api_key=openai.api_key,
+        azure_endpoint=openai.azure_endpoint,
+        openai_api_version="2024-08-01-preview",
+        azure_deployment=route_deployment(route),
+        temperature=0,
+        max_retries=0,
+        http_client=httpx.Client(transport=openai_transport(upstream)),
+        http_async_client=httpx.AsyncClient(transport=openai_async_transport(upstream)),
+    )
+
+
+async def embed_query(user_query: str) -> list[float]:
+    """
+    検索クエリをベクトル化する (リクエストの残り時間と EMBEDDING_STAGE_TIMEOUT の短い方で打ち切る)
+    """
+    return await run_stage("embedding", get_embedding_model().aembed_query(user_query), cap=embedding_stage_timeout)
+
+
+async def vector_search_with_filter(
+    index_name: str,
+    user_query: str,
+    search_filter: SearchFilter,
+    vector_filter_mode: str = "preFilter",  # preFilter設定
+    top: int = 3,
+    oversampling: float = None,  # 圧縮ベクトルを使用するインデックスでのオーバーサンプリング倍率
+    user_vector: list[float] = None,  # ベクトル化済みのクエリ (指定した場合は user_query をベクトル化しない)
+):
+    """
+    ユーザークエリをベクトル化し、インデックスに対応する検索バックエンド (Azure AI Search またはローカルインデックス) で
+    ベクトル検索 + フィルターを実行して、ドキュメント (LangChain の Document) のリストを返す。
+    """
+    # 1. ユーザークエリをベクトル化
+    if user_vector is None:
+        user_vector = await embed_query(user_query)
+
+    # 2. バックエンドで検索 (呼び出し元はどのバックエンドが使われたかを意識しない)
+    retriever = get_retriever(index_name)
+    docs = await run_stage("search", retriever.search(
+        index_name,
+        user_vector,
+        search_filter,
+        top=top,
+        vector_filter_mode=vector_filter_mode,
+        oversampling=oversampling,
+    ), cap=search_stage_timeout)
+    logging.info(f"retriever '{retriever.name}' で '{index_name}' を検索しました: {len(docs)} 件")
+    return await expand_context(retriever, index_name, docs)
+
+
+async def expand_context(retriever, index_name: str, docs: list[Document]) -> list[Document]:
+    """
+    CHUNK_EXPANSION_WINDOW を設定した場合、ヒットしたチャンクを前後のチャンクを含むパッセージに展開する.
+    展開に失敗・時間内に終わらない場合は、ヒットしたチャンクのまま回答する
+    """
+    if chunk_expansion_window <= 0 or not docs:
+        return docs
+    try:
+        return await run_stage("expansion", expand_documents(retriever, index_name, docs), cap=search_stage_timeout)
+    except Exception as e:
+        logging.warning(f"前後のチャンクの展開に失敗したため、ヒットしたチャンクのみで回答します: {e}")
+        return docs
+
+
+# ドキュメント本文を結合
+def format_docs(docs):
+    return "\n\n".join(
+        doc.page_content if isinstance(doc, Document) else doc.get("content", "")
+        for doc in docs
+    )
+
+# メタデータ抽出
+def filter_metadata(docs):
+    return [
+        {
+            "documentUrl": doc.metadata.get("documentUrl"),
+            "documentName": doc.metadata.get("documentName"),
+            "last_modified": doc.metadata.get("last_modified"),
         }
-        docs.append(Document(page_content=doc_content, metadata=metadata))
+        for doc in docs
+    ]
 
-    return docs
 
-def build_filter_condition(folder_name: str, subfolder_name: str) -> str | None:
+def with_history(user_question: str, history: str = None) -> str:
     """
-    folder_name と subfolder_name の組み合わせに応じて、
-    OData フィルタ文字列 (folderName, subfolderName) を生成する。
-    folder_name = "FOLDER_ALL" フィルタリングなし (None)
-    それ以外の場合:
-        subfolder_name = "SUBFOLDER_ALL" フォルダ名のみフィルタリング："folderName eq 'xxx'"
-        subfolder_name != "SUBFOLDER_ALL" フォルダ名とサブフォルダ名でフィルタリング："folderName eq 'xxx' and subfolderName eq 'yyy'"
+    会話の履歴 (要約と直近のやり取り) がある場合は、質問の前に付けて LLM に渡す
     """
-    # folder_name が "FOLDER_ALL" の場合 
-    if folder_name == "FOLDER_ALL":
+    if not history:
+        return user_question
+    return f"これまでの会話:\n{history}\n\n上の会話を踏まえて、次の質問に答えてください。\n質問: {user_question}"
+
+
+def token_usage(message) -> dict | None:
+    """
+    LLM の応答 (AIMessage) のトークン数 (入力・出力・合計)
+    """
+    usage = getattr(message, "usage_metadata", None)
+    if not usage:
         return None
+    return {"input_tokens": usage["input_tokens"], "output_tokens": usage["output_tokens"], "total_tokens": usage["total_tokens"]}
 
-    # folder_name が FOLDER_ALL 以外の場合
-    if subfolder_name == "SUBFOLDER_ALL":
-        # folderName のみフィルタリング
-        return f"folderName eq '{folder_name}'"
-    else:
-        # folderName と subfolderName の両方でフィルタリング
-        return f"folderName eq '{folder_name}' and subfolderName eq '{subfolder_name}'"
 
-def generate_answer(user_question: str, project_name: str, folder_name: str=None, subfolder_name:str=None):
+def summarize_sources(documents_info: list[dict]) -> dict:
     """
-    指定したプロジェクトに対して、フォルダ名でのフィルタリング機能を追加したベクトル検索を実行し、ユーザーの質問に対する回答を生成する 
+    参照ドキュメントの情報を URL・名前・更新日時のリストにまとめる (連続して同じ URL のものは 1 件にする)
     """
-    try:
-        index_name = f"{project_name}-index"
-        # ipdb.set_trace()
-
-        # 条件に応じてフィルタリングを構成
-        filter_condition = build_filter_condition(folder_name, subfolder_name)
-        # vectorFilterModeを用いてベクトル検索にfolderName, subfolderNameでのフィルタリングを追加
-        retrieved_docs = vector_search_with_filter(
-            service_name=service_name,
-            index_name=index_name,
-            api_key=azure_search_key,
-            user_query=user_question,
-            filter_condition=filter_condition,
-            vector_filter_mode="preFilter",
-            top=3
-        )
+    documentUrl_list, documentName_list, last_modified_list = [], [], []
+
+    if documents_info:
+        # 最初の1件を追加
+        documentUrl_list.append(documents_info[0]["documentUrl"])
+        documentName_list.append(documents_info[0]["documentName"])
+        last_modified_list.append(documents_info[0]["last_modified"])
+
+        # 以降、URL が重複しなければ追加
+        for i in range(len(documents_info) - 1):
+            if documents_info[i]["documentUrl"] != documents_info[i+1]["documentUrl"]:
+                documentUrl_list.append(documents_info[i+1]["documentUrl"])
+                documentName_list.append(documents_info[i+1]["documentName"])
+                last_modified_list.append(documents_info[i+1]["last_modified"])
+
+    return {
+        "documentUrl": documentUrl_list,
+        "documentName": documentName_list,
+        "last_modified": last_modified_list,
+    }
 
-        logging.info(f"retrieved_docs: {retrieved_docs}")
 
-        # LLM の設定
-        llm = AzureChatOpenAI(
-            openai_api_key=openai.api_key,
-            azure_endpoint=openai.azure_endpoint,
-            openai_api_version="2024-08-01-preview",
-            azure_deployment="gpt-4o",
-            temperature=0,
+def extract_snippet(text: str, max_chars: int = None) -> str:
+    """
+    チャンクの先頭から max_chars 文字までを、できるだけ文の区切り (。/ 改行) で切って返す
+    """
+    max_chars = max_chars or degraded_snippet_chars
+    text = (text or "").strip()
+    if len(text) <= max_chars:
+        return text
+    snippet = text[:max_chars]
+    boundary = max(snippet.rfind("。"), snippet.rfind("\n"))
+    if boundary >= max_chars // 2:
+        snippet = snippet[:boundary + 1]
+    return snippet.rstrip() + "…"
+
+
+def build_degraded_answer(retrieved_docs: list[Document], reason: str) -> dict:
+    """
+    LLM を使用できない場合の回答. 検索上位のチャンクの抜粋と参照ドキュメントの情報を、degraded であることを明示して返す
+    """
+    snippets = [
+        {
+            "content": extract_snippet(doc.page_content),
+            "documentUrl": doc.metadata.get("documentUrl"),
+            "documentName": doc.metadata.get("documentName"),
+            "last_modified": doc.metadata.get("last_modified"),
+            "score": doc.metadata.get("@search.score"),
+        }
+        for doc in retrieved_docs
+    ]
+    if snippets:
+        answer = "現在回答を生成できないため、関連する資料の抜粋を表示します。\n\n" + "\n\n".join(
+            f"【{snippet['documentName']}】\n{snippet['content']}" for snippet in snippets
         )
+    else:
+        answer = "現在回答を生成できず、関連する資料も見つかりませんでした。"
+    return {
+        "answer": answer,
+        **summarize_sources(filter_metadata(retrieved_docs)),
+        "snippets": snippets,
+        "degraded": True,
+        "degraded_reason": reason,
+    }
+
+
+async def answer_or_degrade(user_question: str, retrieved_docs: list[Document], timeout: float = None, route_mode: str = "auto", history: str = None) -> dict:
+    """
+    質問の難しさに応じたデプロイメント (routing.choose_route, route_mode はプロジェクトごとの指定) で回答を生成し、
+    ルートごとの処理時間を記録する. 回答には使用したルート (route) を含める
+    history は会話の履歴 (ルーティングの判定には使用しない)
+    """
+    decision = choose_route(user_question, retrieved_docs, route_mode)
+    started = time.monotonic()
+    answer = await generate_with_fallback(user_question, retrieved_docs, decision["route"], timeout, history)
+    route_metrics.record(decision, time.monotonic() - started, degraded=answer.get("degraded", False))
+    answer["route"] = decision["route"]
+    return answer
 
-        # ドキュメント本文を結合
-        def format_docs(docs):
-            return "\n\n".join(
-                doc.page_content if isinstance(doc, Document) else doc.get("content", "")
-                for doc in docs
-            )
-
-        # メタデータ抽出
-        def filter_metadata(docs):
-            return [
-                {
-                    "documentUrl": doc.metadata.get("documentUrl"),
-                    "documentName": doc.metadata.get("documentName"),
-                    "last_modified": doc.metadata.get("last_modified"),
-                }
-                for doc in docs
-            ]
-
-        # RAG 用のプロンプトを取得
-        prompt = hub.pull("rlm/rag-prompt")
-        ipdb.set_trace()
-
-        # RAG チェーン構築
-        rag_chain_from_docs = (
-            {
-                "context": lambda input: format_docs(input["documents"]),
-                "question": itemgetter("question"),
-            }
-            | prompt
-            | llm
-            | StrOutputParser()
-        )
 
-        # RAG チェーン実行
-        rag_chain_with_source = RunnableMap(
-            {
-                "documents": lambda _: retrieved_docs,
-                "question": lambda _: user_question
-            }
-        ) | {
-            "documents": lambda input: filter_metadata(input["documents"]),
-            "answer": rag_chain_from_docs,
+async def generate_with_fallback(user_question: str, retrieved_docs: list[Document], route: str, timeout: float = None, history: str = None) -> dict:
+    """
+    LLM で回答を生成する. LLM のサーキットが開いている・timeout 秒以内に応答がない・失敗した場合は
+    検索結果の抜粋 (build_degraded_answer) を返し、検索まで成功したリクエストを 500 にしない.
+    リクエストの期限が近い (残り ANSWER_MIN_LLM_SECONDS 未満) 場合も LLM を呼び出さない
+    """
+    chat = get_upstream(route_upstream(route))
+    if upstream_unavailable(chat.name):
+        logging.warning("LLM のサーキットが開いているため、検索結果の抜粋を返します")
+        return build_degraded_answer(retrieved_docs, "llm_circuit_open")
+    remaining = remaining_seconds()
+    if remaining is not None and remaining < answer_min_llm_seconds:
+        logging.warning(f"リクエストの残り時間 ({remaining:.1f} 秒) が少ないため、検索結果の抜粋を返します")
+        return build_degraded_answer(retrieved_docs, "deadline")
+    try:
+        return await run_stage("llm", answer_with_documents(user_question, retrieved_docs, route, history), cap=timeout or answer_llm_timeout)
+    except Exception as e:
+        # トランスポートの CircuitOpenError / DeadlineExceeded は SDK の APIConnectionError に包まれて届く
+        error = unwrap_error(e)
+        if isinstance(error, DeadlineExceeded):
+            remaining = remaining_seconds()
+            if remaining is not None and remaining <= 0:
+                logging.warning("リクエストの期限までに LLM が応答しなかったため、検索結果の抜粋を返します")
+                return build_degraded_answer(retrieved_docs, "deadline")
+            # 応答しない LLM を呼び出し続けないよう、タイムアウトも失敗として数える
+            chat.breaker.record_failure()
+            logging.warning(f"LLM が {timeout or answer_llm_timeout} 秒以内に応答しなかったため、検索結果の抜粋を返します")
+            return build_degraded_answer(retrieved_docs, "llm_timeout")
+        if isinstance(error, CircuitOpenError):
+            logging.warning(f"LLM のサーキットが開いたため、検索結果の抜粋を返します: {error}")
+            return build_degraded_answer(retrieved_docs, "llm_circuit_open")
+        logging.error(f"LLM の回答生成に失敗したため、検索結果の抜粋を返します: {e}")
+        return build_degraded_answer(retrieved_docs, "llm_error")
+
+
+async def stream_answer(user_question: str, retrieved_docs: list[Document], timeout: float = None, route_mode: str = "auto", history: str = None) -> AsyncIterator[dict]:
+    """
+    answer_or_degrade のストリーミング版. 次のイベントを順に返す
+        {"type": "sources", documentUrl, documentName, last_modified, route}  参照ドキュメントと使用するルート
+        {"type": "token", "content": ...}  LLM の出力 (逐次)
+        {"type": "degraded", ...}  LLM を使用できない場合の回答 (build_degraded_answer と同じ内容)
+        {"type": "error", "reason": ...}  出力の途中で LLM が失敗・タイムアウトした場合
+        {"type": "done"}
+    """
+    decision = choose_route(user_question, retrieved_docs, route_mode)
+    yield {"type": "sources", **summarize_sources(filter_metadata(retrieved_docs)), "route": decision["route"]}
+
+    chat = get_upstream(route_upstream(decision["route"]))
+    remaining = remaining_seconds()
+    unavailable = upstream_unavailable(chat.name)
+    if unavailable or (remaining is not None and remaining < answer_min_llm_seconds):
+        reason = "llm_circuit_open" if unavailable else "deadline"
+        yield {"type": "degraded", **build_degraded_answer(retrieved_docs, reason)}
+        yield {"type": "done"}
+        return
+
+    started = time.monotonic()
+    degraded = False
+    chain = RAG_PROMPT | get_llm(decision["route"]) | StrOutputParser()
+    tokens = chain.astream({"context": format_docs(retrieved_docs), "question": with_history(user_question, history)})
+    # LLM のステージ全体 (最初のトークンから最後まで) を 1 つの期限で打ち切る
+    stage = Deadline(min(timeout or answer_llm_timeout, remaining if remaining is not None else float("inf")))
+    streamed = False
+    try:
+        while True:
+            try:
+                token = await asyncio.wait_for(anext(tokens), timeout=stage.remaining())
+            except StopAsyncIteration:
+                break
+            streamed = True
+            yield {"type": "token", "content": token}
+    except Exception as e:
+        error = unwrap_error(e)
+        if isinstance(e, asyncio.TimeoutError):
+            reason = "llm_timeout"
+        elif isinstance(error, CircuitOpenError):
+            reason = "llm_circuit_open"
+        elif isinstance(error, DeadlineExceeded):
+            reason = "deadline"
+        else:
+            reason = "llm_error"
+        if reason == "llm_timeout":
+            remaining = remaining_seconds()
+            if remaining is not None and remaining <= 0:
+                reason = "deadline"
+            else:
+                chat.breaker.record_failure()
+        logging.warning(f"LLM のストリーミングを中断しました ({reason}): {e}")
+        # 出力を始める前であれば検索結果の抜粋で回答する
+        degraded = True
+        if streamed:
+            yield {"type": "error", "reason": reason}
+        else:
+            yield {"type": "degraded", **build_degraded_answer(retrieved_docs, reason)}
+    finally:
+        await tokens.aclose()
+    route_metrics.record(decision, time.monotonic() - started, degraded=degraded)
+    yield {"type": "done"}
+
+
+async def answer_with_documents(user_question: str, retrieved_docs: list[Document], route: str = "full", history: str = None):
+    """
+    検索済みのドキュメントをコンテキストとして LLM (route のデプロイメント) で回答を生成し、回答と参照ドキュメントの情報・トークン数 (usage) を返す
+    history は会話の履歴 (質問の前に付けて渡す)
+    """
+    # RAG チェーン構築
+    rag_chain_from_docs = (
+        {
+            "context": lambda input: format_docs(input["documents"]),
+            "question": itemgetter("question"),
         }
+        | RAG_PROMPT
+        | get_llm(route)
+    )
 
-        # チェーン実行
-        answer_data = rag_chain_with_source.invoke({})
-        answer = answer_data["answer"]
-
-        # 上位ドキュメントの情報をまとめる
-        documents_info = answer_data["documents"]
-        documentUrl_list, documentName_list, last_modified_list = [], [], []
-
-        if documents_info:
-            # 最初の1件を追加
-            documentUrl_list.append(documents_info[0]["documentUrl"])
-            documentName_list.append(documents_info[0]["documentName"])
-            last_modified_list.append(documents_info[0]["last_modified"])
-
-            # 以降、URL が重複しなければ追加
-            for i in range(len(documents_info) - 1):
-                if documents_info[i]["documentUrl"] != documents_info[i+1]["documentUrl"]:
-                    documentUrl_list.append(documents_info[i+1]["documentUrl"])
-                    documentName_list.append(documents_info[i+1]["documentName"])
-                    last_modified_list.append(documents_info[i+1]["last_modified"])
-
-        content = {
-            "answer": answer,
-            "documentUrl": documentUrl_list,
-            "documentName": documentName_list,
-            "last_modified": last_modified_list,
+    # RAG チェーン実行
+    rag_chain_with_source = RunnableMap(
+        {
+            "documents": lambda _: retrieved_docs,
+            "question": lambda _: with_history(user_question, history)
         }
-        return content
+    ) | {
+        "documents": lambda input: filter_metadata(input["documents"]),
+        "answer": rag_chain_from_docs,
+    }
+
+    # チェーン実行
+    answer_data = await rag_chain_with_source.ainvoke({})
+    answer = answer_data["answer"].content
+
+    # 上位ドキュメントの情報をまとめる
+    content = {
+        "answer": answer,
+        **summarize_sources(answer_data["documents"]),
+        "usage": token_usage(answer_data["answer"]),
+    }
+    return content
+
+
+async def retrieve_documents(user_question: str, project_name: str, folder_name: str=None, subfolder_name:str=None, oversampling: float=None, index_name: str=None, folder_path: str=None, user_vector: list[float]=None) -> list[Document]:
+    """
+    指定したプロジェクトに対して、フォルダ名でのフィルタリング機能を追加したベクトル検索を実行し、回答の根拠とするドキュメントを返す
+    oversampling はインデックスでベクトル圧縮を有効にしている場合のみ指定する
+    index_name はプロジェクトのレコードが指す稼働中のインデックス (未指定の場合は {project}-index)
+    folder_path を指定した場合は、そのフォルダ (任意の階層) 以下のドキュメントに絞り込む
+    user_vector はベクトル化済みのクエリ (会話の履歴を含めたクエリなど)
+    """
+    index_name = index_name or get_index_name(project_name)
+
+    # vectorFilterModeを用いてベクトル検索にfolderName, subfolderNameでのフィルタリングを追加
+    # (共有インデックスの場合は projectName でも絞り込む)
+    retrieved_docs = await vector_search_with_filter(
+        index_name=index_name,
+        user_query=user_question,
+        search_filter=SearchFilter(folder_name, subfolder_name, project_name if shared_index_name else None, folder_path),
+        vector_filter_mode="preFilter",
+        top=3,
+        oversampling=oversampling,
+        user_vector=user_vector,
+    )
+
+    logging.info(f"retrieved_docs: {retrieved_docs}")
+    return retrieved_docs
+
+
+async def generate_answer(user_question: str, project_name: str, folder_name: str=None, subfolder_name:str=None, oversampling: float=None, index_name: str=None, folder_path: str=None, route_mode: str="auto"):
+    """
+    指定したプロジェクトに対して、フォルダ名でのフィルタリング機能を追加したベクトル検索を実行し、ユーザーの質問に対する回答を生成する
+    (引数は retrieve_documents と同じ. route_mode はプロジェクトの answer_route)
+    """
+    try:
+        retrieved_docs = await retrieve_documents(
+            user_question, project_name, folder_name, subfolder_name, oversampling, index_name, folder_path
+        )
+        return await answer_or_degrade(user_question, retrieved_docs, route_mode=route_mode)
 
     except Exception as e:
         logging.error(f"Error generating answer with prompt: {e}")
         raise
 
 
-def generate_answer_all(user_question, container):
+async def retrieve_all_documents(user_question, container, user_vector: list[float]=None) -> list[Document]:
     """
-    プロジェクト名が"ALL"の時、すべてのプロジェクトを検索対象としてベクトル検索を実行する。
-    ベクトル検索の結果から、検索スコア上位3件をもとに、LLMを介して質問に対する回答を生成。
+    プロジェクト名が"ALL"の時、すべてのプロジェクトを検索対象としてベクトル検索を実行し、検索スコア上位3件を返す。
+    user_vector はベクトル化済みのクエリ (会話の履歴を含めたクエリなど)
     """
-    try:
-        # クエリを実行して project_name を抽出
-        project_names = []
-        retrieved_docs_list = []
-        query = "SELECT c.project_name FROM c"  # 必要なフィールドのみ取得
+    # クエリのベクトル化は 1 回のみ行う
+    if user_vector is None:
+        user_vector = await embed_query(user_question)
+    search_filter = SearchFilter()
+    if shared_index_name:
+        # 共有インデックスの場合は、プロジェクトで絞り込まずに 1 回のクエリで全プロジェクトを検索する
+        retrieved_docs_list = await run_stage(
+            "search", get_retriever(shared_index_name).search(shared_index_name, user_vector, search_filter, top=3), cap=search_stage_timeout
+        )
+        doc_indexes = {id(doc): shared_index_name for doc in retrieved_docs_list}
+    else:
+        # クエリを実行して各プロジェクトの稼働中のインデックス名を取得
+        index_names = []
+        query = "SELECT c.project_name, c.active_index FROM c"  # 必要なフィールドのみ取得
         for item in container.query_items(query=query, enable_cross_partition_query=True):
-            project_names.append(item["project_name"])  # project_name をリストに追加
-        
-        # すべてプロジェクトに関してベクトル検索を実行
-        for project_name in project_names:
-            index_name = f"{project_name}-index"
-            retriever = AzureSearch(
-                azure_search_endpoint=azure_search_endpoint,
-                azure_search_key=azure_search_key,
-                index_name=index_name,
-                embedding_function=AzureOpenAIEmbeddings(
-                    azure_deployment="text-embedding-ada-002",
-                    openai_api_version="2023-05-15",
-                    openai_api_key=openai_embedding_key,
-                    azure_endpoint=openai_embedding_endpoint,
-                ).embed_query,
-            ).as_retriever(search_type="similarity")
-
-            retrieved_docs = retriever.get_relevant_documents(user_question)[:3]
-            logging.info(f"retrieved_docs: {retrieved_docs}")
-
-            # retrieved_docs の要素を展開して追加
-            for doc in retrieved_docs:
-                retrieved_docs_list.append(doc)
-
-        # @search.score が大きい順に並べ替え
+            index_names.append(get_project_index_name(item))  # インデックス名をリストに追加
+
+        # すべてのプロジェクトのインデックスを並列に検索する (期限内に終わらない検索はまとめて打ち切る)
+        results = await run_stage("search", asyncio.gather(*[
+            get_retriever(index_name).search(index_name, user_vector, search_filter, top=3)
+            for index_name in index_names
+        ]), cap=search_stage_timeout)
+        retrieved_docs_list = [doc for docs in results for doc in docs]
+        doc_indexes = {id(doc): index_name for index_name, docs in zip(index_names, results) for doc in docs}
+
+    # @search.score が大きい順に並べ替え
+    retrieved_docs_list = sorted(
+        retrieved_docs_list,
+        key=lambda x: x.metadata.get('@search.score', 0),  # @search.score を基準にソート
+        reverse=True  # 降順にソート
+    )
+    #検索結果を上位三件に絞る
+    retrieved_docs_list = retrieved_docs_list[:3]
+
+    # 前後のチャンクの展開はインデックスごとに行う
+    if chunk_expansion_window > 0:
+        by_index: dict[str, list[Document]] = {}
+        for doc in retrieved_docs_list:
+            by_index.setdefault(doc_indexes[id(doc)], []).append(doc)
+        expanded = await asyncio.gather(*[
+            expand_context(get_retriever(index_name), index_name, docs) for index_name, docs in by_index.items()
+        ])
         retrieved_docs_list = sorted(
-            retrieved_docs_list,
-            key=lambda x: x.metadata.get('@search.score', 0),  # @search.score を基準にソート
-            reverse=True  # 降順にソート
-        )
-        #検索結果を上位三件に絞る
-        retrieved_docs_list = retrieved_docs_list[:3]
-        logging.info(f"retrieved_docs sorted by @search.score: {retrieved_docs_list}")
-
-        llm = AzureChatOpenAI(
-            openai_api_key=openai.api_key,
-            azure_endpoint=openai.azure_endpoint,
-            openai_api_version="2024-08-01-preview",
-            azure_deployment="gpt-4o",
-            temperature=0,
+            (doc for docs in expanded for doc in docs), key=lambda x: x.metadata.get('@search.score', 0), reverse=True
         )
+    logging.info(f"retrieved_docs sorted by @search.score: {retrieved_docs_list}")
+    return retrieved_docs_list
 
-        # ベクトルストアから取り出したdocumentからpage_contentの内容だけを抽出し、連結.
-        def format_docs(docs):
-            return "\n\n".join(doc.page_content for doc in docs)
-        
-        # 必要なフィールドのみ抽出
-        def filter_metadata(docs):
-            return [
-                {
-                    "documentUrl": doc.metadata.get("documentUrl"),
-                    "documentName": doc.metadata.get("documentName"),
-                    "last_modified": doc.metadata.get("last_modified"),
-                }
-                for doc in docs
-            ]
-        
-        # Use a prompt for RAG that is checked into the LangChain prompt hub (https://smith.langchain.com/hub/rlm/rag-prompt?organizationId=989ad331-949f-4bac-9694-660074a208a7)
-        prompt = hub.pull("rlm/rag-prompt")
-        
-        rag_chain_from_docs = (
-            {
-                "context": lambda input: format_docs(input['documents']),
-                "question": itemgetter("question"),
-            }
-            | prompt
-            | llm
-            | StrOutputParser()
-        )
 
-        rag_chain_with_source = RunnableMap(
-            {"documents": retriever, "question": RunnablePassthrough()}
-        ) | {
-            "documents": lambda input: filter_metadata(input["documents"]),
-            "answer": rag_chain_from_docs,
-        }
+async def generate_answer_all(user_question, container):
+    """
+    プロジェクト名が"ALL"の時、すべてのプロジェクトを検索対象としてベクトル検索を実行する。
+    ベクトル検索の結果から、検索スコア上位3件をもとに、LLMを介して質問に対する回答を生成。
+    """
+    try:
+        retrieved_docs_list = await retrieve_all_documents(user_question, container)
 
         # 会話の回答生成
         #関連度の高い資料の情報も取得
-        answer_data = rag_chain_with_source.invoke(user_question)
-        answer = answer_data["answer"]
-        documentUrl_list, documentName_list, last_modified_list = [], [], []
-
-        #最も関連度の高い資料をリストに追加
-        documentUrl_list.append(answer_data["documents"][0]["documentUrl"])
-        documentName_list.append(answer_data["documents"][0]["documentName"])
-        last_modified_list.append(answer_data["documents"][0]["last_modified"])
-
-        for i in range(2):
-            # 異なる関連ドキュメントが存在する場合はリストに追加
-            if answer_data["documents"][i]["documentUrl"] != answer_data["documents"][i+1]["documentUrl"]:
-                documentUrl_list.append(answer_data["documents"][i+1]["documentUrl"])
-                documentName_list.append(answer_data["documents"][i+1]["documentName"])
-                last_modified_list.append(answer_data["documents"][i+1]["last_modified"])
-        
-        content={
-            "answer": answer,
-            "documentUrl": documentUrl_list,
-            "documentName": documentName_list,
-            "last_modified": last_modified_list,
-        }
-        return content
+        return await answer_or_degrade(user_question, retrieved_docs_list)
 
     except Exception as e:
         logging.error(f"Error generating answer with prompt: {e}")
-        raise
\ No newline at end of file
+        raise
@@ -0,0 +1,425 @@
+import os
+import asyncio
+import logging
+from datetime import datetime, timezone
+
+from azure.core import MatchConditions
+from azure.cosmos import exceptions
+from fastapi import HTTPException
+
+from SharePoint import SharePointAccessClass
+from indexing_service import ProjectIndexingService, advance_cursor, get_project_index_name, page_query, shared_index_name
+from push_pipeline import PushIndexingPipeline
+from generate_answer import vector_search_with_filter
+from retrievers import SearchFilter
+from search_profiles import IndexStorageProfile, VectorAlgorithmProfile
+from utils import get_site_info_by_url
+
+# 環境変数等の取得
+# 新しいインデックスのドキュメント数が、稼働中のインデックスに対してこの比率を下回る場合は切り替えない
+rebuild_min_count_ratio = float(os.getenv("REBUILD_MIN_COUNT_RATIO", "0.95"))
+# 切り替え後も削除せずに残す (切り戻し用の) 以前のインデックスの数
+rebuild_keep_versions = int(os.getenv("REBUILD_KEEP_VERSIONS", "1"))
+# push 型の投入中に rebuild.heartbeat_at を更新する間隔 (秒). この 5 倍の間更新がない場合は、投入したプロセスが停止したとみなす
+rebuild_heartbeat_seconds = int(os.getenv("REBUILD_HEARTBEAT_SECONDS", "60"))
+# push 型の投入が中断された場合に、最初から投入し直す最大回数 (超えた場合は失敗とし、再構築の再実行が必要)
+rebuild_max_push_attempts = int(os.getenv("REBUILD_MAX_PUSH_ATTEMPTS", "3"))
+
+
+def versioned_name(project_name: str, resource: str, version: int) -> str:
+    """
+    再構築で作成するリソースの名前 ({project}-index-vN, {project}-skillset-vN, {project}-indexer-vN).
+    """
+    return f"{project_name}-{resource}-v{version}"
+
+
+def now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def seconds_since(timestamp: str | None) -> float:
+    if not timestamp:
+        return float("inf")
+    return (datetime.now(timezone.utc) - datetime.fromisoformat(timestamp)).total_seconds()
+
+
+class IndexRebuilder:
+    """
+    稼働中のインデックスを残したまま {project}-index-vN を作成・投入し、検証後にプロジェクトのレコードの
+    active_index を切り替える (ブルーグリーン方式の再構築). 検索は常に active_index を参照するため、
+    再構築中も空・途中のインデックスを検索することはない.
+    状態はプロジェクトのレコード (rebuild) に保存し、advance を繰り返し呼び出して進める (building → switched / failed).
+    push 型の投入はプロセス内のタスクで実行するため、再起動などで中断された場合 (heartbeat_at が更新されない場合) は
+    advance で最初から投入し直す (アップロードはキー単位の上書き、Layout・埋め込みはキャッシュされるため再実行できる).
+    """
+    def __init__(self, search_indexing: ProjectIndexingService, container, sharepoint: SharePointAccessClass):
+        self.search_indexing = search_indexing
+        self.container = container
+        self.sharepoint = sharepoint
+        # push 型で投入中のタスク (プロジェクト名 -> タスク)
+        self._tasks: dict[str, asyncio.Task] = {}
+
+    async def _search(self, index_name: str, body: dict) -> dict:
+        response = await self.search_indexing.http_client.post(
+            f"/indexes('{index_name}')/docs/search.post.search",
+            params={"api-version": self.search_indexing.api_version},
+            json={"search": "*", **body},
+        )
+        if response.status_code != 200:
+            raise HTTPException(status_code=response.status_code, detail=f"ドキュメントの検索に失敗しました: {response.text}")
+        return response.json()
+
+    async def count_documents(self, index_name: str) -> int:
+        return (await self._search(index_name, {"count": True, "top": 0}))["@odata.count"]
+
+    async def _delete(self, resource_path: str):
+        response = await self.search_indexing.http_client.delete(
+            resource_path, params={"api-version": self.search_indexing.api_version}
+        )
+        if response.status_code not in (204, 404):
+            logging.warning(f"リソースの削除に失敗しました ({resource_path}): {response.text}")
+
+    def _save(self, project: dict) -> dict:
+        """
+        レコードを ETag 付きで更新する (別の処理が先に更新していた場合は 409).
+        """
+        try:
+            return self.container.replace_item(
+                item=project["id"], body=project, etag=project.get("_etag"), match_condition=MatchConditions.IfNotModified
+            )
+        except exceptions.CosmosAccessConditionFailedError:
+            raise HTTPException(status_code=409, detail="プロジェクトは別の処理によって更新されています. 再度実行してください.")
+
+    # --- 開始 ---
+
+    async def start(
+            self,
+            project: dict,
+            mode: str = "pull",
+            index_profile: IndexStorageProfile = None,
+            vector_profile: VectorAlgorithmProfile = None,
+            sample_query: str = None,
+            min_count_ratio: float = None,
+        ) -> dict:
+        """
+        新しいバージョンのインデックスを作成し、投入を開始する.
+        pull: 既存のインデクサーの定義を複製した {project}-indexer-vN で投入する.
+        push: push 型パイプラインで SharePoint から直接投入する.
+        """
+        if shared_index_name:
+            raise HTTPException(status_code=400, detail="共有インデックスモードではインデックスの再構築は利用できません")
+        project_name = project["project_name"]
+        rebuild = project.get("rebuild") or {}
+        if rebuild.get("status") == "building":
+            raise HTTPException(status_code=409, detail=f"プロジェクト '{project_name}' のインデックスは再構築中です")
+
+        # 未指定の場合は /resist_project で保留した設定、なければ現在の設定を使用する
+        index_profile = index_profile or IndexStorageProfile(**(project.get("pending_index_profile") or project.get("index_profile", {})))
+        vector_profile = vector_profile or VectorAlgorithmProfile(**(project.get("pending_vector_profile") or project.get("vector_profile", {})))
+        version = project.get("index_version", 0) + 1
+        index_name = versioned_name(project_name, "index", version)
+
+        index = self.search_indexing.build_index_definition(project_name, index_profile, vector_profile, index_name)
+        index_api_version = self.search_indexing.binary_quantization_api_version if index_profile.compression == "binary" else None
+        # 前回失敗したバージョンが残っている場合に備えて削除してから作成する
+        await self._delete(f"/indexes('{index_name}')")
+        await self.search_indexing._apply_resource(f"/indexes('{index_name}')", index, "インデックス", etag=None, api_version=index_api_version)
+
+        if mode == "pull":
+            await self._start_indexer(project_name, version, index_profile)
+        else:
+            site = await asyncio.to_thread(lambda: get_site_info_by_url(self.sharepoint.get_sites(), project["spo_url"]))
+            if site is None:
+                raise HTTPException(status_code=404, detail=f"サイト '{project['spo_url']}' が見つかりませんでした")
+
+        project["rebuild"] = {
+            "version": version,
+            "index_name": index_name,
+            "previous_index": get_project_index_name(project),
+            "mode": mode,
+            "status": "building",
+            "started_at": now(),
+            "sample_query": sample_query,
+            "min_count_ratio": min_count_ratio or rebuild_min_count_ratio,
+            "index_profile": index_profile.model_dump(),
+            "vector_profile": vector_profile.model_dump(),
+        }
+        if mode == "push":
+            project["rebuild"].update({"site_id": site["id"], "attempts": 1, "heartbeat_at": now()})
+        self._save(project)
+        if mode == "push":
+            self._start_push(project)
+        logging.info(f"プロジェクト '{project_name}' のインデックス '{index_name}' の再構築を開始しました ({mode})")
+        return project["rebuild"]
+
+    async def _start_indexer(self, project_name: str, version: int, index_profile: IndexStorageProfile):
+        """
+        稼働中のインデクサーの定義 (スケジュール以外) を複製し、新しいインデックスに投入するインデクサーを作成する (作成時に実行される).
+        """
+        index_name = versioned_name(project_name, "index", version)
+        skillset_name = versioned_name(project_name, "skillset", version)
+        indexer_name = versioned_name(project_name, "indexer", version)
+
+        skillset = self.search_indexing.build_skillset_definition(project_name, index_profile, index_name)
+        skillset["name"] = skillset_name
+        await self._delete(f"/skillsets('{skillset_name}')")
+        await self.search_indexing._apply_resource(f"/skillsets('{skillset_name}')", skillset, "スキルセット", etag=None)
+
+        indexer = await self.search_indexing._get_resource(f"/indexers('{project_name}-indexer')")
+        if indexer is None:
+            raise HTTPException(status_code=404, detail=f"インデクサー '{project_name}-indexer' が見つかりませんでした")
+        for key in ("@odata.etag", "@odata.context"):
+            indexer.pop(key, None)
+        indexer.update({"name": indexer_name, "skillsetName": skillset_name, "targetIndexName": index_name, "schedule": None})
+        await self._delete(f"/indexers('{indexer_name}')")
+        await self.search_indexing._apply_resource(f"/indexers('{indexer_name}')", indexer, "インデクサー", etag=None)
+
+    def _start_push(self, project: dict):
+        """
+        push 型パイプラインで新しいインデックスに投入するタスクを開始する.
+        """
+        rebuild = project["rebuild"]
+        pipeline = PushIndexingPipeline(
+            project["project_name"], rebuild["site_id"], self.sharepoint, self.search_indexing,
+            dedupe_text_fields=IndexStorageProfile(**rebuild["index_profile"]).dedupe_text_fields, index_name=rebuild["index_name"],
+        )
+        self._tasks[project["project_name"]] = asyncio.create_task(self._run_push(project, pipeline))
+
+    async def _run_push(self, project: dict, pipeline: PushIndexingPipeline):
+        """
+        パイプラインの実行中、rebuild.heartbeat_at を定期的に更新する (他のプロセスが投入の中断を判定できるようにする).
+        """
+        async def heartbeat():
+            while True:
+                await asyncio.sleep(rebuild_heartbeat_seconds)
+                try:
+                    await asyncio.to_thread(
+                        self.container.patch_item,
+                        item=project["id"],
+                        partition_key=project["project_name"],
+                        patch_operations=[{"op": "set", "path": "/rebuild/heartbeat_at", "value": now()}],
+                    )
+                except exceptions.CosmosHttpResponseError as e:
+                    logging.warning(f"再構築の heartbeat_at の更新に失敗しました: {e}")
+
+        heartbeat_task = asyncio.create_task(heartbeat())
+        try:
+            return await pipeline.run()
+        finally:
+            heartbeat_task.cancel()
+
+    # --- 進行・検証・切り替え ---
+
+    async def _resume_push(self, project: dict) -> tuple[str, str | None]:
+        """
+        このプロセスに投入中のタスクがない場合の状況を返す. 他のプロセスで投入中であれば building、
+        投入したプロセスが停止していれば最初から投入し直す (最大 REBUILD_MAX_PUSH_ATTEMPTS 回).
+        """
+        rebuild = project["rebuild"]
+        if seconds_since(rebuild.get("heartbeat_at")) < rebuild_heartbeat_seconds * 5:
+            return "building", None
+        attempts = rebuild.get("attempts", 1)
+        if "site_id" not in rebuild or attempts >= rebuild_max_push_attempts:
+            return "failed", "push 型の投入が中断されました. 再構築を再度実行してください"
+        rebuild.update({"attempts": attempts + 1, "heartbeat_at": now()})
+        project.update(self._save(project))
+        self._start_push(project)
+        logging.warning(f"プロジェクト '{project['project_name']}' の push 型の投入が中断されたため、最初から投入し直します ({attempts + 1} 回目)")
+        return "building", None
+
+    async def _build_status(self, project: dict) -> tuple[str, str | None]:
+        """
+        投入の状況を ("building" / "built" / "failed", エラー内容) で返す.
+        """
+        project_name = project["project_name"]
+        rebuild = project["rebuild"]
+        if rebuild["mode"] == "push":
+            task = self._tasks.get(project_name)
+            if task is None:
+                # プロセスの再起動などでタスクが失われた場合
+                return await self._resume_push(project)
+            if not task.done():
+                return "building", None
+            if task.exception():
+                return "failed", str(task.exception())
+            return "built", None
+
+        indexer_name = versioned_name(project_name, "indexer", rebuild["version"])
+        response = await self.search_indexing.http_client.get(
+            f"/indexers('{indexer_name}')/search.status", params={"api-version": self.search_indexing.api_version}
+        )
+        if response.status_code != 200:
+            return "failed", f"インデクサーの状態の取得に失敗しました: {response.text}"
+        last_result = response.json().get("lastResult") or {}
+        if last_result.get("status") in (None, "inProgress"):
+            return "building", None
+        if last_result["status"] != "success":
+            return "failed", last_result.get("errorMessage") or last_result["status"]
+        return "built", None
+
+    async def validate(self, rebuild: dict) -> dict:
+        """
+        新しいインデックスのドキュメント数を稼働中のインデックスと比較し、サンプルクエリで結果が返ることを確認する.
+        """
+        new_count = await self.count_documents(rebuild["index_name"])
+        try:
+            live_count = await self.count_documents(rebuild["previous_index"])
+        except HTTPException:
+            live_count = 0
+        checks = {
+            "document_count": new_count,
+            "previous_document_count": live_count,
+            "count_ok": new_count > 0 and new_count >= live_count * rebuild["min_count_ratio"],
+        }
+        if rebuild.get("sample_query"):
+            documents = await vector_search_with_filter(
+                rebuild["index_name"], rebuild["sample_query"], SearchFilter(),
+                oversampling=IndexStorageProfile(**rebuild["index_profile"]).query_oversampling,
+            )
+            checks["sample_query_results"] = len(documents)
+            checks["sample_query_ok"] = len(documents) > 0
+        checks["passed"] = checks["count_ok"] and checks.get("sample_query_ok", True)
+        return checks
+
+    async def advance(self, project: dict) -> dict:
+        """
+        再構築の状態を確認し、投入が完了していれば検証して切り替える. 更新後の rebuild を返す.
+        """
+        project_name = project["project_name"]
+        rebuild = project.get("rebuild")
+        if not rebuild or rebuild["status"] != "building":
+            return rebuild or {}
+
+        status, error = await self._build_status(project)
+        rebuild = project["rebuild"]
+        if status == "building":
+            return rebuild
+        if status == "failed":
+            rebuild.update({"status": "failed", "error": error, "finished_at": now()})
+            await self._cleanup_build(project_name, rebuild)
+            self._save(project)
+            logging.error(f"プロジェクト '{project_name}' のインデックスの再構築に失敗しました: {error}")
+            return rebuild
+
+        rebuild["validation"] = await self.validate(rebuild)
+        if not rebuild["validation"]["passed"]:
+            rebuild.update({"status": "failed", "error": "検証に失敗しました", "finished_at": now()})
+            await self._cleanup_build(project_name, rebuild)
+            self._save(project)
+            logging.error(f"プロジェクト '{project_name}' の新しいインデックスは検証に失敗しました: {rebuild['validation']}")
+            return rebuild
+        return await self.switch(project)
+
+    async def switch(self, project: dict) -> dict:
+        """
+        プロジェクトのレコードの active_index を新しいインデックスに切り替える (ETag による 1 回の更新).
+        その後、稼働中のインデクサーの出力先を新しいインデックスに変更し、再構築中に更新されたファイルを再処理させる.
+        """
+        project_name = project["project_name"]
+        rebuild = project["rebuild"]
+        previous_index = rebuild["previous_index"]
+
+        project["active_index"] = rebuild["index_name"]
+        project["index_version"] = rebuild["version"]
+        project["index_profile"] = rebuild["index_profile"]
+        project["vector_profile"] = rebuild["vector_profile"]
+        project.pop("pending_index_profile", None)
+        project.pop("pending_vector_profile", None)
+        project["previous_indexes"] = [*project.get("previous_indexes", []), previous_index]
+        rebuild.update({"status": "switched", "finished_at": now()})
+        project.update(self._save(project))
+        logging.info(f"プロジェクト '{project_name}' のインデックスを '{previous_index}' から '{rebuild['index_name']}' に切り替えました")
+
+        await self._retarget_live_indexer(project_name, rebuild, previous_index)
+        await self._cleanup_build(project_name, rebuild)
+        await self.collect_garbage(project)
+        return rebuild
+
+    async def _retarget_live_indexer(self, project_name: str, rebuild: dict, previous_index: str):
+        skillset = self.search_indexing.build_skillset_definition(
+            project_name, IndexStorageProfile(**rebuild["index_profile"]), rebuild["index_name"]
+        )
+        current = await self.search_indexing._get_resource(f"/skillsets('{skillset['name']}')")
+        await self.search_indexing._apply_resource(
+            f"/skillsets('{skillset['name']}')", skillset, "スキルセット", etag=current.get("@odata.etag") if current else None
+        )
+        indexer = await self.search_indexing._get_resource(f"/indexers('{project_name}-indexer')")
+        if indexer is None:
+            return
+        indexer["targetIndexName"] = rebuild["index_name"]
+        await self.search_indexing._apply_resource(f"/indexers('{indexer['name']}')", indexer, "インデクサー", etag=indexer.get("@odata.etag"))
+
+        # 再構築の開始後に更新されたファイルは、稼働中のインデクサーによって以前のインデックスにのみ登録されている可能性があるため再処理させる
+        try:
+            parent_ids, cursor = set(), None
+            while True:
+                response = await self._search(previous_index, {
+                    "select": "parent_id, documentId",
+                    "top": 1000,
+                    **page_query(f"last_modified ge {rebuild['started_at']}", cursor),
+                })
+                documents = response.get("value", [])
+                if not documents:
+                    break
+                parent_ids.update(document["parent_id"] for document in documents if document.get("parent_id"))
+                cursor = advance_cursor(cursor, documents)
+            document_keys = sorted(parent_ids)
+            if document_keys:
+                await self.search_indexing.reset_project_documents(project_name, document_keys)
+            await self.search_indexing.run_project_indexer(project_name)
+        except HTTPException as e:
+            logging.warning(f"切り替え後のインデクサーの実行に失敗しました (次回のスケジュール実行で反映されます): {e.detail}")
+
+    async def _cleanup_build(self, project_name: str, rebuild: dict):
+        """
+        投入用のインデクサー・スキルセットを削除する (失敗した場合は新しいインデックスも削除する).
+        """
+        if rebuild["mode"] == "pull":
+            await self._delete(f"/indexers('{versioned_name(project_name, 'indexer', rebuild['version'])}')")
+            await self._delete(f"/skillsets('{versioned_name(project_name, 'skillset', rebuild['version'])}')")
+        if rebuild["status"] == "failed":
+            await self._delete(f"/indexes('{rebuild['index_name']}')")
+        self._tasks.pop(project_name, None)
+
+    async def collect_garbage(self, project: dict) -> list[str]:
+        """
+        切り替え前のインデックスのうち、直近 REBUILD_KEEP_VERSIONS 個より古いものを削除する.
+        """
+        previous_indexes = project.get("previous_indexes", [])
+        keep = previous_indexes[len(previous_indexes) - rebuild_keep_versions:] if rebuild_keep_versions > 0 else []
+        expired = [index_name for index_name in previous_indexes if index_name not in keep]
+        for index_name in expired:
+            await self._delete(f"/indexes('{index_name}')")
+            logging.info(f"以前のインデックス '{index_name}' を削除しました")
+        if expired:
+            project["previous_indexes"] = keep
+            project.update(self._save(project))
+        return expired
+
+    async def delete_versions(self, project: dict):
+        """
+        プロジェクトの削除時に、再構築で作成したインデックス・インデクサー・スキルセットを削除する.
+        """
+        project_name = project["project_name"]
+        rebuild = project.get("rebuild") or {}
+        if rebuild.get("version"):
+            await self._delete(f"/indexers('{versioned_name(project_name, 'indexer', rebuild['version'])}')")
+            await self._delete(f"/skillsets('{versioned_name(project_name, 'skillset', rebuild['version'])}')")
+            await self._delete(f"/indexes('{rebuild['index_name']}')")
+        for index_name in [project.get("active_index"), *project.get("previous_indexes", [])]:
+            if index_name:
+                await self._delete(f"/indexes('{index_name}')")
+
+    async def advance_all(self):
+        """
+        再構築中の全プロジェクトの状態を進める (タイマーから定期的に呼び出す).
+        """
+        projects = list(self.container.query_items(
+            query="SELECT * FROM c WHERE c.rebuild.status = 'building'",
+            enable_cross_partition_query=True,
+        ))
+        for project in projects:
+            try:
+                await self.advance(project)
+            except Exception as e:
+                logging.error(f"プロジェクト '{project.get('project_name')}' のインデックス再構築の確認エラー: {e}")
@@ -0,0 +1,152 @@
+import os
+import asyncio
+import logging
+from datetime import datetime, timezone
+from statistics import median
+
+from fastapi import HTTPException
+
+from indexing_service import ProjectIndexingService
+from utils import patch_project_fields
+
+# 環境変数等の取得
+# 直近の成功した実行の docs/min の中央値に対して、この比率を下回った実行をスループット低下とみなす
+throughput_regression_ratio = float(os.getenv("INDEXER_THROUGHPUT_REGRESSION_RATIO", "0.5"))
+# 失敗したアイテムの割合・件数がこれを超えた実行を警告する
+error_rate_threshold = float(os.getenv("INDEXER_ERROR_RATE_THRESHOLD", "0.05"))
+error_count_threshold = int(os.getenv("INDEXER_ERROR_COUNT_THRESHOLD", "10"))
+
+# 比較に使用する直近の実行数と、比較対象とする最小の処理件数 (件数が少ない実行は docs/min が安定しないため除外)
+BASELINE_RUNS = 10
+MIN_ITEMS_FOR_THROUGHPUT = 10
+# プロジェクトのレコードに保存する実行履歴の上限
+MAX_HISTORY = 100
+
+
+def parse_time(value: str | None) -> datetime | None:
+    if not value:
+        return None
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def summarize_run(result: dict) -> dict:
+    """
+    インデクサーの実行結果 (lastResult / executionHistory の要素) から、件数・所要時間・docs/min を取り出す.
+    実行中の場合は現在時刻までの経過時間で計算する.
+    """
+    started = parse_time(result.get("startTime"))
+    ended = parse_time(result.get("endTime"))
+    duration = ((ended or datetime.now(timezone.utc)) - started).total_seconds() if started else 0.0
+    processed = result.get("itemsProcessed") or 0
+    failed = result.get("itemsFailed") or 0
+    return {
+        "start_time": result.get("startTime"),
+        "end_time": result.get("endTime"),
+        "status": result.get("status"),
+        "duration_seconds": round(duration, 1),
+        "items_processed": processed,
+        "items_failed": failed,
+        "docs_per_minute": round(processed / duration * 60, 2) if duration > 0 else 0.0,
+        "error_count": len(result.get("errors") or []),
+        "warning_count": len(result.get("warnings") or []),
+        # 失敗の原因を確認できるよう、先頭のエラーのみ保持する
+        "errors": [
+            {"key": error.get("key"), "message": error.get("errorMessage")}
+            for error in (result.get("errors") or [])[:5]
+        ],
+        "error_message": result.get("errorMessage"),
+    }
+
+
+def flag_run(run: dict, previous_runs: list[dict]) -> list[str]:
+    """
+    スループットの低下・エラーの多い実行を判定する.
+    previous_runs は run より前の実行 (新しい順).
+    """
+    flags = []
+    if run["status"] not in ("success", "inProgress", "reset"):
+        flags.append("failed")
+
+    processed = run["items_processed"]
+    # itemsProcessed には失敗したアイテムも含まれる
+    if run["items_failed"] >= error_count_threshold or (
+        processed and run["items_failed"] / processed > error_rate_threshold
+    ):
+        flags.append("error_threshold_exceeded")
+
+    baseline = [
+        previous["docs_per_minute"] for previous in previous_runs
+        if previous["status"] == "success" and previous["items_processed"] >= MIN_ITEMS_FOR_THROUGHPUT
+    ][:BASELINE_RUNS]
+    if run["status"] != "inProgress" and processed >= MIN_ITEMS_FOR_THROUGHPUT and baseline:
+        if run["docs_per_minute"] < median(baseline) * throughput_regression_ratio:
+            flags.append("throughput_regression")
+    return flags
+
+
+class IndexerMonitor:
+    """
+    各プロジェクトのインデクサーの実行状況を取得し、実行履歴 (件数・所要時間・エラー・docs/min) を記録する.
+    履歴はプロジェクトのレコード (indexing_history) に保存し、スループットの低下やエラーの多い実行にフラグを付ける.
+    """
+    def __init__(self, search_indexing: ProjectIndexingService, container):
+        self.search_indexing = search_indexing
+        self.container = container
+
+    async def get_indexer_status(self, project_name: str) -> dict:
+        indexer_name = f"{project_name}-indexer"
+        response = await self.search_indexing.http_client.get(
+            f"/indexers('{indexer_name}')/search.status",
+            params={"api-version": self.search_indexing.api_version},
+        )
+        if response.status_code != 200:
+            raise HTTPException(status_code=response.status_code, detail=f"インデクサーの状態の取得に失敗しました: {response.text}")
+        return response.json()
+
+    async def poll_project(self, project: dict) -> dict:
+        """
+        インデクサーの状態を取得して実行履歴を更新し、現在の状況と履歴を返す.
+        """
+        project_name = project["project_name"]
+        status = await self.get_indexer_status(project_name)
+
+        # executionHistory (新しい順, 最大 50 件) と保存済みの履歴を開始時刻でまとめる
+        runs = {run["start_time"]: run for run in project.get("indexing_history", [])}
+        for result in status.get("executionHistory") or []:
+            if result.get("startTime"):
+                run = summarize_run(result)
+                run["flags"] = runs.get(run["start_time"], {}).get("flags", [])
+                runs[run["start_time"]] = run
+        history = sorted(runs.values(), key=lambda run: run["start_time"], reverse=True)[:MAX_HISTORY]
+
+        newly_flagged = []
+        for position, run in enumerate(history):
+            flags = flag_run(run, history[position + 1:])
+            if set(flags) - set(run["flags"]):
+                newly_flagged.append(run)
+            run["flags"] = flags
+        for run in newly_flagged:
+            logging.warning(f"インデクサー '{project_name}-indexer' の実行 ({run['start_time']}) に問題があります: {run['flags']}")
+
+        project["indexing_history"] = history
+        patch_project_fields(self.container, project, "indexing_history")
+
+        last_result = status.get("lastResult") or {}
+        current = summarize_run(last_result) if last_result.get("status") == "inProgress" else None
+        return {
+            "project_name": project_name,
+            "indexer_status": status.get("status"),
+            "current_run": current,
+            "history": history,
+            "flagged_runs": [run for run in history if run["flags"]],
+        }
+
+    async def poll_all(self):
+        """
+        全プロジェクトのインデクサーの状態を取得する (タイマーから定期的に呼び出す).
+        """
+        projects = list(self.container.read_all_items())
+        results = await asyncio.gather(*[self.poll_project(project) for project in projects], return_exceptions=True)
+        for project, result in zip(projects, results):
+            if isinstance(result, Exception):
+                logging.error(f"プロジェクト '{project.get('project_name')}' のインデクサーの状態取得エラー: {result}")
@@ -0,0 +1,84 @@
+import os
+import math
+from collections import Counter, defaultdict
+from statistics import median
+
+from SharePoint import SharePointAccessClass
+from search_profiles import IndexingPerformanceProfile
+
+# 環境変数等の取得
+# 実行履歴がない場合に所要時間の見積もりに使用する docs/min (Layout スキル + 埋め込みを含む)
+estimated_docs_per_minute = float(os.getenv("INDEXER_ESTIMATED_DOCS_PER_MINUTE", "30"))
+# 見積もりのためにクロールするファイル数の上限 (登録のリクエストが長時間かからないようにする)
+estimate_max_files = int(os.getenv("INDEXING_ESTIMATE_MAX_FILES", "20000"))
+
+# batch_size を指定しない場合のサービスの既定値 (SharePoint インデクサーでは明示されていないため Blob と同じ値で見積もる)
+DEFAULT_BATCH_SIZE = 10
+# 推奨バッチサイズの目安とする 1 バッチあたりの合計ファイルサイズ
+BATCH_TARGET_BYTES = 64 * 1024 * 1024
+# 拡張子ごとの内訳として返す件数
+TOP_EXTENSIONS = 20
+
+
+def crawl_site_files(sharepoint: SharePointAccessClass, site_id: str, max_files: int = None) -> tuple[list[dict], bool]:
+    """
+    サイトのドライブのファイルを (name, size) のリストとして取得する.
+    max_files に達した場合はそこで打ち切り、打ち切ったかどうかを合わせて返す.
+    """
+    max_files = max_files or estimate_max_files
+    files = []
+    for item in sharepoint.list_files_recursive(site_id):
+        if len(files) >= max_files:
+            return files, True
+        files.append({"name": item.get("name", ""), "size": item.get("size") or 0})
+    return files, False
+
+
+def baseline_docs_per_minute(indexing_history: list[dict]) -> float | None:
+    """
+    インデクサーの実行履歴 (indexer_monitor が保存した indexing_history) から、成功した実行の docs/min の中央値を返す.
+    """
+    rates = [
+        run["docs_per_minute"] for run in indexing_history or []
+        if run.get("status") == "success" and run.get("docs_per_minute")
+    ]
+    return median(rates) if rates else None
+
+
+def estimate_indexing(files: list[dict], profile: IndexingPerformanceProfile = None, docs_per_minute: float = None) -> dict:
+    """
+    クロールしたファイルの一覧と実行設定から、インデクサーが処理する件数・サイズ・バッチ数・所要時間を見積もる.
+    拡張子ごとの件数・サイズも返し、除外する拡張子を決める材料にする.
+    """
+    profile = profile or IndexingPerformanceProfile()
+    docs_per_minute = docs_per_minute or estimated_docs_per_minute
+
+    counts, sizes = Counter(), Counter()
+    extensions = defaultdict(lambda: {"files": 0, "bytes": 0})
+    for file in files:
+        classification = profile.classify_file(file["name"], file["size"])
+        counts[classification] += 1
+        sizes[classification] += file["size"]
+        extension = os.path.splitext(file["name"])[1].lower() or "(none)"
+        extensions[extension]["files"] += 1
+        extensions[extension]["bytes"] += file["size"]
+
+    # メタデータのみのファイルも 1 件として処理される (Layout スキルは実行されない)
+    processed = counts["indexed"] + counts["metadata_only"]
+    batch_size = profile.batch_size or DEFAULT_BATCH_SIZE
+    average_bytes = sizes["indexed"] / counts["indexed"] if counts["indexed"] else 0
+    recommended_batch_size = max(1, min(1000, int(BATCH_TARGET_BYTES / average_bytes))) if average_bytes else None
+    return {
+        "files": len(files),
+        "indexed_files": counts["indexed"],
+        "metadata_only_files": counts["metadata_only"],
+        "failed_files": counts["failed"],
+        "excluded_files": counts["excluded"],
+        "indexed_mb": round(sizes["indexed"] / 1024 / 1024, 1),
+        "excluded_mb": round(sizes["excluded"] / 1024 / 1024, 1),
+        "batches": math.ceil(processed / batch_size),
+        "docs_per_minute": docs_per_minute,
+        "estimated_minutes": round(processed / docs_per_minute, 1),
+        "recommended_batch_size": recommended_batch_size,
+        "extensions": dict(sorted(extensions.items(), key=lambda item: item[1]["bytes"], reverse=True)[:TOP_EXTENSIONS]),
+    }
@@ -1,7 +1,10 @@
 import os
+import asyncio
 import logging
 import httpx
-from datetime import datetime, timedelta
+import isodate
+from urllib.parse import unquote
+from datetime import datetime
 from fastapi import HTTPException
 from azure.search.documents.indexes.models import (
     SearchIndex,
@@ -14,9 +17,14 @@ from azure.search.documents.indexes.models import (
     # ベクトル検索実装のためのクラス
     VectorSearch,
     HnswAlgorithmConfiguration,
+    HnswParameters,
+    ExhaustiveKnnAlgorithmConfiguration,
+    ExhaustiveKnnParameters,
     VectorSearchProfile,
     AzureOpenAIVectorizer,
     AzureOpenAIParameters,
+    ScalarQuantizationCompressionConfiguration,
+    ScalarQuantizationParameters,
     # スコアリングプロファイル実装のためのクラス
     ScoringProfile,
     FreshnessScoringFunction,
@@ -39,11 +47,214 @@ from azure.search.documents.indexes.models import (
     SearchIndexer,
     IndexingSchedule,
     IndexingParameters,
+    IndexingParametersConfiguration,
     FieldMapping,
     FieldMappingFunction,
+    SearchIndexerCache,
 )
+from search_profiles import IndexStorageProfile, VectorAlgorithmProfile, IndexingPerformanceProfile
+from resilience import ResilientAsyncTransport
+
+# サービス側が返さない・マスクして返す値 (差分比較の対象外)
+IGNORED_DEFINITION_KEYS = {"@odata.etag", "@odata.context", "startTime"}
+SECRET_DEFINITION_KEYS = {"connectionString", "storageConnectionString", "apiKey", "key"}
+# 既存フィールドで変更できない属性 (変更する場合はインデックスの再構築が必要)
+IMMUTABLE_FIELD_ATTRIBUTES = (
+    "type", "key", "searchable", "filterable", "sortable", "facetable",
+    "analyzer", "searchAnalyzer", "indexAnalyzer", "dimensions", "vectorSearchProfile", "stored",
+)
+# 既存のベクトルフィールドが参照するアルゴリズムで変更できない項目 (efSearch はクエリ時の値のため更新できる)
+IMMUTABLE_ALGORITHM_ATTRIBUTES = ("kind", "hnswParameters/m", "hnswParameters/efConstruction", "hnswParameters/metric", "exhaustiveKnnParameters/metric")
+
+
+# 設定した場合、全プロジェクトのチャンクを 1 つのインデックスに登録し、projectName フィールドで絞り込む (共有インデックスモード)
+# 未設定の場合はプロジェクトごとに {project}-index を作成する
+shared_index_name = os.getenv("SHARED_INDEX_NAME")
+
+# インデックスのキーフィールド
+KEY_FIELD = "site_library_document_Id"
+
+# カスタムスキル (/skills/*) の呼び出しを検証するヘッダー. WebApiSkill の httpHeaders で SKILL_API_KEY を送る
+SKILL_KEY_HEADER = "x-skill-key"
+skill_api_key = os.getenv("SKILL_API_KEY")
+
+
+def escape_odata_string(value: str) -> str:
+    """
+    OData フィルターの文字列リテラル用に、シングルクォートをエスケープする.
+    """
+    return value.replace("'", "''")
+
+
+def page_query(condition: str = None, cursor: tuple[str, int] = None) -> dict:
+    """
+    インデックスの全チャンクをページングで取得するための検索条件 (orderby / filter / skip).
+    キー (site_library_document_Id) は filterable ではないため範囲フィルターに使用できない.
+    documentId (filterable・sortable) の昇順・キーの昇順に並べ、cursor = (最後に取得した documentId, その documentId のうち取得済みの件数) の続きから取得する.
+    $skip は 1 つの documentId のチャンク数までしか使わないため、上限 (100,000) に達しない.
+    """
+    query = {"orderby": f"documentId asc, {KEY_FIELD} asc"}
+    if cursor is not None:
+        cursor_condition = f"documentId ge '{escape_odata_string(cursor[0])}'"
+        condition = f"({condition}) and {cursor_condition}" if condition else cursor_condition
+        query["skip"] = cursor[1]
+    if condition:
+        query["filter"] = condition
+    return query
+
+
+def advance_cursor(cursor: tuple[str, int] | None, documents: list[dict]) -> tuple[str, int]:
+    """
+    取得したページ (documentId を含む) から page_query の次の cursor を返す.
+    """
+    last_document_id = documents[-1]["documentId"]
+    seen = sum(1 for document in documents if document["documentId"] == last_document_id)
+    if cursor is not None and cursor[0] == last_document_id:
+        seen += cursor[1]
+    return last_document_id, seen
+
+
+def get_index_name(project_name: str) -> str:
+    """
+    プロジェクトのチャンクを登録するインデックス名を返す (共有インデックスモードでは全プロジェクト共通).
+    """
+    return shared_index_name or f"{project_name}-index"
+
+
+def get_project_index_name(project: dict) -> str:
+    """
+    プロジェクトのレコードが指す稼働中のインデックス名を返す.
+    再構築 (index_rebuild.IndexRebuilder) で切り替えた後は active_index ({project}-index-vN) を使用する.
+    """
+    return project.get("active_index") or get_index_name(project["project_name"])
+
+
+def project_filter(project_name: str, condition: str = None) -> str | None:
+    """
+    共有インデックスモードの場合、OData フィルター condition に projectName の条件を追加する.
+    プロジェクトごとのインデックスの場合は condition をそのまま返す.
+    """
+    if not shared_index_name:
+        return condition
+    project_condition = f"projectName eq '{escape_odata_string(project_name)}'"
+    return f"{project_condition} and ({condition})" if condition else project_condition
+
+
+def normalize_folder_path(folder_path: str) -> str:
+    """
+    フォルダのパスを、ライブラリのルートからの "/" 区切りの相対パス ("フォルダ/サブフォルダ") に正規化する.
+    """
+    return "/".join(part.strip() for part in folder_path.replace("\\", "/").split("/") if part.strip())
+
+
+def folder_path_prefixes(document_path: str) -> list[str]:
+    """
+    ドキュメントのパス ("/sites/{サイト}/{ライブラリ}/A/B/file.pdf", documentPath の形式) から、
+    親フォルダのパスの接頭辞 (["A", "A/B"]) を返す. folderPath フィールドに登録し、任意の階層のフォルダで絞り込むために使用する.
+    """
+    parts = [part for part in unquote(document_path or "").split("/") if part]
+    if len(parts) > 3 and parts[0] in ("sites", "teams"):
+        parts = parts[3:]
+    folders = parts[:-1]
+    return ["/".join(folders[:depth]) for depth in range(1, len(folders) + 1)]
+
+
+def _is_empty(value) -> bool:
+    return value is None or value == "" or value == [] or value == {}
+
+
+def diff_definitions(desired, current, path: str = "") -> list[str]:
+    """
+    目的の定義と現在の定義を比較し、差分のあるパスの一覧を返す.
+    目的の定義に含まれるキーのみを比較し、サーバーが付与する値 (ETag など) や
+    マスクされて返る秘密情報 (接続文字列・APIキー) は比較しない.
+    """
+    if isinstance(desired, dict):
+        if not isinstance(current, dict):
+            return [path or "/"]
+        differences = []
+        for key, value in desired.items():
+            if key in IGNORED_DEFINITION_KEYS:
+                continue
+            if key in SECRET_DEFINITION_KEYS and isinstance(value, str):
+                continue
+            differences += diff_definitions(value, current.get(key), f"{path}/{key}")
+        return differences
+
+    if isinstance(desired, list):
+        if not isinstance(current, list) or len(desired) != len(current):
+            return [] if _is_empty(desired) and _is_empty(current) else [path]
+        differences = []
+        for i, (desired_item, current_item) in enumerate(zip(desired, current)):
+            differences += diff_definitions(desired_item, current_item, f"{path}/{i}")
+        return differences
+
+    # 既定値のまま (未指定・空) の項目はサーバーが省略して返すことがあるため同一とみなす
+    if _is_empty(desired) and _is_empty(current):
+        return []
+    if current is None and desired in (False, 0, "none", "default"):
+        return []
+    if isinstance(desired, str) and isinstance(current, str):
+        return [] if desired.lower() == current.lower() else [path]
+    return [] if desired == current else [path]
+
+
+def find_breaking_index_changes(desired: dict, current: dict) -> list[str]:
+    """
+    インデックスの更新では反映できない変更 (既存フィールドの属性変更・フィールド削除) を返す.
+    フィールドの追加はインデックスを保持したまま更新できるため含めない.
+    """
+    current_fields = {field["name"]: field for field in current.get("fields", [])}
+    desired_fields = {field["name"]: field for field in desired.get("fields", [])}
+
+    breaking_changes = [f"fields/{name} (removed)" for name in current_fields if name not in desired_fields]
+    for name, field in desired_fields.items():
+        if name not in current_fields:
+            continue
+        for attribute in IMMUTABLE_FIELD_ATTRIBUTES:
+            if attribute in field and diff_definitions(field[attribute], current_fields[name].get(attribute)):
+                breaking_changes.append(f"fields/{name}/{attribute}")
+        if "vectorSearchProfile" in field:
+            breaking_changes += [
+                f"fields/{name}/algorithm/{attribute}"
+                for attribute in _find_algorithm_changes(field["vectorSearchProfile"], desired, current)
+            ]
+    return breaking_changes
+
+
+def _resolve_vector_algorithm(profile_name: str, index: dict) -> dict:
+    """
+    ベクトル検索プロファイル名から、参照しているアルゴリズム設定を返す.
+    """
+    vector_search = index.get("vectorSearch") or {}
+    profile = next((p for p in vector_search.get("profiles") or [] if p["name"] == profile_name), {})
+    return next((a for a in vector_search.get("algorithms") or [] if a["name"] == profile.get("algorithm")), {})
+
+
+def _get_definition_value(definition: dict, path: str):
+    for key in path.split("/"):
+        definition = (definition or {}).get(key)
+    return definition
+
+
+def _find_algorithm_changes(profile_name: str, desired: dict, current: dict) -> list[str]:
+    desired_algorithm = _resolve_vector_algorithm(profile_name, desired)
+    current_algorithm = _resolve_vector_algorithm(profile_name, current)
+    if not current_algorithm:
+        return []
+    return [
+        attribute for attribute in IMMUTABLE_ALGORITHM_ATTRIBUTES
+        if _get_definition_value(desired_algorithm, attribute) is not None
+        and diff_definitions(_get_definition_value(desired_algorithm, attribute), _get_definition_value(current_algorithm, attribute))
+    ]
+
 
 class ProjectIndexingService:
+    # Azure AI Search REST API のバージョン
+    api_version = "2024-05-01-preview"
+    # バイナリ量子化は 2024-07-01 以降でのみ利用できる
+    binary_quantization_api_version = "2024-07-01"
+
     def __init__(self):
         self.azure_search_endpoint = os.getenv("AZURE_SEARCH_ENDPOINT")
         self.azure_search_key = os.getenv("AZURE_SEARCH_ADMIN_KEY")
@@ -55,23 +266,84 @@ class ProjectIndexingService:
         self.ApplicationSecret = os.getenv("SPO_APPLICATION_SECRET")
         self.TenantId = os.getenv("SPO_TENANT_ID")
         self.azure_ai_service_account_key = os.getenv("AZURE_AI_SERVICE_ACCOUNT_KEY")
+        # 設定した場合、スキルセットの埋め込みを埋め込みキャッシュ付きのカスタムスキル (/skills/embeddings) で行う
+        self.embedding_skill_uri = os.getenv("EMBEDDING_SKILL_URI")
+        # フォルダのパスの接頭辞を返すカスタムスキル (/skills/path_prefixes) の URI. 未設定の場合は folderPath を登録しない
+        self.path_prefix_skill_uri = os.getenv("PATH_PREFIX_SKILL_URI")
+        # 設定した場合、インデクサーのエンリッチメントキャッシュを有効にする (メタデータのみの変更やリセット時に Layout を再実行しない)
+        self.indexer_cache_connection_string = os.getenv("INDEXER_CACHE_CONNECTION_STRING")
+        # インデクサーの実行間隔 (ISO 8601, PT5M〜P1D). 変更通知で反映する場合は "none" でスケジュール実行を止められる
+        self.indexer_schedule_interval = os.getenv("INDEXER_SCHEDULE_INTERVAL", "P1D")
+        # REST API 呼び出しで共有する AsyncClient (初回アクセス時に生成)
+        self._http_client: httpx.AsyncClient | None = None
+
+    @property
+    def http_client(self) -> httpx.AsyncClient:
+        """
+        Azure AI Search 向けの共有 AsyncClient を返す.
+        リクエストごとにクライアントを生成せず、コネクションプールを再利用する.
+        429 / 503 は Retry-After に従って再試行し、同時実行数はスロットリングに応じて調整する (上流 "search-indexing").
+        """
+        if self._http_client is None or self._http_client.is_closed:
+            self._http_client = httpx.AsyncClient(
+                base_url=self.azure_search_endpoint or "",
+                headers={
+                    "Content-Type": "application/json",
+                    "api-key": self.azure_search_key or "",
+                },
+                timeout=httpx.Timeout(60.0, connect=10.0),
+                transport=ResilientAsyncTransport(
+                    "search-indexing", limits=httpx.Limits(max_connections=20, max_keepalive_connections=10)
+                ),
+            )
+        return self._http_client
+
+    async def aclose(self):
+        """
+        共有 AsyncClient をクローズする (アプリケーション終了時に呼び出す).
+        """
+        if self._http_client is not None and not self._http_client.is_closed:
+            await self._http_client.aclose()
+        self._http_client = None
 
-    def create_project_index(self, project_name:str):
+    async def _put_resource(self, resource_path: str, payload: dict, resource_label: str):
+        """
+        REST API でリソースを作成または更新する. 失敗時は HTTPException を送出する.
+        """
+        response = await self.http_client.put(
+            resource_path,
+            params={"api-version": self.api_version},
+            json=payload,
+        )
+        if response.status_code not in (200, 201, 204):
+            raise HTTPException(
+                status_code=response.status_code,
+                detail=f"{resource_label}の作成に失敗しました: {response.text}"
+            )
+        return response
+
+    def create_project_index(self, project_name:str, index_profile:IndexStorageProfile=None, vector_profile:VectorAlgorithmProfile=None, index_name:str=None):
         """
         プロジェクト名とSPOのURLを入力して,入力に対して新しいインデックスを作成する.
+        index_profile でベクトル圧縮やテキストフィールドの重複排除を,
+        vector_profile でベクトル検索アルゴリズム (HNSW のパラメータ / 全件探索) を指定できる.
         """
         try:
             project_name = project_name
+            index_profile = index_profile or IndexStorageProfile()
             
             # フィールド定義
             fields = [
                 SearchableField(name="site_library_document_Id", type=SearchFieldDataType.String, key=True, sortable=True, stored=True, analyzer_name="keyword",searchable=True),
+                SimpleField(name="projectName", type=SearchFieldDataType.String, stored=True, filterable=True),
                 SimpleField(name="siteId", type=SearchFieldDataType.String,  stored=True, searchable=True),
                 SimpleField(name="libraryId", type=SearchFieldDataType.String,  stored=True, searchable=True),
                 SimpleField(name="documentId", type=SearchFieldDataType.String,  stored=True, searchable=True, sortable=True, filterable=True),
                 SearchableField(name="documentPath", type=SearchFieldDataType.String,  stored=True, searchable=True, filterable=True),
                 SimpleField(name="folderName", type=SearchFieldDataType.String,  stored=True, searchable=False, filterable=True),
                 SimpleField(name="subfolderName", type=SearchFieldDataType.String,  stored=True, searchable=False, filterable=True),
+                # 親フォルダのパスの接頭辞 (folderPath/any() で任意の階層のフォルダに絞り込む. ファセットはフォルダ一覧に使用する)
+                SimpleField(name="folderPath", type=SearchFieldDataType.Collection(SearchFieldDataType.String), stored=True, filterable=True, facetable=True),
                 SearchableField(name="documentName", type=SearchFieldDataType.String, stored=True, searchable=True, filterable=True),
                 SearchableField(name="documentUrl", type=SearchFieldDataType.String, stored=True, searchable=True, filterable=True),
                 SimpleField(name="last_modified", type=SearchFieldDataType.DateTimeOffset, filterable=True, sortable=True, stored=True),
@@ -85,18 +357,26 @@ class ProjectIndexingService:
                 SearchField(name="content_vector", 
                             type=SearchFieldDataType.Collection(SearchFieldDataType.Single), 
                             vector_search_dimensions=1536, 
-                            vector_search_profile_name="vector_profile"), 
+                            vector_search_profile_name=index_profile.vector_search_profile_name,
+                            stored=index_profile.store_raw_vector), 
             ]
+            # chunk は content と同じ内容のため、重複排除する場合は作成しない
+            if index_profile.dedupe_text_fields:
+                fields = [field for field in fields if field.name != "chunk"]
 
             # 高度な検索の実装
-            vector_search = self.create_vector_search()
+            vector_search = self.create_vector_search(
+                vector_search_profile_name=index_profile.vector_search_profile_name,
+                index_profile=index_profile,
+                vector_profile=vector_profile,
+            )
             #semantic_search = create_semantic_search()
             scoring_profiles, default_scoring_profile = self.create_scoring_profiles()
 
             logging.info("Success creating index")
 
             return SearchIndex(
-                name=f"{project_name}-index",
+                name=index_name or get_index_name(project_name),
                 fields = fields,
                 vector_search = vector_search, # 任意
                 # semantic_search = semantic_search, # 任意
@@ -108,30 +388,86 @@ class ProjectIndexingService:
         #index作成に失敗したときにログを表示
         except Exception as e:
             logging.error(f"Error creating index: {e}")
+            raise
+
+    def build_index_definition(self, project_name:str, index_profile:IndexStorageProfile=None, vector_profile:VectorAlgorithmProfile=None, index_name:str=None) -> dict:
+        """
+        インデックスの定義 (REST API のペイロード) を返す.
+        """
+        index_profile = index_profile or IndexStorageProfile()
+        index = self.create_project_index(project_name, index_profile, vector_profile, index_name).serialize()
+
+        # SDK (11.6.0b4) はバイナリ量子化に未対応のため REST のペイロードに直接追加する
+        if index_profile.compression == "binary":
+            index["vectorSearch"].setdefault("compressions", []).append({
+                "name": index_profile.compression_name,
+                "kind": "binaryQuantization",
+                "rerankWithOriginalVectors": index_profile.rerank_with_original_vectors,
+                "defaultOversampling": index_profile.oversampling,
+            })
+        return index
 
 
     def create_vector_search(
             self,
-            algorithm_name="vector-for-verification-algorithm",
+            algorithm_name=None,
             vector_search_profile_name="vector_profile",
-            vectorizer_name="myVectorizer"
+            vectorizer_name="myVectorizer",
+            index_profile:IndexStorageProfile=None,
+            vector_profile:VectorAlgorithmProfile=None,
         ):
         """
         azure-search-documents==11.6.0b4
+        index_profile でスカラー量子化を指定した場合は圧縮設定をプロファイルに関連付ける.
+        (バイナリ量子化は build_index_definition で REST のペイロードに追加する)
+        vector_profile で HNSW のパラメータ (m, efConstruction, efSearch, metric) または全件探索を指定する.
         """        
+        index_profile = index_profile or IndexStorageProfile()
+        vector_profile = vector_profile or VectorAlgorithmProfile()
+        algorithm_name = algorithm_name or vector_profile.algorithm_name
         resource_url = self.openai_embedding_uri
         deployment_id = self.openai_embedding_model_name
         api_key = self.openai_embedding_key
         model_name = self.openai_embedding_model_name
 
+        # ベクトル圧縮の設定
+        compressions = []
+        if index_profile.compression == "scalar":
+            compressions.append(
+                ScalarQuantizationCompressionConfiguration(
+                    name=index_profile.compression_name,
+                    rerank_with_original_vectors=index_profile.rerank_with_original_vectors,
+                    default_oversampling=index_profile.oversampling,
+                    parameters=ScalarQuantizationParameters(quantized_data_type="int8"),
+                )
+            )
+
+        # ベクトル検索アルゴリズムの設定
+        if vector_profile.kind == "exhaustiveKnn":
+            algorithm = ExhaustiveKnnAlgorithmConfiguration(
+                name=algorithm_name,
+                parameters=ExhaustiveKnnParameters(metric=vector_profile.metric),
+            )
+        else:
+            algorithm = HnswAlgorithmConfiguration(
+                name=algorithm_name,
+                parameters=HnswParameters(
+                    m=vector_profile.m,
+                    ef_construction=vector_profile.ef_construction,
+                    ef_search=vector_profile.ef_search,
+                    metric=vector_profile.metric,
+                ),
+            )
+
         # VectorSearch 設定
         vector_search = VectorSearch(
-            algorithms=[HnswAlgorithmConfiguration(name=algorithm_name)],
+            algorithms=[algorithm],
             profiles=[
                 VectorSearchProfile(
                     name=vector_search_profile_name,
                     algorithm_configuration_name=algorithm_name,
                     vectorizer=vectorizer_name,
+                    compression_configuration_name=index_profile.compression_name,
                 )
             ],
             vectorizers=[
@@ -145,6 +481,7 @@ class ProjectIndexingService:
                     ),
                 )
             ],
+            compressions=compressions or None,
         )
 
         return vector_search
@@ -181,182 +518,229 @@ class ProjectIndexingService:
 
         return scoring_profiles, default_scoring_profile
     
+    def build_data_source_definition(self, project_name:str, spo_url:str) -> dict:
+        """
+        SharePoint Online を参照するデータソースの定義 (REST API のペイロード) を返す.
+        """
+        data_source_name = f"{project_name}-datasource"
+        sharepoint_connection_string = f"SharePointOnlineEndpoint={spo_url};ApplicationId={self.ApplicationId};ApplicationSecret={self.ApplicationSecret};TenantId={self.TenantId};" #社内用 URL version
+        # https://intelligentforce0401.sharepoint.com/sites/Test/Shared%20Documents/Forms/AllItems.aspx?id=%2Fsites%2FTest%2FShared%20Documents%2Ftest&viewid=d0948e95%2D5e9a%2D43cc%2D8630%2D6006ca74a7e3
+        # sharepoint_connection_string = f"SharePointOnlineEndpoint=https://intelligentforce0401.sharepoint.com/sites/{project_name};ApplicationId={ApplicationId};ApplicationSecret={ApplicationSecret};TenantId={TenantId};" #社内用
+        # sharepoint_connection_string = f"SharePointOnlineEndpoint={spo_url};ApplicationId={ApplicationId};ApplicationSecret={ApplicationSecret};TenantId={TenantId};" #社外用
+
+        return {
+            "name": data_source_name,
+            "type": "sharepoint",
+            "credentials": {
+                "connectionString": sharepoint_connection_string
+            },
+            "container": {
+                "name": "defaultSiteLibrary"
+            }
+        }
+
     # Datasource の作成 (非同期)   
     async def create_project_data_source(self, project_name:str, spo_url:str):
         """
         Create a datasource
         """
         try:
-            data_source_name = f"{project_name}-datasource"
-            spo_url = spo_url
-            sharepoint_connection_string = f"SharePointOnlineEndpoint={spo_url};ApplicationId={self.ApplicationId};ApplicationSecret={self.ApplicationSecret};TenantId={self.TenantId};" #社内用 URL version
-            # https://intelligentforce0401.sharepoint.com/sites/Test/Shared%20Documents/Forms/AllItems.aspx?id=%2Fsites%2FTest%2FShared%20Documents%2Ftest&viewid=d0948e95%2D5e9a%2D43cc%2D8630%2D6006ca74a7e3
-            # sharepoint_connection_string = f"SharePointOnlineEndpoint=https://intelligentforce0401.sharepoint.com/sites/{project_name};ApplicationId={ApplicationId};ApplicationSecret={ApplicationSecret};TenantId={TenantId};" #社内用
-            # sharepoint_connection_string = f"SharePointOnlineEndpoint={spo_url};ApplicationId={ApplicationId};ApplicationSecret={ApplicationSecret};TenantId={TenantId};" #社外用
-            
-            # Datasource の作成 (非同期)       
-            data_source_payload = {
-                "name": data_source_name,
-                "type": "sharepoint",
-                "credentials": {
-                    "connectionString": sharepoint_connection_string
-                },
-                "container": {
-                    "name": "defaultSiteLibrary"
-                }
-            }
-
-            headers = {
-                "Content-Type": "application/json",
-                "api-key": self.azure_search_key,
-            }
+            data_source_payload = self.build_data_source_definition(project_name, spo_url)
 
-            # リクエストを送信
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    f"{self.azure_search_endpoint}/datasources?api-version=2024-05-01-preview",
-                    json=data_source_payload,
-                    headers=headers
-                )
-                if response.status_code != 201:
-                    raise HTTPException(
-                        status_code=response.status_code,
-                        detail=f"データソースの作成に失敗しました: {response.json()}"
-                    )
+            # リクエストを送信 (共有クライアントを使用)
+            await self._put_resource(f"/datasources('{data_source_payload['name']}')", data_source_payload, "データソース")
             logging.info("Success creating datasource")
 
-        #データソース作成に失敗したときにログを表示
+        #データソース作成に失敗したときにログを表示し、呼び出し元へ送出する
         except Exception as e:
             logging.error(f"Error creating datasource: {e}")
+            raise
 
-    
-    async def create_project_skillset_layout(self, project_name:str):
+    def build_skillset_definition(self, project_name:str, index_profile:IndexStorageProfile=None, index_name:str=None) -> dict:
         """
-        Create a skillset
+        Layout スキル + 分割 + 埋め込みを行うスキルセットの定義 (REST API のペイロード) を返す.
         """
-        try:
-            skillset_name = f"{project_name}-skillset"
-            index_name = f"{project_name}-index"
-
-            # スキルセット定義 
-            skillset_payload = {
-                "name": skillset_name,
-                "skills": [
-                    # DocumentIntelligenceLayoutSkill
-                    {
-                        "@odata.type": "#Microsoft.Skills.Util.DocumentIntelligenceLayoutSkill",
-                        "name": "my_document_intelligence_layout_skill",
-                        "description": "use layout model",
-                        "context": "/document",
-                        "inputs": [
-                            {"name": "file_data", "source": "/document/file_data", "inputs": []}
-                        ],
-                        "outputs": [
-                            {"name": "markdown_document", "targetName": "markdownDocument"}
-                        ],
-                        "outputMode": "oneToMany",
-                        "markdownHeaderDepth": "h3",
-                    },
-                    # SplitSkill
-                    {
-                        "@odata.type": "#Microsoft.Skills.Text.SplitSkill",
-                        "name": "my_text_split_skill",
-                        "description": "split a document",
-                        "context": "/document/markdownDocument/*",
-                        "inputs": [
-                            {
-                                "name": "text",
-                                "source": "/document/markdownDocument/*/content",
-                                "inputs": [],
-                            }
-                        ],
-                        "outputs": [{"name": "textItems", "targetName": "chunks"}],
-                        "defaultLanguageCode": "ja",
-                        "textSplitMode": "pages",
-                        "maximumPageLength": 2000,
-                        "pageOverlapLength": 500,
-                    },
-                    # AzureOpenAIEmbeddingSkill
-                    {
-                        "@odata.type": "#Microsoft.Skills.Text.AzureOpenAIEmbeddingSkill",
-                        "name": "my_azure_openai_embedding_skill",
-                        "context": "/document/markdownDocument/*/chunks/*",
-                        "inputs": [
-                            {"name": "text", "source": "/document/markdownDocument/*/chunks/*"}
-                        ],
-                        "outputs": [{"name": "embedding", "targetName": "vector"}],
-                        "resourceUri": self.openai_embedding_uri,
-                        "deploymentId": "text-embedding-ada-002",
-                        "apiKey": self.openai_embedding_key,
-                        "modelName": "text-embedding-ada-002",
-                        "dimensions": 1536,
-                    },
-                ],
-                "cognitiveServices": {
-                    "@odata.type": "#Microsoft.Azure.Search.CognitiveServicesByKey",
-                    "key":self.azure_ai_service_account_key,
-                    },
-                "@odata.etag": '"0x8DD180AC7B87C4D"',
-                "indexProjections": {
-                    "selectors": [
+        index_profile = index_profile or IndexStorageProfile()
+        skillset_name = f"{project_name}-skillset"
+        index_name = index_name or get_index_name(project_name)
+
+        # スキルセット定義 
+        skillset_payload = {
+            "name": skillset_name,
+            "skills": [
+                # DocumentIntelligenceLayoutSkill
+                {
+                    "@odata.type": "#Microsoft.Skills.Util.DocumentIntelligenceLayoutSkill",
+                    "name": "my_document_intelligence_layout_skill",
+                    "description": "use layout model",
+                    "context": "/document",
+                    "inputs": [
+                        {"name": "file_data", "source": "/document/file_data", "inputs": []}
+                    ],
+                    "outputs": [
+                        {"name": "markdown_document", "targetName": "markdownDocument"}
+                    ],
+                    "outputMode": "oneToMany",
+                    "markdownHeaderDepth": "h3",
+                },
+                # SplitSkill
+                {
+                    "@odata.type": "#Microsoft.Skills.Text.SplitSkill",
+                    "name": "my_text_split_skill",
+                    "description": "split a document",
+                    "context": "/document/markdownDocument/*",
+                    "inputs": [
                         {
-                            "targetIndexName": index_name,
-                            "parentKeyFieldName": "parent_id",
-                            "sourceContext": "/document/markdownDocument/*/chunks/*",
-                            "mappings": [
-                                {"name": "siteId", "source": "/document/metadata_spo_site_id"},
-                                {"name": "libraryId", "source": "/document/metadata_spo_library_id"},
-                                {"name": "documentId", "source": "/document/metadata_spo_item_id"},
-                                {"name": "documentPath", "source": "/document/metadata_spo_item_path"},
-                                {"name": "folderName", "source": "/document/folderName"},
-                                {"name": "subfolderName", "source": "/document/subfolderName"}, 
-                                {"name": "documentName", "source": "/document/metadata_spo_item_name"},
-                                {"name": "documentUrl", "source": "/document/metadata_spo_item_weburi"},
-                                {"name": "last_modified", "source": "/document/metadata_spo_item_last_modified"},
-                                {"name": "size", "source": "/document/metadata_spo_item_size"},
-                                {"name": "content", "source": "/document/markdownDocument/*/chunks/*"},
-                                {"name": "chunk", "source": "/document/markdownDocument/*/chunks/*"},
-                                {"name": "header_1", "source": "/document/markdownDocument/*/sections/h1"},
-                                {"name": "header_2", "source": "/document/markdownDocument/*/sections/h2"},
-                                {"name": "header_3", "source": "/document/markdownDocument/*/sections/h3"},
-                                {"name": "content_vector", "source": "/document/markdownDocument/*/chunks/*/vector"},
-                            ],
+                            "name": "text",
+                            "source": "/document/markdownDocument/*/content",
+                            "inputs": [],
                         }
                     ],
-                    "parameters": {"projectionMode": "skipIndexingParentDocuments"},
+                    "outputs": [{"name": "textItems", "targetName": "chunks"}],
+                    "defaultLanguageCode": "ja",
+                    "textSplitMode": "pages",
+                    "maximumPageLength": 2000,
+                    "pageOverlapLength": 500,
                 },
-            }
+                # AzureOpenAIEmbeddingSkill
+                {
+                    "@odata.type": "#Microsoft.Skills.Text.AzureOpenAIEmbeddingSkill",
+                    "name": "my_azure_openai_embedding_skill",
+                    "context": "/document/markdownDocument/*/chunks/*",
+                    "inputs": [
+                        {"name": "text", "source": "/document/markdownDocument/*/chunks/*"}
+                    ],
+                    "outputs": [{"name": "embedding", "targetName": "vector"}],
+                    "resourceUri": self.openai_embedding_uri,
+                    "deploymentId": "text-embedding-ada-002",
+                    "apiKey": self.openai_embedding_key,
+                    "modelName": "text-embedding-ada-002",
+                    "dimensions": 1536,
+                },
+            ],
+            "cognitiveServices": {
+                "@odata.type": "#Microsoft.Azure.Search.CognitiveServicesByKey",
+                "key":self.azure_ai_service_account_key,
+                },
+            "indexProjections": {
+                "selectors": [
+                    {
+                        "targetIndexName": index_name,
+                        "parentKeyFieldName": "parent_id",
+                        "sourceContext": "/document/markdownDocument/*/chunks/*",
+                        "mappings": [
+                            {"name": "siteId", "source": "/document/metadata_spo_site_id"},
+                            {"name": "libraryId", "source": "/document/metadata_spo_library_id"},
+                            {"name": "documentId", "source": "/document/metadata_spo_item_id"},
+                            {"name": "documentPath", "source": "/document/metadata_spo_item_path"},
+                            {"name": "folderName", "source": "/document/folderName"},
+                            {"name": "subfolderName", "source": "/document/subfolderName"}, 
+                            {"name": "documentName", "source": "/document/metadata_spo_item_name"},
+                            {"name": "documentUrl", "source": "/document/metadata_spo_item_weburi"},
+                            {"name": "last_modified", "source": "/document/metadata_spo_item_last_modified"},
+                            {"name": "size", "source": "/document/metadata_spo_item_size"},
+                            {"name": "content", "source": "/document/markdownDocument/*/chunks/*"},
+                            {"name": "chunk", "source": "/document/markdownDocument/*/chunks/*"},
+                            {"name": "header_1", "source": "/document/markdownDocument/*/sections/h1"},
+                            {"name": "header_2", "source": "/document/markdownDocument/*/sections/h2"},
+                            {"name": "header_3", "source": "/document/markdownDocument/*/sections/h3"},
+                            {"name": "content_vector", "source": "/document/markdownDocument/*/chunks/*/vector"},
+                        ],
+                    }
+                ],
+                "parameters": {"projectionMode": "skipIndexingParentDocuments"},
+            },
+        }
 
-            # APIヘッダー
-            headers = {
-                "Content-Type": "application/json",
-                "api-key": self.azure_search_key,
+        # 変更のないチャンクの再埋め込みを避けるため、埋め込みキャッシュ付きのカスタムスキルに置き換える
+        if self.embedding_skill_uri:
+            if not skill_api_key:
+                logging.warning("SKILL_API_KEY が未設定のため、埋め込みスキルの呼び出しは拒否されます")
+            skillset_payload["skills"][2] = {
+                "@odata.type": "#Microsoft.Skills.Custom.WebApiSkill",
+                "name": "my_cached_embedding_skill",
+                "description": "embed chunks with a content-hash cache",
+                "context": "/document/markdownDocument/*/chunks/*",
+                "uri": self.embedding_skill_uri,
+                "httpMethod": "POST",
+                "httpHeaders": {SKILL_KEY_HEADER: skill_api_key or ""},
+                "timeout": "PT230S",
+                "batchSize": 16,
+                "inputs": [
+                    {"name": "text", "source": "/document/markdownDocument/*/chunks/*"}
+                ],
+                "outputs": [{"name": "embedding", "targetName": "vector"}],
             }
 
-                # リクエストを送信
-            async with httpx.AsyncClient() as client:
-                response = await client.put(
-                    f"{self.azure_search_endpoint}/skillsets('{skillset_name}')?api-version=2024-05-01-preview",
-                    json=skillset_payload,
-                    headers=headers
-                )
-                if response.status_code != 201:
-                    raise HTTPException(
-                        status_code=response.status_code,
-                        detail=f"スキルセットの作成に失敗しました: {response.json()}"
-                    )
+        # 共有インデックスの場合は projectName に定数を設定する (フィールドマッピングでは定数を設定できないため ConditionalSkill を使用する)
+        if shared_index_name:
+            project_literal = escape_odata_string(project_name)
+            skillset_payload["skills"].append({
+                "@odata.type": "#Microsoft.Skills.Util.ConditionalSkill",
+                "name": "my_project_name_skill",
+                "description": "set the project name",
+                "context": "/document",
+                "inputs": [
+                    {"name": "condition", "source": "= true"},
+                    {"name": "whenTrue", "source": f"= '{project_literal}'"},
+                    {"name": "whenFalse", "source": f"= '{project_literal}'"},
+                ],
+                "outputs": [{"name": "output", "targetName": "projectName"}],
+            })
+            skillset_payload["indexProjections"]["selectors"][0]["mappings"].insert(
+                0, {"name": "projectName", "source": "/document/projectName"}
+            )
+
+        # 親フォルダのパスの接頭辞はドキュメント単位で 1 回だけ計算し、各チャンクにマッピングする
+        if self.path_prefix_skill_uri:
+            skillset_payload["skills"].append({
+                "@odata.type": "#Microsoft.Skills.Custom.WebApiSkill",
+                "name": "my_folder_path_skill",
+                "description": "compute folder path prefixes",
+                "context": "/document",
+                "uri": self.path_prefix_skill_uri,
+                "httpMethod": "POST",
+                "httpHeaders": {SKILL_KEY_HEADER: skill_api_key or ""},
+                "timeout": "PT30S",
+                "batchSize": 100,
+                "inputs": [
+                    {"name": "path", "source": "/document/metadata_spo_item_path"}
+                ],
+                "outputs": [{"name": "folderPath", "targetName": "folderPath"}],
+            })
+            skillset_payload["indexProjections"]["selectors"][0]["mappings"].append(
+                {"name": "folderPath", "source": "/document/folderPath"}
+            )
+
+        # chunk フィールドを作成しない場合はマッピングからも除外する
+        if index_profile.dedupe_text_fields:
+            selector = skillset_payload["indexProjections"]["selectors"][0]
+            selector["mappings"] = [mapping for mapping in selector["mappings"] if mapping["name"] != "chunk"]
+        return skillset_payload
+
+    async def create_project_skillset_layout(self, project_name:str):
+        """
+        Create a skillset
+        """
+        try:
+            skillset_payload = self.build_skillset_definition(project_name)
+            skillset_name = skillset_payload["name"]
+
+            # リクエストを送信 (共有クライアントを使用)
+            await self._put_resource(f"/skillsets('{skillset_name}')", skillset_payload, "スキルセット")
             logging.info("Success creating skillset")
 
-        #スキルセット作成に失敗したときにログを表示    
+        #スキルセット作成に失敗したときにログを表示し、呼び出し元へ送出する
         except Exception as e:
             logging.error(f"Error creating skillset: {e}")
+            raise
 
     
     def create_project_skillset(self, project_name:str):
         """
         Create a skillset
         """  
-        index_name = f"{project_name}-index"
+        index_name = get_index_name(project_name)
         skillset_name = f"{project_name}-skillset"
 
         # テキストのchunking
@@ -431,35 +815,53 @@ class ProjectIndexingService:
         )
     
 
-    def create_project_indexer(self, project_name:str):
+    def build_indexer_schedule(self) -> IndexingSchedule | None:
+        """
+        インデクサーのスケジュールを返す. INDEXER_SCHEDULE_INTERVAL="none" の場合はスケジュールなし (None).
+        """
+        if self.indexer_schedule_interval.lower() == "none":
+            return None
+        return IndexingSchedule(
+            interval=isodate.parse_duration(self.indexer_schedule_interval),
+            start_time=datetime.utcnow()  # 現在のUTC時刻から開始
+        )
+
+    def build_indexing_parameters(self, performance_profile:IndexingPerformanceProfile=None) -> IndexingParameters:
+        """
+        インデクサーのパラメータ (バッチサイズ・失敗の許容数・対象とする拡張子) を返す.
+        """
+        performance_profile = performance_profile or IndexingPerformanceProfile()
+        return IndexingParameters(
+            batch_size=performance_profile.batch_size,
+            max_failed_items=performance_profile.max_failed_items,
+            max_failed_items_per_batch=performance_profile.max_failed_items_per_batch,
+            configuration=IndexingParametersConfiguration(
+                data_to_extract="contentAndMetadata",
+                image_action="none",
+                index_storage_metadata_only_for_oversized_documents=performance_profile.index_metadata_only_for_oversized_documents,
+                fail_on_unsupported_content_type=False,
+                allow_skillset_to_read_file_data=True,
+                indexed_file_name_extensions=",".join(performance_profile.indexed_file_name_extensions) or None,
+                excluded_file_name_extensions=",".join(performance_profile.excluded_file_name_extensions) or None,
+            ),
+        )
+
+    def create_project_indexer(self, project_name:str, performance_profile:IndexingPerformanceProfile=None, index_name:str=None):
         """
         Create a indexer
         """
         try:
             # Create an indexer for project
-            index_name = f"{project_name}-index" 
+            index_name = index_name or get_index_name(project_name)
             indexer_name = f"{project_name}-indexer" 
             skillset_name = f"{project_name}-skillset" 
             data_source_name = f"{project_name}-datasource"  
 
-            #インデクサーのスケジュールを設定（1日1回、現在時刻から開始）
-            schedule = IndexingSchedule(
-                interval=timedelta(days=1),  # 1日1回実行
-                start_time=datetime.utcnow()  # 現在のUTC時刻から開始
-            )
+            #インデクサーのスケジュールを設定（INDEXER_SCHEDULE_INTERVAL、既定は1日1回）
+            schedule = self.build_indexer_schedule()
 
             #fileデータをスキルセットに送る設定
-            indexer_parameters = IndexingParameters(
-                max_failed_items=-1,
-                max_failed_items_per_batch=-1,
-                configuration={
-                "dataToExtract": "contentAndMetadata",
-                "imageAction": "none",
-                "indexStorageMetadataOnlyForOversizedDocuments": True,
-                "failOnUnsupportedContentType": False,
-                "allowSkillsetToReadFileData": True
-            }
-            )
+            indexer_parameters = self.build_indexing_parameters(performance_profile)
 
             folder_field_mappings_function = FieldMappingFunction(
                 name="extractTokenAtPosition",
@@ -479,7 +881,7 @@ class ProjectIndexingService:
                 name="extractTokenAtPosition",
                 parameters={
                     "delimiter": "/",
-                    "position": 4
+                    "position": 5
                 }
             )
 
@@ -507,37 +909,25 @@ class ProjectIndexingService:
         
         except Exception as e:
             logging.error(f"Error creating indexer: {e}")
+            raise
 
 
-    def create_project_folder_indexer(self, project_name:str):
+    def create_project_folder_indexer(self, project_name:str, performance_profile:IndexingPerformanceProfile=None, index_name:str=None):
         """
         Create a indexer
         """
         try:
             # Create an indexer for project
-            index_name = f"{project_name}-index" 
+            index_name = index_name or get_index_name(project_name)
             indexer_name = f"{project_name}-indexer" 
             skillset_name = f"{project_name}-skillset" 
             data_source_name = f"{project_name}-datasource"  
 
-            #インデクサーのスケジュールを設定（1日1回、現在時刻から開始）
-            schedule = IndexingSchedule(
-                interval=timedelta(days=1),  # 1日1回実行
-                start_time=datetime.utcnow()  # 現在のUTC時刻から開始
-            )
+            #インデクサーのスケジュールを設定（INDEXER_SCHEDULE_INTERVAL、既定は1日1回）
+            schedule = self.build_indexer_schedule()
 
             #fileデータをスキルセットに送る設定
-            indexer_parameters = IndexingParameters(
-                max_failed_items=-1,
-                max_failed_items_per_batch=-1,
-                configuration={
-                "dataToExtract": "contentAndMetadata",
-                "imageAction": "none",
-                "indexStorageMetadataOnlyForOversizedDocuments": True,
-                "failOnUnsupportedContentType": False,
-                "allowSkillsetToReadFileData": True
-            }
-            )
+            indexer_parameters = self.build_indexing_parameters(performance_profile)
 
             folder_field_mappings_function = FieldMappingFunction(
                 name="extractTokenAtPosition",
@@ -584,4 +974,263 @@ class ProjectIndexingService:
             return indexer 
         
         except Exception as e:
-            logging.error(f"Error creating indexer: {e}")
\ No newline at end of file
+            logging.error(f"Error creating indexer: {e}")
+            raise
+
+
+    def build_indexer_definition(self, project_name:str, include_root_files:bool, performance_profile:IndexingPerformanceProfile=None, index_name:str=None) -> dict:
+        """
+        インデクサーの定義 (REST API のペイロード) を返す.
+        """
+        if include_root_files:
+            indexer = self.create_project_indexer(project_name, performance_profile, index_name)
+        else:
+            indexer = self.create_project_folder_indexer(project_name, performance_profile, index_name)
+        if self.indexer_cache_connection_string:
+            indexer.cache = SearchIndexerCache(
+                storage_connection_string=self.indexer_cache_connection_string,
+                enable_reprocessing=True,
+            )
+        indexer_payload = indexer.serialize()
+        # スケジュールを無効にした場合、既存のスケジュールも削除されるよう明示的に null を送る
+        indexer_payload.setdefault("schedule", None)
+        # 同様に、バッチサイズ・拡張子の指定を外した場合も既存の値が残らないようにする
+        indexer_payload["parameters"].setdefault("batchSize", None)
+        for key in ("indexedFileNameExtensions", "excludedFileNameExtensions"):
+            indexer_payload["parameters"]["configuration"].setdefault(key, None)
+        return indexer_payload
+
+    async def _get_resource(self, resource_path: str, api_version: str = None) -> dict | None:
+        """
+        REST API で現在のリソース定義を取得する. 存在しない場合は None を返す.
+        """
+        response = await self.http_client.get(resource_path, params={"api-version": api_version or self.api_version})
+        if response.status_code == 404:
+            return None
+        if response.status_code != 200:
+            raise HTTPException(
+                status_code=response.status_code,
+                detail=f"リソース定義の取得に失敗しました ({resource_path}): {response.text}"
+            )
+        return response.json()
+
+    async def _apply_resource(self, resource_path: str, payload: dict, resource_label: str, etag: str | None, api_version: str = None):
+        """
+        ETag による楽観的同時実行制御付きでリソースを作成または更新する.
+        etag が None の場合は新規作成のみ (If-None-Match: *), それ以外は If-Match で更新する.
+        """
+        headers = {"If-Match": etag} if etag else {"If-None-Match": "*"}
+        response = await self.http_client.put(
+            resource_path,
+            params={"api-version": api_version or self.api_version},
+            json=payload,
+            headers=headers,
+        )
+        if response.status_code == 412:
+            raise HTTPException(
+                status_code=409,
+                detail=f"{resource_label}は別の処理によって更新されています. 再度登録してください."
+            )
+        if response.status_code not in (200, 201, 204):
+            raise HTTPException(
+                status_code=response.status_code,
+                detail=f"{resource_label}の更新に失敗しました: {response.text}"
+            )
+
+    async def _reconcile_resource(self, resource_path: str, desired: dict, resource_label: str) -> str:
+        """
+        現在の定義と目的の定義を比較し、必要な場合のみ作成・更新する.
+        戻り値は "created" / "updated" / "unchanged" のいずれか.
+        """
+        current = await self._get_resource(resource_path)
+        if current is None:
+            await self._apply_resource(resource_path, desired, resource_label, etag=None)
+            logging.info(f"{resource_label} '{desired['name']}' を作成しました")
+            return "created"
+
+        differences = diff_definitions(desired, current)
+        if not differences:
+            logging.info(f"{resource_label} '{desired['name']}' に変更はありません")
+            return "unchanged"
+
+        await self._apply_resource(resource_path, desired, resource_label, etag=current.get("@odata.etag"))
+        logging.info(f"{resource_label} '{desired['name']}' を更新しました: {differences}")
+        return "updated"
+
+    async def _reconcile_index(self, desired: dict, allow_index_rebuild: bool, api_version: str = None) -> str:
+        """
+        インデックスを差分更新する.
+        フィールドの追加やスコアリング設定の変更はその場で更新し、ドキュメントは保持する.
+        既存フィールドの属性変更や削除など、更新では反映できない変更がある場合は
+        allow_index_rebuild=True のときのみ削除・再作成し、それ以外は "rebuild_required" を返す.
+        """
+        resource_path = f"/indexes('{desired['name']}')"
+        current = await self._get_resource(resource_path, api_version)
+        if current is None:
+            await self._apply_resource(resource_path, desired, "インデックス", etag=None, api_version=api_version)
+            logging.info(f"インデックス '{desired['name']}' を作成しました")
+            return "created"
+
+        breaking_changes = find_breaking_index_changes(desired, current)
+        if breaking_changes:
+            if not allow_index_rebuild:
+                logging.warning(f"インデックス '{desired['name']}' は再構築が必要な変更を含むため更新しません: {breaking_changes}")
+                return "rebuild_required"
+            response = await self.http_client.delete(
+                resource_path,
+                params={"api-version": api_version or self.api_version},
+                headers={"If-Match": current.get("@odata.etag", "*")},
+            )
+            if response.status_code not in (204, 404):
+                raise HTTPException(
+                    status_code=response.status_code,
+                    detail=f"インデックスの削除に失敗しました: {response.text}"
+                )
+            await self._apply_resource(resource_path, desired, "インデックス", etag=None, api_version=api_version)
+            logging.warning(f"インデックス '{desired['name']}' を再構築しました: {breaking_changes}")
+            return "rebuilt"
+
+        differences = diff_definitions(desired, current)
+        if not differences:
+            logging.info(f"インデックス '{desired['name']}' に変更はありません")
+            return "unchanged"
+
+        await self._apply_resource(resource_path, desired, "インデックス", etag=current.get("@odata.etag"), api_version=api_version)
+        logging.info(f"インデックス '{desired['name']}' を更新しました: {differences}")
+        return "updated"
+
+    async def reconcile_project_resources(
+            self,
+            project_name:str,
+            spo_url:str,
+            include_root_files:bool,
+            index_profile:IndexStorageProfile=None,
+            vector_profile:VectorAlgorithmProfile=None,
+            allow_index_rebuild:bool=False,
+            performance_profile:IndexingPerformanceProfile=None,
+            index_name:str=None,
+        ) -> dict:
+        """
+        プロジェクトの検索リソース (datasource, index, skillset, indexer) を目的の定義に収束させる.
+        datasource, index, skillset は互いに独立しているため並列に処理し、
+        それらをすべて参照する indexer は最後に処理する.
+        index_name には稼働中のインデックス (get_project_index_name) を指定する (未指定の場合は {project}-index).
+        いずれかの処理に失敗した場合は、並列タスクの完了を待ってから最初の例外を送出する.
+
+        Returns:
+            dict: リソース種別ごとの実行結果 ("created" / "updated" / "unchanged" / "rebuilt" / "rebuild_required")
+        """
+        index_profile = index_profile or IndexStorageProfile()
+        data_source = self.build_data_source_definition(project_name, spo_url)
+        index = self.build_index_definition(project_name, index_profile, vector_profile, index_name)
+        skillset = self.build_skillset_definition(project_name, index_profile, index_name)
+        index_api_version = self.binary_quantization_api_version if index_profile.compression == "binary" else None
+        if shared_index_name and allow_index_rebuild:
+            # 共有インデックスを再構築すると全プロジェクトのドキュメントが失われるため、再構築は行わない
+            logging.warning(f"共有インデックス '{shared_index_name}' は再構築できません")
+            allow_index_rebuild = False
+
+        results = await asyncio.gather(
+            self._reconcile_resource(f"/datasources('{data_source['name']}')", data_source, "データソース"),
+            self._reconcile_index(index, allow_index_rebuild, index_api_version),
+            self._reconcile_resource(f"/skillsets('{skillset['name']}')", skillset, "スキルセット"),
+            return_exceptions=True,
+        )
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors:
+            raise errors[0]
+        actions = dict(zip(["datasource", "index", "skillset"], results))
+
+        indexer = self.build_indexer_definition(project_name, include_root_files, performance_profile, index_name)
+        actions["indexer"] = await self._reconcile_resource(f"/indexers('{indexer['name']}')", indexer, "インデクサー")
+        return actions
+
+    async def run_project_indexer(self, project_name:str, reset:bool=False):
+        """
+        インデクサーを実行する. reset=True の場合は変更追跡状態をリセットし、全ドキュメントを再処理する.
+        """
+        indexer_name = f"{project_name}-indexer"
+        if reset:
+            response = await self.http_client.post(f"/indexers('{indexer_name}')/search.reset", params={"api-version": self.api_version})
+            if response.status_code != 204:
+                raise HTTPException(status_code=response.status_code, detail=f"インデクサーのリセットに失敗しました: {response.text}")
+        response = await self.http_client.post(f"/indexers('{indexer_name}')/search.run", params={"api-version": self.api_version})
+        if response.status_code != 202:
+            raise HTTPException(status_code=response.status_code, detail=f"インデクサーの実行に失敗しました: {response.text}")
+        logging.info(f"インデクサー '{indexer_name}' を実行しました (reset={reset})")
+
+    async def find_indexed_documents(self, project_name:str, field:str, values:list[str], index_name:str=None) -> dict[str, dict | None]:
+        """
+        インデックスから field (documentPath, documentUrl, documentId) が一致するファイルのチャンクを 1 件ずつ取得する.
+        見つからない値は None.
+        """
+        index_name = index_name or get_index_name(project_name)
+
+        async def find(value: str):
+            response = await self.http_client.post(
+                f"/indexes('{index_name}')/docs/search.post.search",
+                params={"api-version": self.api_version},
+                json={
+                    "search": "*",
+                    "filter": project_filter(project_name, f"{field} eq '{escape_odata_string(value)}'"),
+                    "select": "parent_id, documentId, documentPath, documentName",
+                    "top": 1,
+                },
+            )
+            if response.status_code != 200:
+                raise HTTPException(status_code=response.status_code, detail=f"ドキュメントの検索に失敗しました: {response.text}")
+            documents = response.json().get("value", [])
+            return documents[0] if documents else None
+
+        results = await asyncio.gather(*[find(value) for value in values])
+        return dict(zip(values, results))
+
+    async def delete_project_documents(self, project_name:str, batch_size:int=1000) -> int:
+        """
+        共有インデックスから、projectName が一致するチャンクをすべて削除する. 削除した件数を返す.
+        削除しながらページングすると続きの位置がずれるため、先に page_query で全キーを取得してからまとめて削除する.
+        """
+        index_name = get_index_name(project_name)
+        project_condition = f"projectName eq '{escape_odata_string(project_name)}'"
+        all_keys, cursor = [], None
+        while True:
+            response = await self.http_client.post(
+                f"/indexes('{index_name}')/docs/search.post.search",
+                params={"api-version": self.api_version},
+                json={"search": "*", "select": f"{KEY_FIELD}, documentId", "top": batch_size, **page_query(project_condition, cursor)},
+            )
+            if response.status_code != 200:
+                raise HTTPException(status_code=response.status_code, detail=f"ドキュメントの検索に失敗しました: {response.text}")
+            documents = response.json().get("value", [])
+            if not documents:
+                break
+            all_keys += [document[KEY_FIELD] for document in documents]
+            cursor = advance_cursor(cursor, documents)
+
+        deleted = 0
+        for start in range(0, len(all_keys), batch_size):
+            keys = all_keys[start:start + batch_size]
+            response = await self.http_client.post(
+                f"/indexes('{index_name}')/docs/search.index",
+                params={"api-version": self.api_version},
+                json={"value": [{"@search.action": "delete", KEY_FIELD: key} for key in keys]},
+            )
+            if response.status_code not in (200, 207):
+                raise HTTPException(status_code=response.status_code, detail=f"ドキュメントの削除に失敗しました: {response.text}")
+            deleted += len(keys)
+        logging.info(f"インデックス '{index_name}' からプロジェクト '{project_name}' のチャンクを {deleted} 件削除しました")
+        return deleted
+
+    async def reset_project_documents(self, project_name:str, document_keys:list[str]):
+        """
+        インデクサーの resetdocs で、指定したドキュメント (データソース側のキー = parent_id) のみを次回の実行で再処理させる.
+        """
+        indexer_name = f"{project_name}-indexer"
+        response = await self.http_client.post(
+            f"/indexers('{indexer_name}')/search.resetdocs",
+            params={"api-version": self.api_version, "overwrite": "false"},
+            json={"documentKeys": document_keys},
+        )
+        if response.status_code != 204:
+            raise HTTPException(status_code=response.status_code, detail=f"ドキュメントのリセットに失敗しました: {response.text}")
+        logging.info(f"インデクサー '{indexer_name}' で {len(document_keys)} 件のドキュメントをリセットしました")
@@ -0,0 +1,185 @@
+import os
+import asyncio
+import hashlib
+import logging
+import tempfile
+
+from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import ResourceNotFoundError
+from azure.ai.documentintelligence.aio import DocumentIntelligenceClient
+from azure.storage.blob.aio import BlobServiceClient
+
+# 環境変数等の取得
+intelligence_key = os.getenv("DOCUMENT_INTELLIGENCE_API_KEY")
+intelligence_endpoint = os.getenv("DOCUMENT_INTELLIGENCE_ENDPOINT")
+# LAYOUT_CACHE_CONTAINER を設定した場合は Blob Storage、それ以外はローカルディレクトリに保存する
+# (Functions では作業ディレクトリが読み取り専用のため、既定は一時ディレクトリ)
+layout_cache_connection_string = os.getenv("LAYOUT_CACHE_CONNECTION_STRING")
+layout_cache_container = os.getenv("LAYOUT_CACHE_CONTAINER")
+layout_cache_dir = os.getenv("LAYOUT_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "layout_cache")
+
+
+def content_hash(content: bytes) -> str:
+    """
+    ファイルの内容の SHA-256. ファイル名・フォルダ・メタデータが変わっても内容が同じなら同じキーになる.
+    """
+    return hashlib.sha256(content).hexdigest()
+
+
+class LocalLayoutStore:
+    """
+    Layout の結果 (Markdown) をローカルディレクトリに {hash}.md として保存する.
+    """
+    def __init__(self, directory: str = None):
+        self.directory = directory or layout_cache_dir
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        # 1 ディレクトリ内のファイル数が増えすぎないよう、先頭 2 文字で分ける
+        return os.path.join(self.directory, key[:2], f"{key}.md")
+
+    async def get(self, key: str) -> str | None:
+        def read():
+            try:
+                with open(self._path(key), encoding="utf-8") as f:
+                    return f.read()
+            except FileNotFoundError:
+                return None
+        return await asyncio.to_thread(read)
+
+    async def put(self, key: str, markdown: str):
+        def write():
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # 書き込み途中のファイルを読まないよう、一時ファイルに書いてから置き換える
+            with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+                f.write(markdown)
+            os.replace(f"{path}.tmp", path)
+        await asyncio.to_thread(write)
+
+    async def aclose(self):
+        pass
+
+
+class BlobLayoutStore:
+    """
+    Layout の結果 (Markdown) を Blob Storage のコンテナーに {hash}.md として保存する.
+    """
+    def __init__(self, connection_string: str, container_name: str):
+        self.service_client = BlobServiceClient.from_connection_string(connection_string)
+        self.container_client = self.service_client.get_container_client(container_name)
+
+    async def get(self, key: str) -> str | None:
+        try:
+            downloader = await self.container_client.download_blob(f"{key}.md", encoding="utf-8")
+            return await downloader.readall()
+        except ResourceNotFoundError:
+            return None
+
+    async def put(self, key: str, markdown: str):
+        await self.container_client.upload_blob(
+            f"{key}.md", markdown.encode("utf-8"), overwrite=True, content_type="text/markdown; charset=utf-8"
+        )
+
+    async def aclose(self):
+        await self.service_client.close()
+
+
+class CachedLayoutAnalyzer:
+    """
+    Document Intelligence の Layout モデルの結果をファイル内容のハッシュでキャッシュする.
+    同じ内容のファイルを同時に解析しようとした場合も、解析は 1 回のみ行う.
+    """
+    def __init__(self, store=None):
+        self.store = store or get_layout_store()
+        self._client: DocumentIntelligenceClient | None = None
+        self._in_flight: dict[str, asyncio.Future] = {}
+        self.hits = 0  # キャッシュから取得したファイル数
+        self.misses = 0  # Layout モデルで解析したファイル数
+        self.pages_analyzed = 0  # Layout モデルで解析したページ数
+
+    @property
+    def client(self) -> DocumentIntelligenceClient:
+        if self._client is None:
+            self._client = DocumentIntelligenceClient(intelligence_endpoint, AzureKeyCredential(intelligence_key or ""))
+        return self._client
+
+    async def analyze(self, content: bytes) -> str:
+        """
+        ファイルの内容を Markdown に変換する (キャッシュにあれば Layout モデルを呼び出さない).
+        """
+        key = content_hash(content)
+        if key in self._in_flight:
+            self.hits += 1
+            return await asyncio.shield(self._in_flight[key])
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            markdown = await self.store.get(key)
+            if markdown is not None:
+                self.hits += 1
+            else:
+                poller = await self.client.begin_analyze_document(
+                    "prebuilt-layout",
+                    content,
+                    content_type="application/octet-stream",
+                    output_content_format="markdown",
+                )
+                result = await poller.result()
+                markdown = result.content or ""
+                self.misses += 1
+                self.pages_analyzed += len(result.pages or [])
+                await self.store.put(key, markdown)
+            future.set_result(markdown)
+            return markdown
+        except Exception as e:
+            future.set_exception(e)
+            # 待機しているタスクがない場合に "Future exception was never retrieved" とならないようにする
+            future.exception()
+            raise
+        finally:
+            # キャンセルされた場合 (BaseException) も、待機しているタスクが待ち続けないようにする
+            if not future.done():
+                future.cancel()
+            del self._in_flight[key]
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "files": total,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            "pages_analyzed": self.pages_analyzed,
+        }
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+
+_store = None
+
+
+def get_layout_store():
+    """
+    プロセス内で共有する Layout キャッシュの保存先を返す (初回呼び出し時に生成).
+    """
+    global _store
+    if _store is None:
+        if layout_cache_container:
+            _store = BlobLayoutStore(layout_cache_connection_string, layout_cache_container)
+            logging.info(f"Layout キャッシュ: Blob コンテナー '{layout_cache_container}'")
+        else:
+            _store = LocalLayoutStore()
+            logging.info(f"Layout キャッシュ: ローカルディレクトリ '{_store.directory}'")
+    return _store
+
+
+async def close_layout_store():
+    global _store
+    if _store is not None:
+        await _store.aclose()
+        _store = None
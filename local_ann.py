@@ -0,0 +1,334 @@
+import heapq
+import json
+import math
+import os
+import numpy as np
+
+
+def prepare_vectors(vectors: np.ndarray, metric: str) -> np.ndarray:
+    """
+    距離計算の前処理を行う (cosine の場合は正規化して内積で比較できるようにする).
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if metric == "cosine":
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        vectors = vectors / np.maximum(norms, 1e-12)
+    return vectors
+
+
+def compute_distances(query: np.ndarray, candidates: np.ndarray, metric: str) -> np.ndarray:
+    """
+    クエリと候補ベクトルの距離を返す (小さいほど近い). prepare_vectors 済みのベクトルを受け取る.
+    """
+    if metric == "euclidean":
+        diff = candidates - query
+        return np.einsum("ij,ij->i", diff, diff)
+    # cosine (正規化済み) / dotProduct は内積が大きいほど近い
+    return -(candidates @ query)
+
+
+def distance_to_score(distances: np.ndarray, metric: str) -> np.ndarray:
+    """
+    距離を Azure AI Search の @search.score と同じ向き (大きいほど近い) のスコアに変換する.
+    """
+    if metric == "cosine":
+        # score = 1 / (1 + (1 - cos)), distances = -cos
+        return 1.0 / (2.0 + distances)
+    if metric == "euclidean":
+        return 1.0 / (1.0 + np.sqrt(np.maximum(distances, 0.0)))
+    return -distances
+
+
+class HnswIndex:
+    """
+    Azure AI Search の HNSW と同じパラメータ (m, efConstruction, efSearch, metric) を持つ
+    ローカルの HNSW 実装. 本番環境での試行錯誤をせずにパラメータを比較するために使用する.
+    """
+
+    def __init__(self, dimensions: int, m: int = 4, ef_construction: int = 400, metric: str = "cosine", seed: int = 0):
+        self.dimensions = dimensions
+        self.m = m
+        self.max_neighbors_level0 = m * 2
+        self.ef_construction = ef_construction
+        self.metric = metric
+        self.level_multiplier = 1 / math.log(max(m, 2))
+        self.rng = np.random.default_rng(seed)
+
+        self.vectors = np.empty((0, dimensions), dtype=np.float32)
+        self.levels: list[int] = []
+        # graph[level][node] = 近傍ノードのリスト
+        self.graph: list[dict[int, list[int]]] = []
+        self.entry_point: int | None = None
+
+    def __len__(self):
+        return len(self.levels)
+
+    def add(self, vectors: np.ndarray):
+        """
+        ベクトルを追加してグラフを構築する. ノード番号は追加順の連番になる.
+        """
+        vectors = prepare_vectors(np.atleast_2d(vectors), self.metric)
+        start = len(self)
+        self.vectors = np.concatenate([self.vectors, vectors]) if start else vectors.copy()
+        for node in range(start, start + len(vectors)):
+            self._insert(node)
+
+    def _random_level(self) -> int:
+        return int(-math.log(1.0 - self.rng.random()) * self.level_multiplier)
+
+    def _distances(self, query: np.ndarray, nodes: list[int]) -> np.ndarray:
+        return compute_distances(query, self.vectors[nodes], self.metric)
+
+    def _search_layer(self, query: np.ndarray, entry_points: list[int], ef: int, level: int) -> list[tuple[float, int]]:
+        """
+        1 つの階層を貪欲に探索し、近い順に最大 ef 件の (距離, ノード) を返す.
+        """
+        layer = self.graph[level]
+        visited = set(entry_points)
+        entry_distances = self._distances(query, entry_points)
+        candidates = [(d, n) for d, n in zip(entry_distances.tolist(), entry_points)]
+        heapq.heapify(candidates)
+        results = [(-d, n) for d, n in candidates]
+        heapq.heapify(results)
+        while len(results) > ef:
+            heapq.heappop(results)
+
+        while candidates:
+            distance, node = heapq.heappop(candidates)
+            if distance > -results[0][0] and len(results) >= ef:
+                break
+            neighbors = [n for n in layer.get(node, []) if n not in visited]
+            if not neighbors:
+                continue
+            visited.update(neighbors)
+            for neighbor_distance, neighbor in zip(self._distances(query, neighbors).tolist(), neighbors):
+                if len(results) < ef or neighbor_distance < -results[0][0]:
+                    heapq.heappush(candidates, (neighbor_distance, neighbor))
+                    heapq.heappush(results, (-neighbor_distance, neighbor))
+                    if len(results) > ef:
+                        heapq.heappop(results)
+        return sorted((-d, n) for d, n in results)
+
+    def _select_neighbors(self, candidates: list[tuple[float, int]], max_neighbors: int) -> list[int]:
+        """
+        近傍選択ヒューリスティック: 既に選んだ近傍よりもクエリに近い候補のみを残し、グラフの多様性を保つ.
+        """
+        selected: list[int] = []
+        for distance, node in candidates:
+            if len(selected) >= max_neighbors:
+                break
+            if selected and np.any(self._distances(self.vectors[node], selected) < distance):
+                continue
+            selected.append(node)
+        # 多様性の条件で不足した場合は近い順に補う
+        if len(selected) < max_neighbors:
+            for _, node in candidates:
+                if len(selected) >= max_neighbors:
+                    break
+                if node not in selected:
+                    selected.append(node)
+        return selected
+
+    def _connect(self, node: int, neighbors: list[int], level: int):
+        layer = self.graph[level]
+        layer[node] = neighbors
+        max_neighbors = self.max_neighbors_level0 if level == 0 else self.m
+        for neighbor in neighbors:
+            links = layer.setdefault(neighbor, [])
+            links.append(node)
+            if len(links) > max_neighbors:
+                distances = self._distances(self.vectors[neighbor], links)
+                layer[neighbor] = self._select_neighbors(sorted(zip(distances.tolist(), links)), max_neighbors)
+
+    def _insert(self, node: int):
+        level = self._random_level()
+        self.levels.append(level)
+        while len(self.graph) <= level:
+            self.graph.append({})
+
+        if self.entry_point is None:
+            for l in range(level + 1):
+                self.graph[l][node] = []
+            self.entry_point = node
+            return
+
+        query = self.vectors[node]
+        entry_points = [self.entry_point]
+        top_level = self.levels[self.entry_point]
+        # 上位階層は最近傍 1 件のみを辿る
+        for l in range(top_level, level, -1):
+            entry_points = [self._search_layer(query, entry_points, 1, l)[0][1]]
+        for l in range(min(level, top_level), -1, -1):
+            candidates = self._search_layer(query, entry_points, self.ef_construction, l)
+            max_neighbors = self.max_neighbors_level0 if l == 0 else self.m
+            self._connect(node, self._select_neighbors(candidates, max_neighbors), l)
+            entry_points = [n for _, n in candidates]
+        for l in range(top_level + 1, level + 1):
+            self.graph[l][node] = []
+        if level > top_level:
+            self.entry_point = node
+
+    def search(self, query: np.ndarray, k: int, ef_search: int = 500, allowed: np.ndarray | None = None):
+        """
+        上位 k 件の (ノード番号の配列, スコアの配列) を返す.
+        allowed (bool 配列) を指定した場合、条件を満たすノードのみを結果に含める.
+        """
+        if self.entry_point is None:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        query = prepare_vectors(query, self.metric)
+        entry_points = [self.entry_point]
+        for l in range(self.levels[self.entry_point], 0, -1):
+            entry_points = [self._search_layer(query, entry_points, 1, l)[0][1]]
+        results = self._search_layer(query, entry_points, max(ef_search, k), 0)
+        if allowed is not None:
+            results = [(d, n) for d, n in results if allowed[n]]
+        results = results[:k]
+        ids = np.array([n for _, n in results], dtype=np.int64)
+        distances = np.array([d for d, _ in results], dtype=np.float32)
+        return ids, distance_to_score(distances, self.metric)
+
+    def save(self, path: str):
+        """
+        グラフを npz 形式で保存する (ベクトル自体は呼び出し元で別途保存する).
+        """
+        arrays = {"levels": np.array(self.levels, dtype=np.int32),
+                  "params": np.array([self.dimensions, self.m, self.ef_construction, -1 if self.entry_point is None else self.entry_point])}
+        for level, layer in enumerate(self.graph):
+            nodes = np.array(sorted(layer), dtype=np.int64)
+            offsets = np.cumsum([0] + [len(layer[n]) for n in nodes])
+            arrays[f"nodes_{level}"] = nodes
+            arrays[f"offsets_{level}"] = offsets
+            arrays[f"links_{level}"] = np.array([x for n in nodes for x in layer[n]], dtype=np.int64)
+        np.savez(path, metric=np.array(self.metric), **arrays)
+
+    @classmethod
+    def load(cls, path: str, vectors: np.ndarray) -> "HnswIndex":
+        """
+        save で保存したグラフと、prepare_vectors 済みのベクトル (mmap も可) から復元する.
+        """
+        data = np.load(path)
+        dimensions, m, ef_construction, entry_point = data["params"].tolist()
+        index = cls(dimensions, m=m, ef_construction=ef_construction, metric=str(data["metric"]))
+        index.vectors = vectors
+        index.levels = data["levels"].tolist()
+        index.entry_point = None if entry_point < 0 else entry_point
+        level = 0
+        while f"nodes_{level}" in data:
+            nodes, offsets, links = data[f"nodes_{level}"], data[f"offsets_{level}"], data[f"links_{level}"]
+            index.graph.append({
+                int(n): links[offsets[i]:offsets[i + 1]].tolist() for i, n in enumerate(nodes)
+            })
+            level += 1
+        return index
+
+
+def exact_search(vectors: np.ndarray, query: np.ndarray, k: int, metric: str = "cosine", allowed: np.ndarray | None = None):
+    """
+    全件探索 (exhaustiveKnn 相当) で上位 k 件の (ノード番号の配列, スコアの配列) を返す.
+    """
+    query = prepare_vectors(query, metric)
+    candidate_ids = np.arange(len(vectors)) if allowed is None else np.flatnonzero(allowed)
+    if len(candidate_ids) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    distances = compute_distances(query, vectors[candidate_ids], metric)
+    top = np.argsort(distances, kind="stable")[:k]
+    return candidate_ids[top], distance_to_score(distances[top], metric)
+
+
+class LocalVectorIndex:
+    """
+    ディスク上のローカルベクトルインデックス.
+    ディレクトリ構成:
+        vectors.npy     prepare_vectors 済みの float32 行列 (mmap で読み込む)
+        graph.npz       HnswIndex のグラフ
+        metadata.jsonl  1 行 1 チャンクのメタデータ (content, documentUrl, folderName など)
+    folderName / subfolderName / projectName / folderPath ごとの転置リストを読み込み時に作成し、フィルター条件に使用する.
+    folderPath のようなリストの値は要素ごとに転置リストへ登録する.
+    """
+    filter_fields = ("folderName", "subfolderName", "projectName", "folderPath")
+    # フィルター後の件数がこれ以下の場合は HNSW ではなく全件探索を行う
+    exact_search_threshold = 5000
+
+    def __init__(self, directory: str, metric: str = "cosine", ef_search: int = 500):
+        self.directory = directory
+        self.metric = metric
+        self.ef_search = ef_search
+        self.vectors = np.load(os.path.join(directory, "vectors.npy"), mmap_mode="r")
+        graph_path = os.path.join(directory, "graph.npz")
+        self.hnsw = HnswIndex.load(graph_path, self.vectors) if os.path.exists(graph_path) else None
+        if self.hnsw is not None:
+            self.metric = self.hnsw.metric
+        with open(os.path.join(directory, "metadata.jsonl"), encoding="utf-8") as f:
+            self.metadata = [json.loads(line) for line in f]
+
+        self._lookups: dict[str, dict] = {}
+        self.postings: dict[str, dict[str, np.ndarray]] = {}
+        for field in self.filter_fields:
+            values: dict[str, list[int]] = {}
+            for i, row in enumerate(self.metadata):
+                value = row.get(field) or ""
+                for item in value if isinstance(value, list) else [value]:
+                    values.setdefault(item, []).append(i)
+            self.postings[field] = {value: np.array(ids, dtype=np.int64) for value, ids in values.items()}
+
+    def __len__(self):
+        return len(self.metadata)
+
+    def lookup(self, field: str, values: list[str]) -> list[dict]:
+        """
+        field の値が values のいずれかに一致するチャンクのメタデータを返す (チャンクのキーでの一括取得などに使用する).
+        """
+        if field not in self._lookups:
+            self._lookups[field] = {row.get(field): i for i, row in enumerate(self.metadata)}
+        rows = self._lookups[field]
+        return [self.metadata[rows[value]] for value in values if value in rows]
+
+    def allowed_mask(self, conditions: dict[str, str]) -> np.ndarray | None:
+        """
+        {フィールド名: 値} の完全一致条件 (AND) を満たす行の bool 配列を返す. 条件がなければ None.
+        """
+        mask = None
+        for field, value in conditions.items():
+            field_mask = np.zeros(len(self), dtype=bool)
+            field_mask[self.postings.get(field, {}).get(value, np.empty(0, dtype=np.int64))] = True
+            mask = field_mask if mask is None else mask & field_mask
+        return mask
+
+    def search(self, query: np.ndarray, k: int, conditions: dict[str, str] | None = None):
+        """
+        上位 k 件の (メタデータ, スコア) のリストを返す.
+        フィルター後の件数が少ない場合やグラフがない場合は全件探索、それ以外は HNSW で探索する.
+        HNSW の結果がフィルターにより k 件に満たない場合は全件探索にフォールバックする.
+        """
+        allowed = self.allowed_mask(conditions or {})
+        n_allowed = len(self) if allowed is None else int(allowed.sum())
+        if n_allowed == 0:
+            return []
+
+        ids = None
+        if self.hnsw is not None and n_allowed > self.exact_search_threshold:
+            # フィルターで除外される割合に応じて探索候補数を増やす
+            ef = min(len(self), int(self.ef_search * len(self) / n_allowed))
+            ids, scores = self.hnsw.search(query, k, ef_search=max(ef, k), allowed=allowed)
+            if len(ids) < min(k, n_allowed):
+                ids = None
+        if ids is None:
+            ids, scores = exact_search(self.vectors, query, k, self.metric, allowed)
+        return [(self.metadata[i], float(score)) for i, score in zip(ids.tolist(), scores.tolist())]
+
+    @staticmethod
+    def build(directory: str, documents: list[dict], vectors: np.ndarray, metric: str = "cosine",
+              m: int = 4, ef_construction: int = 400, use_hnsw: bool = True):
+        """
+        ドキュメント (メタデータ) とベクトルからローカルインデックスを作成する.
+        """
+        os.makedirs(directory, exist_ok=True)
+        prepared = prepare_vectors(vectors, metric)
+        np.save(os.path.join(directory, "vectors.npy"), prepared)
+        if use_hnsw:
+            hnsw = HnswIndex(prepared.shape[1], m=m, ef_construction=ef_construction, metric=metric)
+            hnsw.add(prepared)
+            hnsw.save(os.path.join(directory, "graph.npz"))
+        with open(os.path.join(directory, "metadata.jsonl"), "w", encoding="utf-8") as f:
+            for document in documents:
+                f.write(json.dumps(document, ensure_ascii=False) + "\n")
@@ -0,0 +1,439 @@
+import os
+import re
+import json
+import time
+import random
+import asyncio
+import logging
+import threading
+
+import httpx
+
+from resilience import (
+    RETRYABLE_STATUS_CODES, THROTTLE_STATUS_CODES, CircuitOpenError, ResilientAsyncTransport, ResilientTransport,
+    cap_timeouts, get_upstream, parse_retry_after, retry_max_attempts, retry_max_delay,
+)
+from deadlines import DeadlineExceeded, remaining_seconds
+
+# 環境変数等の取得
+# Azure OpenAI のデプロイメントのプール (JSON ファイルのパスまたは JSON 文字列). 上流の名前ごとにエンドポイントのリストを指定する
+#   {"openai-chat": [{"name": "east", "endpoint": "https://...", "api_key_env": "AOAI_EAST_KEY", "deployment": "gpt-4o", "weight": 2}, ...],
+#    "openai-chat-fast": [...], "openai-embeddings": [...]}
+# プールを指定しない上流は、従来どおり 1 つのエンドポイント (AZURE_OPENAI_ENDPOINT など) を使用する
+openai_pool_config = os.getenv("OPENAI_POOL_CONFIG")
+# エンドポイントの選び方 ("least_loaded": 重みあたりの実行中の件数と残りクォータで選ぶ, "weighted": 重みに比例してランダムに選ぶ)
+openai_pool_strategy = os.getenv("OPENAI_POOL_STRATEGY", "least_loaded")
+# 応答がこの秒数を超えた場合、別のエンドポイントにも同じリクエストを送り、先に返った方を使う (0 の場合はヘッジしない)
+openai_hedge_delay = float(os.getenv("OPENAI_HEDGE_DELAY", "0"))
+# 応答ヘッダーの残りクォータを有効とみなす秒数 (Azure OpenAI のクォータは 1 分単位で回復する)
+openai_quota_ttl = float(os.getenv("OPENAI_QUOTA_TTL", "60"))
+
+# URL のパスのうちデプロイメント名の部分 (/openai/deployments/{deployment}/...)
+DEPLOYMENT_PATH = re.compile(r"^(.*?/openai/deployments/)[^/]+(/.*)?$")
+
+
+def load_pool_config(value: str = None) -> dict[str, list[dict]]:
+    """
+    OPENAI_POOL_CONFIG を読み込む. api_key の代わりに api_key_env (キーを格納した環境変数の名前) を指定できる.
+    """
+    value = value if value is not None else openai_pool_config
+    if not value:
+        return {}
+    if not value.lstrip().startswith("{"):
+        with open(value, encoding="utf-8") as f:
+            value = f.read()
+    config = json.loads(value)
+    for upstream, members in config.items():
+        for member in members:
+            if "api_key_env" in member:
+                member["api_key"] = os.getenv(member["api_key_env"])
+            if not member.get("endpoint") or not member.get("api_key"):
+                raise ValueError(f"OPENAI_POOL_CONFIG の {upstream} に endpoint・api_key のないエンドポイントがあります: {member.get('name')}")
+    return config
+
+
+class PoolMember:
+    """
+    プールのエンドポイント 1 つ. 同時実行数の制御・サーキットブレーカー・メトリクスは上流 "{プール}:{name}" として resilience で管理する.
+    """
+    def __init__(self, pool: str, config: dict):
+        self.name = config.get("name") or httpx.URL(config["endpoint"]).host
+        self.endpoint = httpx.URL(config["endpoint"].rstrip("/"))
+        self.api_key = config["api_key"]
+        self.deployment = config.get("deployment")
+        self.weight = float(config.get("weight", 1))
+        self.upstream = get_upstream(f"{pool}:{self.name}")
+        self.throttled_until = 0.0
+        self.remaining_requests: int | None = None
+        self.remaining_tokens: int | None = None
+        self.max_remaining_tokens = 0
+        self.quota_updated_at = 0.0
+
+    def available(self) -> bool:
+        return time.monotonic() >= self.throttled_until and not self.upstream.breaker.is_open()
+
+    def quota_fraction(self) -> float:
+        """
+        直近の応答ヘッダーから推定した残りクォータの割合 (不明な場合は 1).
+        """
+        if self.remaining_tokens is None or time.monotonic() - self.quota_updated_at > openai_quota_ttl:
+            return 1.0
+        if self.remaining_requests == 0:
+            return 0.0
+        return self.remaining_tokens / self.max_remaining_tokens if self.max_remaining_tokens else 1.0
+
+    def load(self) -> float:
+        """
+        least_loaded で比較する負荷 (小さいほど空いている). 残りクォータが少ないエンドポイントほど避ける.
+        """
+        return (self.upstream.limiter.in_flight + 1) / self.weight / max(self.quota_fraction(), 0.05)
+
+    def observe(self, response: httpx.Response, latency: float):
+        self.upstream.observe(response.status_code, response.headers, latency)
+        headers = response.headers
+        if "x-ratelimit-remaining-tokens" in headers or "x-ratelimit-remaining-requests" in headers:
+            try:
+                self.remaining_tokens = int(headers.get("x-ratelimit-remaining-tokens", self.remaining_tokens or 0))
+                self.remaining_requests = int(headers.get("x-ratelimit-remaining-requests", -1))
+            except ValueError:
+                pass
+            else:
+                self.max_remaining_tokens = max(self.max_remaining_tokens, self.remaining_tokens)
+                self.quota_updated_at = time.monotonic()
+        if response.status_code in THROTTLE_STATUS_CODES:
+            # Retry-After の間はこのエンドポイントを選ばない
+            self.throttled_until = time.monotonic() + (parse_retry_after(headers) or 1.0)
+
+    def on_transport_error(self):
+        self.upstream.requests += 1
+        self.upstream.transport_errors += 1
+        remaining = remaining_seconds()
+        if remaining is None or remaining > 0:
+            self.upstream.breaker.record_failure()
+
+    def prepare(self, request: httpx.Request) -> httpx.Request:
+        """
+        リクエストの送信先 (ホスト・デプロイメント名)・API キーをこのエンドポイントのものに置き換える.
+        """
+        path = request.url.path
+        if self.deployment:
+            path = DEPLOYMENT_PATH.sub(lambda m: f"{m.group(1)}{self.deployment}{m.group(2) or ''}", path)
+        url = request.url.copy_with(scheme=self.endpoint.scheme, host=self.endpoint.host, port=self.endpoint.port, path=path)
+        headers = [(k, v) for k, v in request.headers.multi_items() if k.lower() not in ("host", "api-key", "authorization")]
+        headers.append(("api-key", self.api_key))
+        extensions = dict(request.extensions)
+        extensions["timeout"] = cap_timeouts(extensions.get("timeout", {}))
+        return httpx.Request(request.method, url, headers=headers, content=request.content, extensions=extensions)
+
+    def stats(self) -> dict:
+        return {
+            "endpoint": str(self.endpoint),
+            "deployment": self.deployment,
+            "weight": self.weight,
+            "available": self.available(),
+            "in_flight": self.upstream.limiter.in_flight,
+            "remaining_requests": self.remaining_requests,
+            "remaining_tokens": self.remaining_tokens,
+            "quota_fraction": round(self.quota_fraction(), 3),
+        }
+
+
+class DeploymentPool:
+    """
+    同じモデルの複数のデプロイメント (エンドポイント・キー) を 1 つの上流として扱う.
+    """
+    def __init__(self, name: str, members: list[dict]):
+        self.name = name
+        self.members = [PoolMember(name, member) for member in members]
+        self.failovers = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self._lock = threading.Lock()
+
+    def pick(self, exclude=()) -> PoolMember | None:
+        """
+        利用できる (スロットリング中・サーキットが開いていない) エンドポイントを OPENAI_POOL_STRATEGY で選ぶ.
+        exclude (このリクエストで失敗したエンドポイント) 以外に候補がない場合は None を返す.
+        """
+        candidates = [member for member in self.members if member not in exclude and member.available()]
+        if not candidates:
+            return None
+        if openai_pool_strategy == "weighted":
+            return random.choices(candidates, weights=[member.weight for member in candidates])[0]
+        with self._lock:
+            return min(candidates, key=lambda member: (member.load(), random.random()))
+
+    def wait_seconds(self) -> float | None:
+        """
+        すべてのエンドポイントがスロットリング中の場合、最初に解除されるまでの秒数 (サーキットが開いているだけの場合は None).
+        """
+        now = time.monotonic()
+        waits = [member.throttled_until - now for member in self.members if not member.upstream.breaker.is_open()]
+        return max(0.0, min(waits)) if waits else None
+
+    def circuit_retry_after(self) -> float:
+        """
+        すべてのエンドポイントのサーキットが開いている場合、最初に試行できるようになるまでの秒数.
+        """
+        return min(member.upstream.breaker._remaining() for member in self.members)
+
+    def unavailable(self) -> bool:
+        """
+        すべてのエンドポイントを利用できないかどうか (サーキットが開いている、またはスロットリングの解除まで RETRY_MAX_DELAY を超えて待つ必要がある).
+        この場合、トランスポートは待たずに失敗する.
+        """
+        if any(member.available() for member in self.members):
+            return False
+        wait = self.wait_seconds()
+        return wait is None or wait > retry_max_delay
+
+    def stats(self) -> dict:
+        return {
+            "strategy": openai_pool_strategy,
+            "hedge_delay": openai_hedge_delay,
+            "failovers": self.failovers,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "members": {member.name: member.stats() for member in self.members},
+        }
+
+
+_pools: dict[str, DeploymentPool] = {}
+
+
+def get_pool(upstream: str) -> DeploymentPool | None:
+    """
+    上流 upstream のプール (OPENAI_POOL_CONFIG に指定がない場合は None).
+    """
+    if not _pools and openai_pool_config:
+        for name, members in load_pool_config().items():
+            _pools[name] = DeploymentPool(name, members)
+            logging.info(f"Azure OpenAI のプール '{name}': {[member.name for member in _pools[name].members]}")
+    return _pools.get(upstream)
+
+
+def upstream_unavailable(upstream: str) -> bool:
+    """
+    上流 upstream を現在呼び出せないかどうか. プールの場合はすべてのエンドポイントを利用できない場合、
+    プールでない場合は上流のサーキットが開いている場合.
+    """
+    pool = get_pool(upstream)
+    if pool is not None:
+        return pool.unavailable()
+    return get_upstream(upstream).breaker.is_open()
+
+
+def pool_stats() -> dict:
+    return {name: pool.stats() for name, pool in sorted(_pools.items())}
+
+
+def _is_retryable(response: httpx.Response) -> bool:
+    return response.status_code in RETRYABLE_STATUS_CODES
+
+
+class PooledAsyncTransport(httpx.AsyncBaseTransport):
+    """
+    httpx.AsyncClient 用のトランスポート. リクエストをプールのエンドポイントに振り分け、
+    429 / 5xx・接続エラーの場合は待たずに別のエンドポイントで再試行する (フェイルオーバー).
+    OPENAI_HEDGE_DELAY 秒以内に応答がない場合は別のエンドポイントにも送り、先に成功した応答を使う (ヘッジ).
+    """
+    def __init__(self, pool: DeploymentPool, **transport_kwargs):
+        self.pool = pool
+        self.transport = httpx.AsyncHTTPTransport(**transport_kwargs)
+
+    async def _attempt(self, request: httpx.Request, member: PoolMember) -> httpx.Response:
+        upstream = member.upstream
+        upstream.breaker.before_request()
+        try:
+            await asyncio.wait_for(upstream.limiter.acquire_async(), timeout=remaining_seconds())
+        except BaseException as e:
+            upstream.breaker.record_cancel()
+            if isinstance(e, asyncio.TimeoutError):
+                raise DeadlineExceeded(upstream.name) from None
+            raise
+        started = time.perf_counter()
+        try:
+            response = await self.transport.handle_async_request(member.prepare(request))
+        except httpx.TransportError:
+            member.on_transport_error()
+            raise
+        except BaseException:
+            upstream.breaker.record_cancel()
+            raise
+        finally:
+            upstream.limiter.release()
+        member.observe(response, time.perf_counter() - started)
+        return response
+
+    async def _hedged(self, request: httpx.Request, member: PoolMember, tried: set) -> httpx.Response:
+        if openai_hedge_delay <= 0:
+            return await self._attempt(request, member)
+        primary = asyncio.ensure_future(self._attempt(request, member))
+        pending = {primary}
+        fallback, error = None, None
+        try:
+            done, _ = await asyncio.wait(pending, timeout=openai_hedge_delay)
+            backup_member = None if done else self.pool.pick(exclude=tried | {member})
+            if backup_member is None:
+                pending = set()
+                return await primary
+
+            self.pool.hedged += 1
+            tried.add(backup_member)
+            logging.info(f"{self.pool.name}: {member.name} の応答が {openai_hedge_delay} 秒を超えたため {backup_member.name} にも送信します")
+            backup = asyncio.ensure_future(self._attempt(request, backup_member))
+            pending = {primary, backup}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    response = task.result()
+                    if not _is_retryable(response):
+                        self.pool.hedge_wins += int(task is backup)
+                        if fallback is not None:
+                            await fallback.aclose()
+                        return response
+                    # 両方とも失敗した場合に返す (呼び出し元で別のエンドポイントに切り替える)
+                    if fallback is not None:
+                        await fallback.aclose()
+                    fallback = response
+            if fallback is not None:
+                return fallback
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+                task.add_done_callback(_close_discarded)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        # 別のエンドポイントに同じ本文を送るため、先に読み込んでおく
+        await request.aread()
+        tried: set[PoolMember] = set()
+        response, error = None, None
+        for attempt in range(retry_max_attempts):
+            remaining = remaining_seconds()
+            if remaining is not None and remaining <= 0:
+                raise DeadlineExceeded(self.pool.name)
+            member = self.pool.pick(exclude=tried) or self.pool.pick()
+            if member is None:
+                # すべてのエンドポイントがスロットリング中であれば、最初に解除されるまで待つ
+                wait = self.pool.wait_seconds()
+                if wait is None:
+                    raise CircuitOpenError(self.pool.name, self.pool.circuit_retry_after())
+                if wait > retry_max_delay or (remaining is not None and wait >= remaining):
+                    break
+                await asyncio.sleep(wait)
+                continue
+            if response is not None:
+                await response.aclose()
+                response = None
+            if attempt:
+                self.pool.failovers += 1
+            tried.add(member)
+            try:
+                response = await self._hedged(request, member, tried)
+            except httpx.TransportError as e:
+                error = e
+                logging.warning(f"{self.pool.name}: {member.name} への接続に失敗したため、別のエンドポイントで再試行します: {e}")
+                continue
+            except CircuitOpenError as e:
+                error = e
+                continue
+            if not _is_retryable(response):
+                return response
+            logging.warning(f"{self.pool.name}: {member.name} が {response.status_code} を返したため、別のエンドポイントで再試行します")
+        if response is not None:
+            return response
+        raise error or DeadlineExceeded(self.pool.name)
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+def _close_discarded(task: asyncio.Task):
+    """
+    ヘッジで使わなかったリクエストが応答を返していた場合は閉じる.
+    """
+    if not task.cancelled() and task.exception() is None:
+        asyncio.ensure_future(task.result().aclose())
+
+
+class PooledTransport(httpx.BaseTransport):
+    """
+    PooledAsyncTransport の同期版 (httpx.Client 用). フェイルオーバーのみ行い、ヘッジはしない.
+    """
+    def __init__(self, pool: DeploymentPool, **transport_kwargs):
+        self.pool = pool
+        self.transport = httpx.HTTPTransport(**transport_kwargs)
+
+    def _attempt(self, request: httpx.Request, member: PoolMember) -> httpx.Response:
+        upstream = member.upstream
+        upstream.breaker.before_request()
+        upstream.limiter.acquire()
+        started = time.perf_counter()
+        try:
+            response = self.transport.handle_request(member.prepare(request))
+        except httpx.TransportError:
+            member.on_transport_error()
+            raise
+        except BaseException:
+            upstream.breaker.record_cancel()
+            raise
+        finally:
+            upstream.limiter.release()
+        member.observe(response, time.perf_counter() - started)
+        return response
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        request.read()
+        tried: set[PoolMember] = set()
+        response, error = None, None
+        for attempt in range(retry_max_attempts):
+            remaining = remaining_seconds()
+            if remaining is not None and remaining <= 0:
+                raise DeadlineExceeded(self.pool.name)
+            member = self.pool.pick(exclude=tried) or self.pool.pick()
+            if member is None:
+                wait = self.pool.wait_seconds()
+                if wait is None:
+                    raise CircuitOpenError(self.pool.name, self.pool.circuit_retry_after())
+                if wait > retry_max_delay or (remaining is not None and wait >= remaining):
+                    break
+                time.sleep(wait)
+                continue
+            if response is not None:
+                response.close()
+                response = None
+            if attempt:
+                self.pool.failovers += 1
+            tried.add(member)
+            try:
+                response = self._attempt(request, member)
+            except (httpx.TransportError, CircuitOpenError) as e:
+                error = e
+                logging.warning(f"{self.pool.name}: {member.name} の呼び出しに失敗したため、別のエンドポイントで再試行します: {e}")
+                continue
+            if not _is_retryable(response):
+                return response
+            logging.warning(f"{self.pool.name}: {member.name} が {response.status_code} を返したため、別のエンドポイントで再試行します")
+        if response is not None:
+            return response
+        raise error or DeadlineExceeded(self.pool.name)
+
+    def close(self):
+        self.transport.close()
+
+
+def openai_async_transport(upstream: str) -> httpx.AsyncBaseTransport:
+    """
+    上流 upstream の httpx.AsyncClient 用トランスポート (プールがあればプール、なければ単一のエンドポイント).
+    """
+    pool = get_pool(upstream)
+    return PooledAsyncTransport(pool) if pool else ResilientAsyncTransport(upstream)
+
+
+def openai_transport(upstream: str) -> httpx.BaseTransport:
+    pool = get_pool(upstream)
+    return PooledTransport(pool) if pool else ResilientTransport(upstream)
@@ -0,0 +1,509 @@
+import re
+import time
+import asyncio
+import logging
+from urllib.parse import urlparse, unquote
+
+from SharePoint import SharePointAccessClass
+from indexing_service import (
+    KEY_FIELD, ProjectIndexingService, advance_cursor, escape_odata_string, folder_path_prefixes, get_index_name, page_query, project_filter,
+)
+from generate_answer import get_embedding_model
+from embedding_cache import CachedEmbedder, get_embedding_store
+from layout_cache import CachedLayoutAnalyzer
+from chunker import MarkdownChunker
+
+# Layout モデルを通さずにそのまま読み込むファイル
+PLAIN_TEXT_EXTENSIONS = (".txt", ".md", ".csv", ".json")
+
+# インデックスのキーに使用できない文字
+INVALID_KEY_CHARACTERS = re.compile(r"[^A-Za-z0-9_\-=]")
+
+# 各ステージのワーカー終了を伝える番兵
+_DONE = object()
+
+
+class StageMetrics:
+    """
+    パイプラインの 1 ステージ分の処理件数・処理時間.
+    """
+    def __init__(self, name: str, workers: int):
+        self.name = name
+        self.workers = workers
+        self.items_in = 0  # 受け取った件数
+        self.items_out = 0  # 次のステージに渡した件数
+        self.errors = 0
+        self.busy_seconds = 0.0  # ワーカーが処理に費やした時間の合計
+        self.started_at: float | None = None
+        self.finished_at: float | None = None
+
+    @property
+    def elapsed_seconds(self) -> float:
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.perf_counter()) - self.started_at
+
+    def to_dict(self) -> dict:
+        elapsed = self.elapsed_seconds
+        return {
+            "workers": self.workers,
+            "items_in": self.items_in,
+            "items_out": self.items_out,
+            "errors": self.errors,
+            "elapsed_seconds": round(elapsed, 2),
+            "items_per_second": round(self.items_in / elapsed, 2) if elapsed else 0.0,
+            # ワーカーが処理中だった時間の割合 (1 に近いほどこのステージがボトルネック)
+            "utilization": round(self.busy_seconds / (elapsed * self.workers), 2) if elapsed else 0.0,
+        }
+
+
+def make_parent_id(item_id: str) -> str:
+    """
+    ファイル (driveItem) の ID から、チャンクの親 ID を生成する.
+    """
+    return INVALID_KEY_CHARACTERS.sub("_", item_id)
+
+
+def make_document_key(item_id: str, chunk_index: int) -> str:
+    """
+    チャンクのキーを生成する (キーに使用できる文字は英数字, "_", "-", "=" のみ).
+    """
+    return f"{make_parent_id(item_id)}_pages_{chunk_index}"
+
+
+def get_document_id(item) -> str | None:
+    """
+    ステージ間で受け渡す要素 (driveItem, (driveItem, 内容), チャンク) から元のファイルの ID を返す.
+    """
+    if isinstance(item, tuple):
+        return item[0].get("id")
+    return item.get("documentId") or item.get("id")
+
+
+def to_drive_relative_path(path: str) -> str:
+    """
+    ドキュメントのパスをドライブのルートからの相対パスに変換する.
+    "/sites/{サイト}/{ライブラリ}/フォルダ/file.pdf" (documentPath の形式) の場合はサイトとライブラリの部分を取り除く.
+    """
+    path = unquote(urlparse(path).path if path.startswith("http") else path)
+    parts = [part for part in path.split("/") if part]
+    if len(parts) > 3 and parts[0] == "sites":
+        parts = parts[3:]
+    return "/".join(parts)
+
+
+def get_folder_names(item: dict) -> tuple[str, str]:
+    """
+    driveItem の親フォルダのパス ("/drive/root:/フォルダ/サブフォルダ") からフォルダ名とサブフォルダ名を返す.
+    ルート直下のファイルは空文字.
+    """
+    parent_path = unquote(item.get("parentReference", {}).get("path", ""))
+    parts = [part for part in parent_path.split("root:", 1)[-1].split("/") if part]
+    folder_name = parts[0] if len(parts) > 0 else ""
+    subfolder_name = parts[1] if len(parts) > 1 else ""
+    return folder_name, subfolder_name
+
+
+class PushIndexingPipeline:
+    """
+    SharePoint のファイルを取得し、チャンク分割・埋め込みを行ってプロジェクトのインデックスへ直接アップロードする (push 型のインデックス作成).
+    ダウンロード → チャンク分割 → 埋め込み → アップロード の 4 ステージで構成し、
+    各ステージは上限付きのキューと専用のワーカーを持つ (後段が詰まると前段が待機する).
+
+    インデックスに登録済みのファイル (documentUrl が一致するチャンクがあるファイル) は、そのチャンクの parent_id と documentId を引き継ぐ.
+    インデクサーのインデックスプロジェクションは parent_id で自身が作成したチャンクを置き換えるため、
+    後でインデクサーが同じファイルを処理しても push で登録したチャンクは残らない.
+    indexer_managed=True (稼働中のインデクサーも同じインデックスに登録する) の場合、未登録のファイルは
+    インデクサーの parent_id が分からないため登録せず (deferred)、インデクサーに任せる.
+    ファイルの指定・結果はすべて driveItem の ID で行う.
+    """
+    def __init__(
+        self,
+        project_name: str,
+        site_id: str,
+        sharepoint: SharePointAccessClass,
+        search_indexing: ProjectIndexingService,
+        dedupe_text_fields: bool = False,
+        download_workers: int = 8,
+        chunk_workers: int = 4,
+        embed_workers: int = 4,
+        upload_workers: int = 2,
+        queue_size: int = 64,
+        embed_batch_size: int = 16,
+        upload_batch_size: int = 1000,
+        flush_seconds: float = 5.0,
+        max_chunk_tokens: int = None,
+        chunk_overlap_tokens: int = None,
+        index_name: str = None,
+        indexer_managed: bool = False,
+    ):
+        self.project_name = project_name
+        # 再構築中の新しいバージョンなど、稼働中以外のインデックスに登録する場合は index_name を指定する
+        self.index_name = index_name or get_index_name(project_name)
+        self.site_id = site_id
+        self.sharepoint = sharepoint
+        self.search_indexing = search_indexing
+        self.indexer_managed = indexer_managed
+        self.dedupe_text_fields = dedupe_text_fields
+        self.embed_batch_size = embed_batch_size
+        # mergeOrUpload は 1 リクエストあたり 1000 件まで
+        self.upload_batch_size = min(upload_batch_size, 1000)
+        self.flush_seconds = flush_seconds
+        # h1〜h3 の見出し単位・トークン数基準で分割する (分割処理はプロセスプールで実行)
+        self.chunker = MarkdownChunker(max_chunk_tokens, chunk_overlap_tokens)
+
+        self.metrics = {
+            "download": StageMetrics("download", download_workers),
+            "chunk": StageMetrics("chunk", chunk_workers),
+            "embed": StageMetrics("embed", embed_workers),
+            "upload": StageMetrics("upload", upload_workers),
+        }
+        self.queue_size = queue_size
+        self.status = "pending"
+        self.files_listed = 0
+        self.failures: list[dict] = []
+        # ファイル (driveItem) の ID ごとにアップロードしたチャンクのキー
+        self.uploaded_keys: dict[str, set[str]] = {}
+        # ファイルの ID ごとの、チャンクに設定する parent_id と documentId (登録済みのファイルはインデックスの値を引き継ぐ)
+        self.identities: dict[str, dict] = {}
+        # documentId からファイルの ID への対応
+        self.item_ids: dict[str, str] = {}
+        # インデクサーに任せたファイルの ID
+        self.deferred: list[str] = []
+        # 変更のないチャンクは保存済みのベクトルを再利用する
+        self.embedder: CachedEmbedder | None = None
+        # 内容が同じファイルは Layout の結果を再利用する
+        self.layout_analyzer: CachedLayoutAnalyzer | None = None
+
+    def _record_failure(self, stage: str, name: str, error: Exception, document_ids: list[str] = None):
+        logging.error(f"[push:{self.project_name}] {stage} に失敗しました ({name}): {error}")
+        self.failures.append({"stage": stage, "name": name, "error": str(error), "document_ids": document_ids or []})
+
+    async def run(self, folder_id: str = "root", items: list[dict] = None) -> dict:
+        """
+        パイプラインを実行し、ステージごとの処理結果を返す.
+        items (driveItem のリスト) を指定した場合は、フォルダを列挙せずに指定したファイルのみを処理する.
+        """
+        self.status = "running"
+        self.embedder = CachedEmbedder(get_embedding_model(), get_embedding_store())
+        self.layout_analyzer = CachedLayoutAnalyzer()
+        queues = {
+            name: asyncio.Queue(maxsize=self.queue_size)
+            for name in ("download", "chunk", "embed", "upload")
+        }
+        stages = [
+            ("download", self.download, 1),
+            ("chunk", self.chunk, 1),
+            ("embed", self.embed, self.embed_batch_size),
+            ("upload", self.upload, self.upload_batch_size),
+        ]
+        tasks = []
+        try:
+            tasks.append(asyncio.create_task(self._list_files(queues["download"], folder_id, items)))
+            for position, (name, process, batch_size) in enumerate(stages):
+                next_name = stages[position + 1][0] if position + 1 < len(stages) else None
+                tasks.append(asyncio.create_task(self._run_stage(
+                    name, process, batch_size, queues[name],
+                    queues[next_name] if next_name else None,
+                    self.metrics[next_name].workers if next_name else 0,
+                )))
+            await asyncio.gather(*tasks)
+            self.status = "completed" if not self.failures else "completed_with_errors"
+        except Exception as e:
+            self.status = "failed"
+            self._record_failure("pipeline", self.project_name, e)
+            for task in tasks:
+                task.cancel()
+        finally:
+            await self.layout_analyzer.aclose()
+
+        report = self.report()
+        logging.info(f"[push:{self.project_name}] {report}")
+        return report
+
+    def report(self) -> dict:
+        return {
+            "project_name": self.project_name,
+            "status": self.status,
+            "files_listed": self.files_listed,
+            "stages": {name: metrics.to_dict() for name, metrics in self.metrics.items()},
+            "embedding_cache": self.embedder.stats() if self.embedder else None,
+            "layout_cache": self.layout_analyzer.stats() if self.layout_analyzer else None,
+            "failures": self.failures[:100],
+        }
+
+    async def _list_files(self, out_queue: asyncio.Queue, folder_id: str, items: list[dict] = None):
+        """
+        対象ファイルを列挙してダウンロードキューに投入し、最後に番兵を入れる.
+        """
+        try:
+            files = items if items is not None else await asyncio.to_thread(
+                lambda: list(self.sharepoint.list_files_recursive(self.site_id, folder_id))
+            )
+            self.files_listed = len(files)
+            for item in files:
+                await out_queue.put(item)
+        finally:
+            for _ in range(self.metrics["download"].workers):
+                await out_queue.put(_DONE)
+
+    async def _run_stage(self, name: str, process, batch_size: int, in_queue: asyncio.Queue, out_queue: asyncio.Queue | None, next_workers: int):
+        """
+        1 ステージ分のワーカーを起動し、全ワーカーの終了後に次のステージへ番兵を渡す.
+        """
+        metrics = self.metrics[name]
+        metrics.started_at = time.perf_counter()
+        try:
+            await asyncio.gather(*[
+                self._worker(metrics, process, batch_size, in_queue, out_queue)
+                for _ in range(metrics.workers)
+            ])
+        finally:
+            metrics.finished_at = time.perf_counter()
+            if out_queue is not None:
+                for _ in range(next_workers):
+                    await out_queue.put(_DONE)
+
+    async def _worker(self, metrics: StageMetrics, process, batch_size: int, in_queue: asyncio.Queue, out_queue: asyncio.Queue | None):
+        """
+        キューから最大 batch_size 件をまとめて取り出して処理し、結果を次のキューへ渡す.
+        バッチが埋まらない場合も flush_seconds 経過で処理する.
+        """
+        finished = False
+        while not finished:
+            batch = []
+            while len(batch) < batch_size:
+                try:
+                    if batch:
+                        item = await asyncio.wait_for(in_queue.get(), timeout=self.flush_seconds)
+                    else:
+                        item = await in_queue.get()
+                except asyncio.TimeoutError:
+                    break
+                if item is _DONE:
+                    finished = True
+                    break
+                batch.append(item)
+            if not batch:
+                continue
+
+            metrics.items_in += len(batch)
+            started = time.perf_counter()
+            try:
+                results = await process(batch)
+            except Exception as e:
+                metrics.errors += len(batch)
+                self._record_failure(metrics.name, f"{len(batch)} items", e, sorted({self._item_id(get_document_id(item)) for item in batch}))
+                results = []
+            finally:
+                metrics.busy_seconds += time.perf_counter() - started
+
+            metrics.items_out += len(results)
+            if out_queue is not None:
+                for result in results:
+                    await out_queue.put(result)
+
+    def _item_id(self, document_id: str) -> str:
+        return self.item_ids.get(document_id, document_id)
+
+    async def _resolve_identities(self, batch: list[dict]) -> list[dict]:
+        """
+        ファイルのチャンクに設定する parent_id と documentId を決め、処理するファイルを返す.
+        インデックスに登録済みのファイルはその値を引き継ぎ、未登録のファイルは indexer_managed の場合はインデクサーに任せる.
+        """
+        urls = [item["webUrl"] for item in batch if item.get("webUrl")]
+        indexed = await self.search_indexing.find_indexed_documents(self.project_name, "documentUrl", urls, self.index_name) if urls else {}
+        resolved = []
+        for item in batch:
+            document = indexed.get(item.get("webUrl"))
+            if document and document.get("parent_id"):
+                identity = {"parent_id": document["parent_id"], "documentId": document.get("documentId") or item["id"]}
+            elif self.indexer_managed:
+                self.deferred.append(item["id"])
+                continue
+            else:
+                identity = {"parent_id": make_parent_id(item["id"]), "documentId": item["id"]}
+            self.identities[item["id"]] = identity
+            self.item_ids[identity["documentId"]] = item["id"]
+            resolved.append(item)
+        return resolved
+
+    async def download(self, batch: list[dict]) -> list[tuple[dict, bytes]]:
+        """
+        ファイルの内容をダウンロードする (インデクサーに任せるファイルはダウンロードしない).
+        """
+        results = []
+        for item in await self._resolve_identities(batch):
+            try:
+                content = await asyncio.to_thread(self.sharepoint.download_item_content, self.site_id, item["id"])
+                results.append((item, content))
+            except Exception as e:
+                self.metrics["download"].errors += 1
+                self._record_failure("download", item.get("name", item["id"]), e, [item["id"]])
+        return results
+
+    async def extract_markdown(self, item: dict, content: bytes) -> str:
+        """
+        ファイルの内容を Markdown として取り出す (テキストファイル以外は Document Intelligence の Layout モデルを使用).
+        """
+        if item.get("name", "").lower().endswith(PLAIN_TEXT_EXTENSIONS):
+            return content.decode("utf-8", errors="ignore")
+        return await self.layout_analyzer.analyze(content)
+
+    def build_documents(self, item: dict, chunks: list[dict]) -> list[dict]:
+        """
+        チャンクごとに、インデクサーと同じフィールド構成のドキュメントを作成する.
+        """
+        folder_name, subfolder_name = get_folder_names(item)
+        identity = self.identities.get(item["id"]) or {"parent_id": make_parent_id(item["id"]), "documentId": item["id"]}
+        parent_id = identity["parent_id"]
+        document_path = unquote(urlparse(item.get("webUrl", "")).path)
+        documents = []
+        for chunk_index, chunk in enumerate(chunks):
+            document = {
+                "site_library_document_Id": make_document_key(parent_id, chunk_index),
+                "projectName": self.project_name,
+                "siteId": self.site_id,
+                "libraryId": item.get("parentReference", {}).get("driveId", ""),
+                "documentId": identity["documentId"],
+                "documentPath": document_path,
+                "folderName": folder_name,
+                "subfolderName": subfolder_name,
+                "folderPath": folder_path_prefixes(document_path),
+                "documentName": item.get("name", ""),
+                "documentUrl": item.get("webUrl", ""),
+                "last_modified": item.get("lastModifiedDateTime"),
+                "size": item.get("size"),
+                "parent_id": parent_id,
+                "header_1": chunk["header_1"],
+                "header_2": chunk["header_2"],
+                "header_3": chunk["header_3"],
+                "content": chunk["content"],
+            }
+            if not self.dedupe_text_fields:
+                document["chunk"] = chunk["content"]
+            documents.append(document)
+        return documents
+
+    async def chunk(self, batch: list[tuple[dict, bytes]]) -> list[dict]:
+        """
+        ファイルからテキストを取り出してチャンクに分割する.
+        """
+        results = []
+        for item, content in batch:
+            try:
+                markdown = await self.extract_markdown(item, content)
+                chunks = await self.chunker.achunk(markdown)
+                results.extend(self.build_documents(item, chunks))
+            except Exception as e:
+                self.metrics["chunk"].errors += 1
+                self._record_failure("chunk", item.get("name", item["id"]), e, [item["id"]])
+        return results
+
+    async def embed(self, batch: list[dict]) -> list[dict]:
+        """
+        チャンクをまとめて 1 回の呼び出しでベクトル化する (キャッシュ済みのチャンクは API を呼び出さない).
+        """
+        vectors = await self.embedder.aembed_documents([document["content"] for document in batch])
+        for document, vector in zip(batch, vectors):
+            document["content_vector"] = vector
+        return batch
+
+    async def upload(self, batch: list[dict]) -> list[dict]:
+        """
+        mergeOrUpload でインデックスにドキュメントをまとめて登録する.
+        """
+        payload = {"value": [{"@search.action": "mergeOrUpload", **document} for document in batch]}
+        response = await self.search_indexing.http_client.post(
+            f"/indexes('{self.index_name}')/docs/search.index",
+            params={"api-version": self.search_indexing.api_version},
+            json=payload,
+        )
+        # 207 は一部のドキュメントのみ失敗
+        if response.status_code not in (200, 207):
+            raise RuntimeError(f"アップロードに失敗しました ({response.status_code}): {response.text}")
+
+        uploaded = []
+        documents = {document["site_library_document_Id"]: document for document in batch}
+        for result in response.json().get("value", []):
+            document = documents[result["key"]]
+            item_id = self._item_id(document["documentId"])
+            if result.get("status"):
+                uploaded.append(document)
+                self.uploaded_keys.setdefault(item_id, set()).add(result["key"])
+            else:
+                self.metrics["upload"].errors += 1
+                self._record_failure("upload", result["key"], RuntimeError(result.get("errorMessage")), [item_id])
+        return uploaded
+
+    def document_status(self, item_id: str) -> dict:
+        """
+        ファイル単位の処理結果 (登録したチャンク数とエラー) を返す.
+        deferred: インデックスに未登録のファイルのため、インデクサーに任せた.
+        """
+        if item_id in self.deferred:
+            return {"status": "deferred", "chunks": 0, "errors": []}
+        errors = [failure["error"] for failure in self.failures if item_id in failure["document_ids"]]
+        chunks = len(self.uploaded_keys.get(item_id, ()))
+        return {
+            "status": "failed" if errors else "indexed",
+            "chunks": chunks,
+            "errors": errors,
+        }
+
+    async def _find_chunk_keys(self, document_id: str) -> list[str]:
+        """
+        インデックスに登録済みの、指定した documentId のチャンクのキーをすべて返す (page_query でページングする).
+        """
+        condition = project_filter(self.project_name, f"documentId eq '{escape_odata_string(document_id)}'")
+        keys, cursor = [], None
+        while True:
+            response = await self.search_indexing.http_client.post(
+                f"/indexes('{self.index_name}')/docs/search.post.search",
+                params={"api-version": self.search_indexing.api_version},
+                json={"search": "*", "select": f"{KEY_FIELD}, documentId", "top": 1000, **page_query(condition, cursor)},
+            )
+            response.raise_for_status()
+            documents = response.json().get("value", [])
+            if not documents:
+                return keys
+            keys += [document[KEY_FIELD] for document in documents]
+            cursor = advance_cursor(cursor, documents)
+
+    async def _delete_keys(self, keys: list[str]):
+        for start in range(0, len(keys), 1000):
+            response = await self.search_indexing.http_client.post(
+                f"/indexes('{self.index_name}')/docs/search.index",
+                params={"api-version": self.search_indexing.api_version},
+                json={"value": [{"@search.action": "delete", "site_library_document_Id": key} for key in keys[start:start + 1000]]},
+            )
+            response.raise_for_status()
+
+    async def remove_stale_chunks(self, item_ids: list[str]) -> int:
+        """
+        指定したファイルについて、今回アップロードしなかったチャンク (ファイルが短くなった場合の残りや、
+        引き継ぐ前の古い形式のキーのチャンク) を削除する. 処理に失敗した・インデクサーに任せたファイルは既存のチャンクを残す.
+        """
+        stale_keys = []
+        for item_id in item_ids:
+            if self.document_status(item_id)["status"] != "indexed":
+                continue
+            uploaded = self.uploaded_keys.get(item_id, set())
+            document_id = self.identities[item_id]["documentId"]
+            stale_keys.extend(key for key in await self._find_chunk_keys(document_id) if key not in uploaded)
+        if stale_keys:
+            await self._delete_keys(stale_keys)
+            logging.info(f"[push:{self.project_name}] 古いチャンクを {len(stale_keys)} 件削除しました")
+        return len(stale_keys)
+
+    async def delete_document_chunks(self, document_ids: list[str]) -> int:
+        """
+        SharePoint で削除されたファイルのチャンクをすべて削除する.
+        削除された driveItem からは documentUrl が取得できないため、documentId で特定する
+        (push で登録したチャンクは driveItem の ID、インデクサーのチャンクは metadata_spo_item_id).
+        """
+        keys = [key for document_id in document_ids for key in await self._find_chunk_keys(document_id)]
+        if keys:
+            await self._delete_keys(keys)
+            logging.info(f"[push:{self.project_name}] 削除されたファイルのチャンクを {len(keys)} 件削除しました")
+        return len(keys)
@@ -0,0 +1,576 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+from collections import Counter, deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import httpx
+import openai
+import requests
+from requests.adapters import HTTPAdapter
+
+from deadlines import DeadlineExceeded, remaining_seconds
+
+# 環境変数等の取得
+# 429 / 5xx・接続エラー時の最大試行回数 (初回を含む)
+retry_max_attempts = int(os.getenv("UPSTREAM_RETRY_MAX_ATTEMPTS", "5"))
+# 指数バックオフの基準・上限 (秒). Retry-After がこの上限を超える場合は待たずに応答を返す
+retry_base_delay = float(os.getenv("UPSTREAM_RETRY_BASE_DELAY", "0.5"))
+retry_max_delay = float(os.getenv("UPSTREAM_RETRY_MAX_DELAY", "30"))
+# 上流ごとの同時実行数の初期値・範囲 (AIMD で調整する)
+concurrency_initial = int(os.getenv("UPSTREAM_CONCURRENCY_INITIAL", "8"))
+concurrency_min = int(os.getenv("UPSTREAM_CONCURRENCY_MIN", "1"))
+concurrency_max = int(os.getenv("UPSTREAM_CONCURRENCY_MAX", "64"))
+# スロットリング時に同時実行数に掛ける係数
+concurrency_decrease_factor = float(os.getenv("UPSTREAM_CONCURRENCY_DECREASE_FACTOR", "0.5"))
+# 連続してこの回数失敗 (5xx・接続エラー) した上流はサーキットを開き、一定時間呼び出さずに失敗させる
+circuit_failure_threshold = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+# サーキットを開いておく秒数 (経過後に 1 件だけ試行し、成功すれば閉じる)
+circuit_open_seconds = float(os.getenv("CIRCUIT_OPEN_SECONDS", "30"))
+
+# 再試行するステータスコード
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+# スロットリングとみなし、同時実行数を減らすステータスコード
+THROTTLE_STATUS_CODES = {429, 503}
+# 同じ輻輳で何度も減らさないよう、減少の間隔をこの秒数以上あける
+DECREASE_COOLDOWN_SECONDS = 1.0
+
+
+def parse_retry_after(headers) -> float | None:
+    """
+    応答ヘッダーから待機秒数を返す (retry-after-ms / x-ms-retry-after-ms / Retry-After の秒数または日時).
+    """
+    for name in ("retry-after-ms", "x-ms-retry-after-ms"):
+        value = headers.get(name)
+        if value:
+            try:
+                return max(0.0, float(value) / 1000)
+            except ValueError:
+                pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int) -> float:
+    """
+    指数バックオフ (full jitter) の待機秒数. 同時に失敗したリクエストが同じタイミングで再試行しないようにする.
+    """
+    return random.uniform(0, min(retry_max_delay, retry_base_delay * 2 ** attempt))
+
+
+class CircuitOpenError(Exception):
+    """
+    サーキットが開いているため、上流を呼び出さずに失敗させたことを表す.
+    """
+    def __init__(self, upstream: str, retry_after: float):
+        super().__init__(f"{upstream} のサーキットが開いています (約 {retry_after:.0f} 秒後に再試行)")
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+
+class ConcurrencyLimitError(Exception):
+    """
+    同時実行数の上限に達しており、待機もできない (イベントループ上の同期呼び出し) ため、上流を呼び出さずに失敗させたことを表す.
+    """
+    def __init__(self, upstream: str):
+        super().__init__(f"{upstream} の同時実行数が上限に達しています")
+        self.upstream = upstream
+
+
+class CircuitBreaker:
+    """
+    上流ごとのサーキットブレーカー.
+    closed: 通常どおり呼び出す. failure_threshold 回連続で失敗すると open にする.
+    open: open_seconds の間は呼び出さずに CircuitOpenError を送出する.
+    half_open: open_seconds の経過後、1 件だけ試行する. 成功すれば closed、失敗すれば再び open にする.
+    """
+    def __init__(self, name: str, failure_threshold: int = None, open_seconds: float = None):
+        self.name = name
+        self.failure_threshold = failure_threshold or circuit_failure_threshold
+        self.open_seconds = open_seconds or circuit_open_seconds
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_count = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def _remaining(self) -> float:
+        return max(0.0, self.open_seconds - (time.monotonic() - self._opened_at))
+
+    def is_open(self) -> bool:
+        """
+        呼び出しても CircuitOpenError になるかどうか (呼び出す前に代替の処理へ切り替える場合に使用する).
+        """
+        with self._lock:
+            if self.state == "open":
+                return self._remaining() > 0
+            return self.state == "half_open" and self._probe_in_flight
+
+    def before_request(self):
+        with self._lock:
+            if self.state == "open":
+                if self._remaining() > 0:
+                    raise CircuitOpenError(self.name, self._remaining())
+                self.state = "half_open"
+                self._probe_in_flight = False
+            if self.state == "half_open":
+                if self._probe_in_flight:
+                    raise CircuitOpenError(self.name, self.open_seconds)
+                self._probe_in_flight = True
+
+    def record_success(self):
+        with self._lock:
+            if self.state != "closed":
+                logging.info(f"{self.name} のサーキットを閉じました")
+            self.state = "closed"
+            self.consecutive_failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            self._probe_in_flight = False
+            if self.state == "half_open" or (self.state == "closed" and self.consecutive_failures >= self.failure_threshold):
+                self.state = "open"
+                self._opened_at = time.monotonic()
+                self.opened_count += 1
+                logging.warning(f"{self.name} のサーキットを開きました ({self.consecutive_failures} 回連続で失敗)")
+
+    def record_cancel(self):
+        """
+        結果が分からないまま中断された呼び出し (タイムアウトによるキャンセルなど) の試行枠を解放する.
+        """
+        with self._lock:
+            self._probe_in_flight = False
+
+
+def cap_timeouts(timeouts: dict) -> dict:
+    """
+    httpx のタイムアウト (connect / read / write / pool) を、リクエストの残り時間以下にする.
+    """
+    remaining = remaining_seconds()
+    if remaining is None:
+        return timeouts
+    return {key: remaining if value is None else min(value, remaining) for key, value in timeouts.items()}
+
+
+def cap_requests_timeout(timeout):
+    """
+    requests の timeout (秒または (connect, read)) を、リクエストの残り時間以下にする.
+    """
+    remaining = remaining_seconds()
+    if remaining is None:
+        return timeout
+    if isinstance(timeout, tuple):
+        return tuple(remaining if value is None else min(value, remaining) for value in timeout)
+    return remaining if timeout is None else min(timeout, remaining)
+
+
+def _wake(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+class AdaptiveLimiter:
+    """
+    AIMD (加算増加・乗算減少) で同時実行数の上限を調整するリミッター.
+    成功するごとに上限を 1/上限 ずつ (上限分の成功で 1) 増やし、スロットリングされた場合は decrease_factor 倍に減らす.
+    同期 (acquire) と非同期 (acquire_async) の呼び出し元で同じ上限を共有する.
+    """
+    def __init__(self, initial: int = None, minimum: int = None, maximum: int = None, decrease_factor: float = None):
+        self.minimum = minimum or concurrency_min
+        self.maximum = maximum or concurrency_max
+        self.limit = float(min(max(initial or concurrency_initial, self.minimum), self.maximum))
+        self.decrease_factor = decrease_factor or concurrency_decrease_factor
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+        self._async_waiters: deque[tuple[asyncio.AbstractEventLoop, asyncio.Future]] = deque()
+        self._last_decrease = 0.0
+
+    def _has_capacity(self) -> bool:
+        return self.in_flight < int(self.limit)
+
+    def _notify(self):
+        # 待機中の同期・非同期の呼び出し元を 1 つずつ起こす (起きた側が改めて空きを確認する)
+        self._condition.notify()
+        while self._async_waiters:
+            loop, future = self._async_waiters.popleft()
+            if not future.done():
+                loop.call_soon_threadsafe(_wake, future)
+                break
+
+    def acquire(self):
+        with self._condition:
+            while not self._has_capacity():
+                self._condition.wait(timeout=1.0)
+            self.in_flight += 1
+
+    def try_acquire(self) -> bool:
+        """
+        空きがあれば確保して True を返す. 待機しない.
+        """
+        with self._lock:
+            if not self._has_capacity():
+                return False
+            self.in_flight += 1
+            return True
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                if self._has_capacity():
+                    self.in_flight += 1
+                    return
+                future = loop.create_future()
+                self._async_waiters.append((loop, future))
+            # 起こされなかった場合 (上限の増加など) も定期的に空きを確認する
+            await asyncio.wait([future], timeout=1.0)
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+            self._notify()
+
+    def on_success(self):
+        with self._lock:
+            previous = int(self.limit)
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            if int(self.limit) > previous:
+                self._notify()
+
+    def on_throttle(self):
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_decrease >= DECREASE_COOLDOWN_SECONDS:
+                self.limit = max(self.minimum, self.limit * self.decrease_factor)
+                self._last_decrease = now
+
+
+class Upstream:
+    """
+    外部サービス (上流) 1 つ分の同時実行数の制御・再試行・サーキットブレーカー・メトリクス.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self.limiter = AdaptiveLimiter()
+        self.breaker = CircuitBreaker(name)
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+        self.failures = 0
+        self.transport_errors = 0
+        self.status_codes = Counter()
+        self.latency_seconds = 0.0
+        self.limiter_wait_seconds = 0.0
+        self.last_retry_after: float | None = None
+
+    def observe(self, status_code: int, headers, latency: float = 0.0):
+        """
+        応答 1 件を記録し、同時実行数の上限を調整する.
+        """
+        self.requests += 1
+        self.status_codes[status_code] += 1
+        self.latency_seconds += latency
+        if status_code in THROTTLE_STATUS_CODES:
+            self.throttled += 1
+            self.last_retry_after = parse_retry_after(headers)
+            self.limiter.on_throttle()
+        elif status_code < 500:
+            self.limiter.on_success()
+        # スロットリングは障害とみなさない (同時実行数の調整で対応する)
+        if status_code >= 500 and status_code not in THROTTLE_STATUS_CODES:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+
+    def _retry_delay(self, status_code: int, headers, attempt: int) -> float | None:
+        """
+        再試行する場合は待機秒数、しない場合は None を返す.
+        """
+        if status_code not in RETRYABLE_STATUS_CODES:
+            return None
+        retry_after = parse_retry_after(headers)
+        if attempt + 1 >= retry_max_attempts or (retry_after or 0) > retry_max_delay:
+            self.failures += 1
+            return None
+        delay = retry_after + random.uniform(0, retry_base_delay) if retry_after is not None else backoff_delay(attempt)
+        # 待機するとリクエストの期限を過ぎる場合は再試行しない
+        remaining = remaining_seconds()
+        if remaining is not None and delay >= remaining:
+            self.failures += 1
+            return None
+        return delay
+
+    def _on_transport_error(self, error: Exception, attempt: int) -> float:
+        self.requests += 1
+        self.transport_errors += 1
+        remaining = remaining_seconds()
+        # リクエストの期限に合わせて短くしたタイムアウトによる失敗は、上流の障害として数えない
+        if remaining is not None and remaining <= 0:
+            self.failures += 1
+            raise DeadlineExceeded(self.name) from error
+        self.breaker.record_failure()
+        if attempt + 1 >= retry_max_attempts:
+            self.failures += 1
+            raise error
+        delay = backoff_delay(attempt)
+        if remaining is not None and delay >= remaining:
+            self.failures += 1
+            raise DeadlineExceeded(self.name) from error
+        return delay
+
+    def _check_deadline(self):
+        remaining = remaining_seconds()
+        if remaining is not None and remaining <= 0:
+            raise DeadlineExceeded(self.name)
+
+    async def send_async(self, send, close, retryable_exceptions: tuple = ()):
+        """
+        send (1 回分の送信を行う coroutine function) を、同時実行数の上限内で実行し、429 / 5xx・接続エラーの場合は再試行する.
+        再試行する応答は close で閉じる. サーキットが開いている場合は呼び出さずに CircuitOpenError を送出する.
+        リクエストの期限 (deadlines) が設定されている場合は、枠の待機・再試行をその残り時間内に収める.
+        """
+        for attempt in range(retry_max_attempts):
+            self._check_deadline()
+            self.breaker.before_request()
+            waited = time.perf_counter()
+            try:
+                await asyncio.wait_for(self.limiter.acquire_async(), timeout=remaining_seconds())
+            except BaseException as e:
+                self.breaker.record_cancel()
+                if isinstance(e, asyncio.TimeoutError):
+                    raise DeadlineExceeded(self.name) from None
+                raise
+            started = time.perf_counter()
+            self.limiter_wait_seconds += started - waited
+            try:
+                response = await send()
+            except retryable_exceptions as e:
+                self.limiter.release()
+                delay = self._on_transport_error(e, attempt)
+            except BaseException:
+                self.limiter.release()
+                self.breaker.record_cancel()
+                raise
+            else:
+                self.limiter.release()
+                self.observe(response.status_code, response.headers, time.perf_counter() - started)
+                delay = self._retry_delay(response.status_code, response.headers, attempt)
+                if delay is None:
+                    return response
+                await close(response)
+            self.retries += 1
+            logging.warning(f"{self.name}: {attempt + 1} 回目の呼び出しに失敗したため {delay:.1f} 秒後に再試行します")
+            await asyncio.sleep(delay)
+
+    def send(self, send, close, retryable_exceptions: tuple = ()):
+        """
+        send_async の同期版.
+        イベントループのスレッドから呼び出された場合は、ループを止めないよう待機しない
+        (同時実行数の空きがなければ ConcurrencyLimitError、再試行せずにその時点の結果を返す).
+        async の処理からは asyncio.to_thread で呼び出すこと.
+        """
+        on_event_loop = running_on_event_loop()
+        for attempt in range(retry_max_attempts):
+            self._check_deadline()
+            self.breaker.before_request()
+            waited = time.perf_counter()
+            if not on_event_loop:
+                self.limiter.acquire()
+            elif not self.limiter.try_acquire():
+                # 空きを待つとイベントループ全体が止まる (空きを作る他のタスクも動けない) ため、待たずに失敗させる
+                self.breaker.record_cancel()
+                raise ConcurrencyLimitError(self.name)
+            started = time.perf_counter()
+            self.limiter_wait_seconds += started - waited
+            try:
+                response = send()
+            except retryable_exceptions as e:
+                self.limiter.release()
+                delay = self._on_transport_error(e, attempt)
+                if on_event_loop:
+                    logging.warning(f"{self.name}: イベントループ上の同期呼び出しのため再試行しません")
+                    raise
+            except BaseException:
+                self.limiter.release()
+                self.breaker.record_cancel()
+                raise
+            else:
+                self.limiter.release()
+                self.observe(response.status_code, response.headers, time.perf_counter() - started)
+                delay = self._retry_delay(response.status_code, response.headers, attempt)
+                if delay is None:
+                    return response
+                if on_event_loop:
+                    logging.warning(f"{self.name}: イベントループ上の同期呼び出しのため再試行しません ({response.status_code})")
+                    return response
+                close(response)
+            self.retries += 1
+            logging.warning(f"{self.name}: {attempt + 1} 回目の呼び出しに失敗したため {delay:.1f} 秒後に再試行します")
+            time.sleep(delay)
+
+    def stats(self) -> dict:
+        timed = self.requests - self.transport_errors
+        return {
+            "circuit": self.breaker.state,
+            "circuit_opened": self.breaker.opened_count,
+            "concurrency_limit": round(self.limiter.limit, 2),
+            "in_flight": self.limiter.in_flight,
+            "requests": self.requests,
+            "retries": self.retries,
+            "throttled": self.throttled,
+            "failures": self.failures,
+            "transport_errors": self.transport_errors,
+            "status_codes": {str(code): count for code, count in sorted(self.status_codes.items())},
+            "avg_latency_ms": round(self.latency_seconds / timed * 1000, 1) if timed else None,
+            "avg_limiter_wait_ms": round(self.limiter_wait_seconds / self.requests * 1000, 1) if self.requests else None,
+            "last_retry_after": self.last_retry_after,
+        }
+
+
+_upstreams: dict[str, Upstream] = {}
+
+
+def running_on_event_loop() -> bool:
+    """
+    現在のスレッドでイベントループが実行中かどうか.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+def get_upstream(name: str) -> Upstream:
+    if name not in _upstreams:
+        _upstreams[name] = Upstream(name)
+    return _upstreams[name]
+
+
+def upstream_stats() -> dict:
+    """
+    上流ごとのメトリクス (同時実行数の上限・再試行・スロットリング・レイテンシ) を返す.
+    """
+    return {name: upstream.stats() for name, upstream in sorted(_upstreams.items())}
+
+
+async def _aclose_httpx(response: httpx.Response):
+    await response.aclose()
+
+
+class ResilientAsyncTransport(httpx.AsyncBaseTransport):
+    """
+    httpx.AsyncClient 用のトランスポート. 上流 upstream の同時実行数の制御と再試行を行う.
+    transport_kwargs (limits など) は内部の AsyncHTTPTransport に渡す.
+    """
+    def __init__(self, upstream: str, **transport_kwargs):
+        self.upstream = get_upstream(upstream)
+        self.transport = httpx.AsyncHTTPTransport(**transport_kwargs)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        async def send():
+            # 試行ごとに、その時点の残り時間でタイムアウトを短くする
+            request.extensions["timeout"] = cap_timeouts(request.extensions.get("timeout", {}))
+            return await self.transport.handle_async_request(request)
+
+        return await self.upstream.send_async(send, _aclose_httpx, (httpx.TransportError,))
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+class ResilientTransport(httpx.BaseTransport):
+    """
+    ResilientAsyncTransport の同期版 (httpx.Client 用).
+    """
+    def __init__(self, upstream: str, **transport_kwargs):
+        self.upstream = get_upstream(upstream)
+        self.transport = httpx.HTTPTransport(**transport_kwargs)
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        def send():
+            request.extensions["timeout"] = cap_timeouts(request.extensions.get("timeout", {}))
+            return self.transport.handle_request(request)
+
+        return self.upstream.send(send, lambda response: response.close(), (httpx.TransportError,))
+
+    def close(self):
+        self.transport.close()
+
+
+class ResilientHTTPAdapter(HTTPAdapter):
+    """
+    requests.Session 用のアダプター. 上流 upstream の同時実行数の制御と再試行を行う.
+    """
+    def __init__(self, upstream: str, **kwargs):
+        self.upstream = get_upstream(upstream)
+        super().__init__(**kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        def send():
+            return HTTPAdapter.send(self, request, timeout=cap_requests_timeout(timeout), **kwargs)
+
+        return self.upstream.send(send, lambda response: response.close(), (requests.ConnectionError, requests.Timeout))
+
+
+def resilient_session(upstream: str) -> requests.Session:
+    session = requests.Session()
+    adapter = ResilientHTTPAdapter(upstream)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def record_cosmos_response(pipeline_response):
+    """
+    CosmosClient の raw_response_hook. Cosmos DB の SDK は 429 を x-ms-retry-after-ms に従って自身で再試行するため、
+    ここではメトリクスのみ記録する.
+    """
+    response = pipeline_response.http_response
+    get_upstream("cosmos").observe(response.status_code, response.headers)
+
+
+def unwrap_error(error: Exception) -> Exception:
+    """
+    SDK (openai など) がトランスポートの例外を自身の例外 (APIConnectionError など) で包んでいる場合に、
+    __cause__ をたどって元の CircuitOpenError / ConcurrencyLimitError / DeadlineExceeded を返す. 見つからない場合は error をそのまま返す.
+    """
+    cause, seen = error, set()
+    while cause is not None and id(cause) not in seen:
+        if isinstance(cause, (CircuitOpenError, ConcurrencyLimitError, DeadlineExceeded)):
+            return cause
+        seen.add(id(cause))
+        cause = cause.__cause__
+    return error
+
+
+def is_throttled_error(error: Exception) -> bool:
+    """
+    再試行しても上流のスロットリングが解消しなかった (または同時実行数の上限で呼び出せなかった) エラーかどうか.
+    """
+    if isinstance(error, ConcurrencyLimitError):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in THROTTLE_STATUS_CODES
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in THROTTLE_STATUS_CODES
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code in THROTTLE_STATUS_CODES
+    return False
@@ -0,0 +1,268 @@
+import os
+import asyncio
+import logging
+import httpx
+from langchain.schema import Document
+
+from local_ann import LocalVectorIndex
+from resilience import ResilientAsyncTransport
+from indexing_service import KEY_FIELD, escape_odata_string, normalize_folder_path
+
+# 環境変数等の取得
+azure_search_endpoint = os.getenv("AZURE_SEARCH_ENDPOINT")
+azure_search_key = os.getenv("AZURE_SEARCH_ADMIN_KEY")
+service_name = "srch-rag-dev-001"
+# 検索バックエンド ("azure": Azure AI Search, "local": ローカルインデックス, "auto": ローカルインデックスがあれば優先)
+retriever_backend = os.getenv("RETRIEVER_BACKEND", "azure")
+local_index_dir = os.getenv("LOCAL_INDEX_DIR", "local_indexes")
+
+# 検索結果として取得するフィールド
+SELECT_FIELDS = [KEY_FIELD, "parent_id", "folderName", "content", "documentUrl", "documentName", "last_modified"]
+# 文字列のコレクションのフィールド (any() で条件を指定する)
+COLLECTION_FILTER_FIELDS = ("folderPath",)
+# 前後のチャンクの展開で、1 回のクエリで取得するチャンク (キー) の件数
+CHUNK_FETCH_BATCH_SIZE = 100
+
+
+class SearchFilter:
+    """
+    バックエンドに依存しない検索条件. 各バックエンドがそれぞれの形式 (OData など) に変換する.
+    """
+    def __init__(self, folder_name: str = None, subfolder_name: str = None, project_name: str = None, folder_path: str = None):
+        self.folder_name = folder_name
+        self.subfolder_name = subfolder_name
+        # 共有インデックスを検索する場合のみ指定する
+        self.project_name = project_name
+        # 任意の階層のフォルダ ("A/B/C"). 指定した場合は folder_name, subfolder_name より優先する
+        self.folder_path = normalize_folder_path(folder_path) if folder_path else None
+
+    def conditions(self) -> dict[str, str]:
+        """
+        フィールド名と値の完全一致条件 (AND) を返す.
+        folder_name = "FOLDER_ALL" (または未指定) の場合はフォルダの条件なし,
+        subfolder_name = "SUBFOLDER_ALL" (または未指定) の場合はフォルダ名のみで絞り込む.
+        project_name を指定した場合は projectName でも絞り込む.
+        folder_path を指定した場合は folderPath (親フォルダのパスの接頭辞のコレクション) にそのパスを含むものに絞り込む.
+        """
+        conditions = {"projectName": self.project_name} if self.project_name else {}
+        if self.folder_path:
+            conditions["folderPath"] = self.folder_path
+            return conditions
+        if not self.folder_name or self.folder_name == "FOLDER_ALL":
+            return conditions
+        conditions["folderName"] = self.folder_name
+        if self.subfolder_name and self.subfolder_name != "SUBFOLDER_ALL":
+            conditions["subfolderName"] = self.subfolder_name
+        return conditions
+
+
+def build_filter_condition(folder_name: str, subfolder_name: str, project_name: str = None, folder_path: str = None) -> str | None:
+    """
+    folder_name と subfolder_name の組み合わせに応じて、
+    OData フィルタ文字列 (folderName, subfolderName) を生成する。
+    folder_name = "FOLDER_ALL" フィルタリングなし (None)
+    それ以外の場合:
+        subfolder_name = "SUBFOLDER_ALL" フォルダ名のみフィルタリング："folderName eq 'xxx'"
+        subfolder_name != "SUBFOLDER_ALL" フォルダ名とサブフォルダ名でフィルタリング："folderName eq 'xxx' and subfolderName eq 'yyy'"
+    project_name を指定した場合 (共有インデックス) は "projectName eq 'zzz'" を追加する.
+    folder_path を指定した場合はフォルダ名の代わりに "folderPath/any(p: p eq 'A/B')" で絞り込む.
+    値のシングルクォートはエスケープする.
+    """
+    conditions = SearchFilter(folder_name, subfolder_name, project_name, folder_path).conditions()
+    if not conditions:
+        return None
+    return " and ".join(
+        f"{field}/any(p: p eq '{escape_odata_string(value)}')" if field in COLLECTION_FILTER_FIELDS
+        else f"{field} eq '{escape_odata_string(value)}'"
+        for field, value in conditions.items()
+    )
+
+
+def to_document(item: dict, score: float) -> Document:
+    """
+    検索結果の 1 件を LangChain の Document に変換する (バックエンド共通の形式).
+    """
+    metadata = {
+        "id": item.get(KEY_FIELD, ""),  # チャンクのキー
+        "parent_id": item.get("parent_id", ""),
+        "documentUrl": item.get("documentUrl", ""),
+        "documentName": item.get("documentName", ""),
+        "last_modified": item.get("last_modified", ""),
+        "folderName": item.get("folderName", ""),
+        "@search.score": score,
+    }
+    return Document(page_content=item.get("content", ""), metadata=metadata)
+
+
+class AzureSearchRetriever:
+    """
+    Azure AI Search の REST API でベクトル検索 + フィルターを実行するバックエンド.
+    """
+    name = "azure"
+
+    def __init__(self, endpoint: str = None, api_key: str = None):
+        self.endpoint = endpoint or azure_search_endpoint or f"https://{service_name}.search.windows.net"
+        self.api_key = api_key or azure_search_key
+        self._http_client: httpx.AsyncClient | None = None
+
+    @property
+    def http_client(self) -> httpx.AsyncClient:
+        if self._http_client is None or self._http_client.is_closed:
+            self._http_client = httpx.AsyncClient(
+                base_url=self.endpoint,
+                headers={"Content-Type": "application/json", "api-key": self.api_key or ""},
+                timeout=httpx.Timeout(30.0, connect=5.0),
+                # インデックス作成 (search-indexing) の負荷で検索が待たされないよう、上流を分けて同時実行数を管理する
+                transport=ResilientAsyncTransport(
+                    "search", limits=httpx.Limits(max_connections=50, max_keepalive_connections=20)
+                ),
+            )
+        return self._http_client
+
+    async def aclose(self):
+        if self._http_client is not None and not self._http_client.is_closed:
+            await self._http_client.aclose()
+        self._http_client = None
+
+    def has_index(self, index_name: str) -> bool:
+        return True
+
+    async def search(
+        self,
+        index_name: str,
+        query_vector: list[float],
+        search_filter: SearchFilter,
+        top: int = 3,
+        vector_filter_mode: str = "preFilter",  # preFilter設定
+        oversampling: float = None,  # 圧縮ベクトルを使用するインデックスでのオーバーサンプリング倍率
+    ) -> list[Document]:
+        #  REST API 用 JSON ボディを構築
+        body = {
+            "select": ", ".join(SELECT_FIELDS), # 取得するフィールド名を指定する
+            "filter": build_filter_condition(
+                search_filter.folder_name, search_filter.subfolder_name, search_filter.project_name, search_filter.folder_path
+            ),  # OData フィルター
+            "vectorFilterMode": vector_filter_mode,
+            "vectorQueries": [
+                {
+                    "kind": "vector",
+                    "fields": "content_vector",  # インデックスで定義したベクトルフィールド
+                    "vector": query_vector,
+                    "k": top
+                }
+            ]
+        }
+        # 圧縮ベクトルで k * oversampling 件の候補を取得し、元のベクトルで再スコアリングする
+        if oversampling:
+            body["vectorQueries"][0]["oversampling"] = oversampling
+
+        response = await self.http_client.post(
+            f"/indexes/{index_name}/docs/search",
+            params={"api-version": "2024-07-01"},
+            json=body,
+        )
+        response.raise_for_status()
+        return [to_document(item, item.get("@search.score", 0)) for item in response.json().get("value", [])]
+
+    async def fetch_chunks(self, index_name: str, parent_ids: list[str], keys: list[str]) -> list[dict]:
+        """
+        チャンクのうちキーが keys に含まれるものをまとめて取得する (前後のチャンクの展開に使用する).
+        キー (site_library_document_Id) は filterable ではないが keyword アナライザーで検索できるため、
+        親ドキュメント (parent_id) のフィルターとキーのフレーズ検索 (searchFields) で必要なチャンクだけを取得する.
+        """
+        wanted = list(dict.fromkeys(keys))
+        if not wanted or not parent_ids:
+            return []
+        # parent_id に使用される文字 (英数字, "_", "-", "=") に含まれない "|" を区切り文字にする
+        condition = f"search.in(parent_id, '{escape_odata_string('|'.join(parent_ids))}', '|')"
+        found = []
+        for start in range(0, len(wanted), CHUNK_FETCH_BATCH_SIZE):
+            batch = wanted[start:start + CHUNK_FETCH_BATCH_SIZE]
+            # キー全体を 1 つのフレーズとして一致させる ("-" などが演算子として解釈されないようにする)
+            query = " | ".join('"' + key.replace("\\", "\\\\").replace('"', '\\"') + '"' for key in batch)
+            response = await self.http_client.post(
+                f"/indexes/{index_name}/docs/search",
+                params={"api-version": "2024-07-01"},
+                json={
+                    "search": query,
+                    "searchFields": KEY_FIELD,
+                    "queryType": "simple",
+                    "searchMode": "any",
+                    "filter": condition,
+                    "select": f"{KEY_FIELD}, content",
+                    "top": len(batch),
+                },
+            )
+            response.raise_for_status()
+            found += [item for item in response.json().get("value", []) if item.get(KEY_FIELD) in batch]
+        return found
+
+
+class LocalVectorRetriever:
+    """
+    ディスク上のローカルインデックス (local_ann.LocalVectorIndex) を検索するバックエンド.
+    ホットなプロジェクトの低レイテンシな読み取りレプリカ、およびローカル環境での検証に使用する.
+    インデックスは {LOCAL_INDEX_DIR}/{index_name}/ に tools/build_local_index.py で作成する.
+    """
+    name = "local"
+
+    def __init__(self, directory: str = None):
+        self.directory = directory or local_index_dir
+        self._indexes: dict[str, LocalVectorIndex] = {}
+
+    def _index_path(self, index_name: str) -> str:
+        return os.path.join(self.directory, index_name)
+
+    def has_index(self, index_name: str) -> bool:
+        return index_name in self._indexes or os.path.exists(os.path.join(self._index_path(index_name), "vectors.npy"))
+
+    def get_index(self, index_name: str) -> LocalVectorIndex:
+        if index_name not in self._indexes:
+            self._indexes[index_name] = LocalVectorIndex(self._index_path(index_name))
+            logging.info(f"ローカルインデックス '{index_name}' を読み込みました ({len(self._indexes[index_name])} 件)")
+        return self._indexes[index_name]
+
+    async def aclose(self):
+        self._indexes.clear()
+
+    async def search(
+        self,
+        index_name: str,
+        query_vector: list[float],
+        search_filter: SearchFilter,
+        top: int = 3,
+        vector_filter_mode: str = "preFilter",
+        oversampling: float = None,
+    ) -> list[Document]:
+        # 検索処理は CPU バウンドのため、イベントループを塞がないよう別スレッドで実行する
+        def run():
+            index = self.get_index(index_name)
+            return index.search(query_vector, top, search_filter.conditions())
+
+        results = await asyncio.to_thread(run)
+        return [to_document(item, score) for item, score in results]
+
+    async def fetch_chunks(self, index_name: str, parent_ids: list[str], keys: list[str]) -> list[dict]:
+        # ローカルインデックスはキーで直接引ける
+        return self.get_index(index_name).lookup(KEY_FIELD, keys)
+
+
+azure_retriever = AzureSearchRetriever()
+local_retriever = LocalVectorRetriever()
+
+
+def get_retriever(index_name: str):
+    """
+    インデックスを検索するバックエンドを返す.
+    RETRIEVER_BACKEND=auto の場合はローカルインデックスが存在すればローカル、なければ Azure AI Search を使用する.
+    """
+    if retriever_backend == "local":
+        return local_retriever
+    if retriever_backend == "auto" and local_retriever.has_index(index_name):
+        return local_retriever
+    return azure_retriever
+
+
+async def close_retrievers():
+    await azure_retriever.aclose()
+    await local_retriever.aclose()
@@ -0,0 +1,133 @@
+import os
+import logging
+from collections import deque
+
+from langchain.schema import Document
+
+from openai_pool import upstream_unavailable
+
+# 環境変数等の取得
+# 難しい質問 (複数の資料をまとめる質問など) に使用するデプロイメント
+answer_full_deployment = os.getenv("ANSWER_FULL_DEPLOYMENT", "gpt-4o")
+# 簡単な質問 (1 つの資料を引けば答えられる質問) に使用する小さく速いデプロイメント. 未設定の場合はすべて full で回答する
+answer_fast_deployment = os.getenv("ANSWER_FAST_DEPLOYMENT")
+# fast に振り分ける質問の文字数の上限
+route_fast_max_question_chars = int(os.getenv("ROUTE_FAST_MAX_QUESTION_CHARS", "80"))
+# 検索結果の参照ドキュメント (URL) の数がこれ以下であれば、1 つの資料で答えられる質問とみなす
+route_fast_max_sources = int(os.getenv("ROUTE_FAST_MAX_SOURCES", "1"))
+# 参照ドキュメントが複数でも、1 位と 2 位のスコアの差がこれ以上あれば 1 位の資料で答えられる質問とみなす
+route_fast_min_score_margin = float(os.getenv("ROUTE_FAST_MIN_SCORE_MARGIN", "0.05"))
+# ルートごとのレイテンシの分位数の計算に使用する直近の件数
+route_latency_window = int(os.getenv("ROUTE_LATENCY_WINDOW", "500"))
+
+# プロジェクトのレコードの answer_route に指定できる値 (auto: 質問ごとに判定する)
+ROUTE_MODES = ("auto", "fast", "full")
+
+
+def route_deployment(route: str) -> str:
+    return answer_fast_deployment if route == "fast" and answer_fast_deployment else answer_full_deployment
+
+
+def route_upstream(route: str) -> str:
+    """
+    ルートの LLM 呼び出しに使用する上流の名前. デプロイメントごとにクォータが異なるため、同時実行数とサーキットも分ける.
+    """
+    return "openai-chat-fast" if route == "fast" else "openai-chat"
+
+
+def question_features(user_question: str, retrieved_docs: list[Document]) -> dict:
+    """
+    ルーティングの判定に使用する特徴量 (質問の文字数・参照ドキュメントの数・検索スコアの 1 位と 2 位の差).
+    """
+    scores = sorted((doc.metadata.get("@search.score") or 0 for doc in retrieved_docs), reverse=True)
+    sources = {doc.metadata.get("documentUrl") for doc in retrieved_docs}
+    return {
+        "question_chars": len((user_question or "").strip()),
+        "distinct_sources": len(sources),
+        "top_score": scores[0] if scores else None,
+        "score_margin": scores[0] - scores[1] if len(scores) >= 2 else None,
+    }
+
+
+def classify_question(features: dict) -> tuple[str, str]:
+    """
+    特徴量から質問の難しさを判定し、(ルート, 理由) を返す.
+    短い質問で、1 つの資料 (参照ドキュメントが少ない、または 1 位のスコアが突出している) で答えられるものを fast とする.
+    """
+    if features["question_chars"] > route_fast_max_question_chars:
+        return "full", "long_question"
+    if features["distinct_sources"] == 0:
+        return "full", "no_sources"
+    if features["distinct_sources"] <= route_fast_max_sources:
+        return "fast", "single_source"
+    margin = features["score_margin"]
+    if margin is not None and margin >= route_fast_min_score_margin:
+        return "fast", "clear_top_match"
+    return "full", "multi_source"
+
+
+def choose_route(user_question: str, retrieved_docs: list[Document], mode: str = "auto") -> dict:
+    """
+    回答に使用するルート (fast / full) を決める. mode はプロジェクトごとの指定 (auto の場合は質問ごとに判定する).
+    fast のデプロイメントが未設定、またはそのサーキットが開いている (プールの場合はすべてのエンドポイントを利用できない) 場合は full を使用する.
+    """
+    features = question_features(user_question, retrieved_docs)
+    if mode in ("fast", "full"):
+        route, reason = mode, "project_override"
+    else:
+        route, reason = classify_question(features)
+    if route == "fast" and not answer_fast_deployment:
+        route, reason = "full", "fast_not_configured"
+    elif route == "fast" and upstream_unavailable(route_upstream("fast")):
+        route, reason = "full", "fast_circuit_open"
+
+    decision = {"route": route, "deployment": route_deployment(route), "reason": reason, "features": features}
+    logging.info(
+        f"ルーティング: {route} ({decision['deployment']}, 理由: {reason}, 文字数: {features['question_chars']}, "
+        f"参照ドキュメント: {features['distinct_sources']}, スコア差: {features['score_margin']})"
+    )
+    return decision
+
+
+class RouteMetrics:
+    """
+    ルートごとの件数・判定理由・LLM のレイテンシ (直近 ROUTE_LATENCY_WINDOW 件の分位数) を集計する.
+    """
+    def __init__(self):
+        self._routes: dict[str, dict] = {}
+
+    def _entry(self, route: str) -> dict:
+        return self._routes.setdefault(route, {
+            "requests": 0,
+            "degraded": 0,
+            "reasons": {},
+            "latencies": deque(maxlen=route_latency_window),
+        })
+
+    def record(self, decision: dict, seconds: float, degraded: bool = False):
+        entry = self._entry(decision["route"])
+        entry["requests"] += 1
+        entry["degraded"] += int(degraded)
+        entry["reasons"][decision["reason"]] = entry["reasons"].get(decision["reason"], 0) + 1
+        entry["latencies"].append(seconds)
+        logging.info(f"ルート {decision['route']} の LLM の処理時間: {seconds * 1000:.0f} ms (degraded: {degraded})")
+
+    def stats(self) -> dict:
+        stats = {}
+        for route, entry in sorted(self._routes.items()):
+            latencies = sorted(entry["latencies"])
+
+            def percentile(p):
+                return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 1) if latencies else None
+            stats[route] = {
+                "deployment": route_deployment(route),
+                "requests": entry["requests"],
+                "degraded": entry["degraded"],
+                "reasons": dict(entry["reasons"]),
+                "p50_latency_ms": percentile(0.5),
+                "p95_latency_ms": percentile(0.95),
+            }
+        return stats
+
+
+route_metrics = RouteMetrics()
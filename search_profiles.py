@@ -0,0 +1,113 @@
+import os
+from typing import Literal, Optional
+from pydantic import BaseModel, Field, field_validator
+
+
+class IndexStorageProfile(BaseModel):
+    """
+    インデックスの保存形式に関する設定.
+    既定値は従来のインデックス定義 (圧縮なし・ベクトル原本を保存・content/chunk の両方を保持) と同じ.
+    """
+    # ベクトル圧縮方式 ("scalar": int8 へのスカラー量子化, "binary": 1bit へのバイナリ量子化)
+    compression: Literal["none", "scalar", "binary"] = "none"
+    # False の場合 content_vector を stored=False とし、取得用のベクトル原本を保存しない
+    store_raw_vector: bool = True
+    # 圧縮ベクトルで候補を取得した後、元のベクトルで再スコアリングする
+    rerank_with_original_vectors: bool = True
+    # 圧縮ベクトル検索時に k の何倍の候補を取得するか (クエリ時にも指定する)
+    oversampling: Optional[float] = Field(default=None, ge=1.0)
+    # True の場合 content と同じ内容を持つ chunk フィールドを作成しない
+    dedupe_text_fields: bool = False
+
+    @property
+    def compression_name(self) -> str | None:
+        if self.compression == "none":
+            return None
+        return f"{self.compression}-quantization"
+
+    @property
+    def vector_search_profile_name(self) -> str:
+        """
+        圧縮設定ごとにプロファイル名を分け、圧縮方式の変更をフィールド定義の変更として検出できるようにする.
+        """
+        if self.compression == "none":
+            return "vector_profile"
+        return f"vector_profile_{self.compression}"
+
+    @property
+    def query_oversampling(self) -> float | None:
+        """
+        クエリ時に指定するオーバーサンプリング倍率 (圧縮なしの場合は指定できない).
+        """
+        if self.compression == "none":
+            return None
+        return self.oversampling
+
+
+class VectorAlgorithmProfile(BaseModel):
+    """
+    プロジェクトごとのベクトル検索アルゴリズムの設定.
+    既定値は Azure AI Search の HNSW 既定値 (m=4, efConstruction=400, efSearch=500, cosine) と同じ.
+    小規模なプロジェクトでは exhaustiveKnn (全件探索) でも十分に高速で、再現率は常に 1 になる.
+    """
+    kind: Literal["hnsw", "exhaustiveKnn"] = "hnsw"
+    # グラフの各ノードが持つ双方向リンク数 (大きいほど再現率・メモリ使用量が増える)
+    m: int = Field(default=4, ge=4, le=10)
+    # インデックス作成時の探索候補数 (大きいほど構築が遅くなり、グラフの品質が上がる)
+    ef_construction: int = Field(default=400, ge=100, le=1000)
+    # クエリ時の探索候補数 (大きいほど再現率が上がり、レイテンシが増える)
+    ef_search: int = Field(default=500, ge=100, le=1000)
+    metric: Literal["cosine", "euclidean", "dotProduct"] = "cosine"
+
+    @property
+    def algorithm_name(self) -> str:
+        if self.kind == "exhaustiveKnn":
+            return "exhaustive-knn-algorithm"
+        return "vector-for-verification-algorithm"
+
+
+class IndexingPerformanceProfile(BaseModel):
+    """
+    プロジェクトごとのインデクサーの実行設定 (バッチサイズ・失敗の許容数・サイズ超過時の扱い・対象とする拡張子).
+    既定値は従来のインデクサー定義 (サービス既定のバッチサイズ・失敗を無制限に許容・サイズ超過はメタデータのみ・全拡張子) と同じ.
+    """
+    # 1 バッチで処理するファイル数 (None の場合はサービスの既定値). ファイルが大きい場合は小さくする
+    batch_size: Optional[int] = Field(default=None, ge=1, le=1000)
+    # 実行全体・バッチごとに許容する失敗件数 (-1 は無制限)
+    max_failed_items: int = Field(default=-1, ge=-1)
+    max_failed_items_per_batch: int = Field(default=-1, ge=-1)
+    # True の場合、価格レベルの上限を超えるファイルはメタデータのみを登録する (False の場合は失敗として扱う)
+    index_metadata_only_for_oversized_documents: bool = True
+    # 価格レベルの抽出上限 (MB). Basic: 16, S1: 128, S2 以上: 256. 見積もりでサイズ超過のファイルを判定するために使用する
+    max_file_size_mb: float = Field(default=16, gt=0)
+    # 対象とする拡張子 (空の場合はすべて) と除外する拡張子 (バイナリなど). 例: [".pdf", ".docx"]
+    indexed_file_name_extensions: list[str] = []
+    excluded_file_name_extensions: list[str] = []
+
+    @field_validator("indexed_file_name_extensions", "excluded_file_name_extensions")
+    @classmethod
+    def normalize_extensions(cls, extensions: list[str]) -> list[str]:
+        """
+        "PDF" / ".pdf" のどちらの形式でも受け付け、小文字・先頭に "." を付けた形式にそろえる.
+        """
+        normalized = []
+        for extension in extensions:
+            extension = extension.strip().lower()
+            if extension and not extension.startswith("."):
+                extension = f".{extension}"
+            if extension and extension not in normalized:
+                normalized.append(extension)
+        return normalized
+
+    def classify_file(self, file_name: str, size: int = 0) -> str:
+        """
+        インデクサーがファイルをどのように扱うかを返す ("indexed" / "excluded" / "metadata_only" / "failed").
+        """
+        extension = os.path.splitext(file_name)[1].lower()
+        if self.indexed_file_name_extensions and extension not in self.indexed_file_name_extensions:
+            return "excluded"
+        if extension in self.excluded_file_name_extensions:
+            return "excluded"
+        if size > self.max_file_size_mb * 1024 * 1024:
+            return "metadata_only" if self.index_metadata_only_for_oversized_documents else "failed"
+        return "indexed"
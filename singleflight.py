@@ -0,0 +1,172 @@
+import re
+import time
+import asyncio
+import logging
+import unicodedata
+from collections.abc import AsyncIterator, Awaitable, Callable, Hashable
+
+from deadlines import Deadline, DeadlineExceeded, current_deadline, remaining_seconds, request_deadline_max_seconds, use_deadline
+
+
+def normalize_question(question: str) -> str:
+    """
+    同じ質問とみなすための正規化 (NFKC・前後と連続する空白・大文字小文字).
+    """
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", question or "")).strip().lower()
+
+
+def answer_key(project_name: str, question: str, folder_name: str = None, subfolder_name: str = None, folder_path: str = None, conversation_id: str = None) -> tuple:
+    """
+    /answer の重複判定のキー (プロジェクト・フィルター・会話・正規化した質問).
+    会話の中の質問は履歴によって回答が変わるため、別の会話の同じ質問とは共有しない.
+    """
+    return (project_name.lower(), folder_name or None, subfolder_name or None, folder_path or None, conversation_id or None, normalize_question(question))
+
+
+class Broadcast:
+    """
+    1 つのストリームの出力を複数の購読者に配信する. 途中から購読した場合も先頭から受け取る.
+    """
+    def __init__(self):
+        self.items: list = []
+        self.done = False
+        self.error: BaseException | None = None
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def publish(self, item):
+        self.items.append(item)
+        self._notify()
+
+    def close(self, error: BaseException = None):
+        self.done = True
+        self.error = error
+        self._notify()
+
+    async def subscribe(self) -> AsyncIterator:
+        position = 0
+        while True:
+            while position < len(self.items):
+                yield self.items[position]
+                position += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await self._changed.wait()
+
+
+def caller_expires_at() -> float:
+    """
+    呼び出し元の期限 (time.monotonic() の値). 期限のない呼び出し元は REQUEST_DEADLINE_MAX_SECONDS 後とする.
+    """
+    deadline = current_deadline()
+    return deadline.expires_at if deadline is not None else time.monotonic() + request_deadline_max_seconds
+
+
+class _Flight:
+    def __init__(self, deadline: Deadline, broadcast: Broadcast = None):
+        self.deadline = deadline
+        self.task: asyncio.Task | None = None
+        self.broadcast = broadcast
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    同じキーの処理が実行中の場合は新たに実行せず、実行中の処理の結果を共有する.
+    処理は 1 回だけ実行し、その期限は待機している呼び出し元のうち最も遅い期限とする (後から待機した呼び出し元の期限まで延ばす).
+    各呼び出し元は自身の期限で待機を打ち切り、待機している呼び出し元がすべていなくなった場合は処理もキャンセルする.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self._flights: dict[Hashable, _Flight] = {}
+        self.started = 0
+        self.joined = 0
+
+    def _start(self, key: Hashable, coroutine, broadcast: Broadcast = None) -> _Flight:
+        flight = _Flight(Deadline(0), broadcast)
+        flight.deadline.expires_at = caller_expires_at()
+
+        async def run():
+            # 最初の呼び出し元の期限ではなく、呼び出し元の間で共有する期限で実行する
+            with use_deadline(flight.deadline):
+                return await coroutine
+        flight.task = asyncio.ensure_future(run())
+        self._flights[key] = flight
+        self.started += 1
+
+        def forget(_):
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.task.add_done_callback(forget)
+        return flight
+
+    def _join(self, key: Hashable) -> _Flight | None:
+        flight = self._flights.get(key)
+        if flight is not None:
+            flight.deadline.extend(caller_expires_at())
+            self.joined += 1
+            logging.info(f"{self.name}: 実行中の同じ処理の結果を共有します ({flight.waiters} 件が待機中)")
+        return flight
+
+    def _leave(self, flight: _Flight):
+        flight.waiters -= 1
+        if flight.waiters == 0 and not flight.task.done():
+            flight.task.cancel()
+
+    async def do(self, key: Hashable, factory: Callable[[], Awaitable]):
+        """
+        factory() の結果を返す. 同じキーの処理が実行中の場合はその結果を待つ.
+        """
+        flight = self._join(key) or self._start(key, factory())
+        flight.waiters += 1
+        try:
+            # 1 つの呼び出し元のキャンセルで、他の呼び出し元が待つ処理をキャンセルしない
+            return await asyncio.shield(flight.task)
+        finally:
+            self._leave(flight)
+
+    async def stream(self, key: Hashable, factory: Callable[[], AsyncIterator]) -> AsyncIterator:
+        """
+        factory() が返すストリームの要素を返す. 同じキーのストリームが実行中の場合は、その出力を先頭から受け取る.
+        """
+        flight = self._join(key)
+        if flight is None or flight.broadcast is None:
+            broadcast = Broadcast()
+
+            async def produce():
+                try:
+                    async for item in factory():
+                        broadcast.publish(item)
+                except asyncio.CancelledError as e:
+                    broadcast.close(e)
+                    raise
+                except Exception as e:
+                    # 例外は購読者がそれぞれ受け取る
+                    broadcast.close(e)
+                    return
+                broadcast.close()
+
+            flight = self._start(key, produce(), broadcast)
+        flight.waiters += 1
+        subscription = flight.broadcast.subscribe()
+        try:
+            while True:
+                # 共有するストリームの期限は延びている場合があるため、呼び出し元の期限で打ち切る
+                try:
+                    item = await asyncio.wait_for(anext(subscription), timeout=remaining_seconds())
+                except StopAsyncIteration:
+                    return
+                except asyncio.TimeoutError:
+                    raise DeadlineExceeded(self.name) from None
+                yield item
+        finally:
+            await subscription.aclose()
+            self._leave(flight)
+
+    def stats(self) -> dict:
+        return {"in_flight": len(self._flights), "started": self.started, "joined": self.joined}
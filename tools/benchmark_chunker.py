@@ -0,0 +1,100 @@
+"""
+chunker.chunk_markdown と、スキルセットの SplitSkill 相当の文字数ベースの分割 (2000 文字 / 重複 500 文字) を比較するツール.
+Markdown ファイル (Layout キャッシュのディレクトリなど) を入力に、チャンク数・chunks/sec・トークン数・推定インデックスサイズを出力する.
+
+使用例:
+    python tools/benchmark_chunker.py --input layout_cache --max-tokens 256,512,1024 --overlap-tokens 0,64 --workers 4
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import chunker  # noqa: E402
+
+
+def parse_ints(value: str) -> list[int]:
+    return [int(x) for x in value.split(",") if x]
+
+
+def load_markdown(path: str, limit: int = None) -> list[str]:
+    """
+    ディレクトリ以下の .md (または単一ファイル) を読み込む.
+    """
+    paths = [path] if os.path.isfile(path) else sorted(glob.glob(os.path.join(path, "**", "*.md"), recursive=True))
+    documents = []
+    for file_path in paths[:limit]:
+        with open(file_path, encoding="utf-8") as f:
+            documents.append(f.read())
+    return documents
+
+
+def estimate_index_bytes(contents: list[str], dimensions: int, dedupe_text_fields: bool) -> int:
+    """
+    チャンク本文 (content, 重複排除しない場合は chunk も) とベクトル (float32) の合計サイズ.
+    """
+    text_bytes = sum(len(content.encode("utf-8")) for content in contents)
+    return text_bytes * (1 if dedupe_text_fields else 2) + len(contents) * dimensions * 4
+
+
+def summarize(name: str, contents: list[str], seconds: float, args) -> dict:
+    tokens = [chunker.count_tokens(content) for content in contents]
+    return {
+        "name": name,
+        "chunks": len(contents),
+        "chunks_per_second": len(contents) / seconds if seconds else 0.0,
+        "avg_tokens": sum(tokens) / len(tokens) if tokens else 0.0,
+        "max_tokens": max(tokens, default=0),
+        "total_tokens": sum(tokens),
+        "index_mb": estimate_index_bytes(contents, args.dimensions, args.dedupe_text_fields) / 1024 / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Markdown チャンク分割のベンチマーク")
+    parser.add_argument("--input", required=True, help="Markdown ファイル、または .md を含むディレクトリ")
+    parser.add_argument("--limit", type=int, default=None, help="読み込むファイル数の上限")
+    parser.add_argument("--max-tokens", default="512", help="カンマ区切りのチャンク最大トークン数")
+    parser.add_argument("--overlap-tokens", default="64", help="カンマ区切りの重複トークン数")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="プロセスプールのワーカー数 (1 の場合は同一プロセス)")
+    parser.add_argument("--dimensions", type=int, default=1536)
+    parser.add_argument("--dedupe-text-fields", action="store_true", help="chunk フィールドを作成しない場合のサイズで見積もる")
+    args = parser.parse_args()
+
+    documents = load_markdown(args.input, args.limit)
+    if not documents:
+        sys.exit(f"Markdown ファイルが見つかりません: {args.input}")
+    print(f"ファイル数: {len(documents)}, 合計 {sum(len(d) for d in documents):,} 文字, ワーカー数: {args.workers}")
+
+    rows = []
+    splitter = RecursiveCharacterTextSplitter(chunk_size=2000, chunk_overlap=500)
+    started = time.perf_counter()
+    contents = [chunk for document in documents for chunk in splitter.split_text(document)]
+    rows.append(summarize("chars 2000/500", contents, time.perf_counter() - started, args))
+
+    chunker.chunk_process_workers = args.workers
+    for max_tokens in parse_ints(args.max_tokens):
+        for overlap_tokens in parse_ints(args.overlap_tokens):
+            markdown_chunker = chunker.MarkdownChunker(
+                max_tokens, overlap_tokens, parallel_threshold=2 if args.workers > 1 else len(documents) + 1
+            )
+            # プロセスプールの起動時間を計測に含めないよう、事前に起動しておく
+            markdown_chunker.chunk_many(documents[:2])
+            started = time.perf_counter()
+            results = markdown_chunker.chunk_many(documents)
+            contents = [chunk["content"] for chunks in results for chunk in chunks]
+            rows.append(summarize(f"tokens {max_tokens}/{overlap_tokens}", contents, time.perf_counter() - started, args))
+    chunker.shutdown_process_pool()
+
+    print(f"{'splitter':<18}{'chunks':>8}{'chunks/s':>11}{'avg tok':>9}{'max tok':>9}{'total tok':>11}{'index MB':>10}")
+    for row in rows:
+        print(f"{row['name']:<18}{row['chunks']:>8}{row['chunks_per_second']:>11.1f}{row['avg_tokens']:>9.1f}"
+              f"{row['max_tokens']:>9}{row['total_tokens']:>11}{row['index_mb']:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+export_index_vectors.py でエクスポートした .jsonl からローカルインデックス (local_ann.LocalVectorIndex) を作成するツール.
+作成したインデックスは RETRIEVER_BACKEND=local / auto のときに retrievers.LocalVectorRetriever が使用する.
+
+使用例:
+    python tools/export_index_vectors.py --project myproject --output myproject.jsonl
+    python tools/build_local_index.py --project myproject --input myproject.jsonl --m 4 --ef-construction 400
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from local_ann import LocalVectorIndex  # noqa: E402
+
+local_index_dir = os.getenv("LOCAL_INDEX_DIR", "local_indexes")
+
+
+def load_documents(path: str):
+    """
+    .jsonl を読み込み、content_vector を除いたメタデータとベクトルの配列を返す.
+    ベクトルを持たないチャンクはスキップする.
+    """
+    documents, vectors = [], []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            document = json.loads(line)
+            vector = document.pop("content_vector", None)
+            if not vector:
+                continue
+            documents.append(document)
+            vectors.append(vector)
+    return documents, np.asarray(vectors, dtype=np.float32)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="エクスポートしたチャンクからローカルインデックスを作成する")
+    parser.add_argument("--project", required=True, help="プロジェクト名 ({LOCAL_INDEX_DIR}/{project}-index に作成する)")
+    parser.add_argument("--input", required=True, help="export_index_vectors.py で出力した .jsonl")
+    parser.add_argument("--output-dir", default=None, help="出力先ディレクトリを直接指定する場合")
+    parser.add_argument("--metric", default="cosine", choices=["cosine", "euclidean", "dotProduct"])
+    parser.add_argument("--m", type=int, default=4)
+    parser.add_argument("--ef-construction", type=int, default=400)
+    parser.add_argument("--no-hnsw", action="store_true", help="グラフを作成せず、常に全件探索を行う")
+    args = parser.parse_args()
+
+    documents, vectors = load_documents(args.input)
+    if not documents:
+        sys.exit(f"ベクトルを含むチャンクがありません: {args.input}")
+
+    directory = args.output_dir or os.path.join(local_index_dir, f"{args.project.lower()}-index")
+    started = time.perf_counter()
+    LocalVectorIndex.build(
+        directory,
+        documents,
+        vectors,
+        metric=args.metric,
+        m=args.m,
+        ef_construction=args.ef_construction,
+        use_hnsw=not args.no_hnsw,
+    )
+    print(f"{len(documents)} 件 (次元数 {vectors.shape[1]}) のローカルインデックスを作成しました: {directory} "
+          f"({time.perf_counter() - started:.1f} 秒)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+SharePoint サイトをクロールし、インデクサーの実行設定 (IndexingPerformanceProfile) ごとに
+処理するファイル数・サイズ・バッチ数・所要時間を見積もるツール.
+拡張子ごとの件数・サイズも出力するため、プロジェクト登録時の performance_profile (除外する拡張子・バッチサイズ) を決める材料にする.
+
+使用例:
+    python tools/estimate_indexing.py --spo-url https://contoso.sharepoint.com/sites/project \\
+        --exclude .zip,.exe,.mp4 --max-file-mb 16 --batch-size 5
+"""
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from SharePoint import SharePointAccessClass  # noqa: E402
+from indexing_estimate import crawl_site_files, estimate_indexing  # noqa: E402
+from search_profiles import IndexingPerformanceProfile  # noqa: E402
+
+
+def parse_list(value: str) -> list[str]:
+    return [x for x in value.split(",") if x]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SharePoint のクロール結果からインデックス作成を見積もる")
+    parser.add_argument("--spo-url", help="サイトの URL (webUrl と完全一致するもの)")
+    parser.add_argument("--site-id", help="サイト ID を直接指定する場合")
+    parser.add_argument("--max-files", type=int, default=100000, help="クロールするファイル数の上限")
+    parser.add_argument("--batch-size", type=int, default=None)
+    parser.add_argument("--include", default="", help="カンマ区切りの対象とする拡張子 (空の場合はすべて)")
+    parser.add_argument("--exclude", default="", help="カンマ区切りの除外する拡張子")
+    parser.add_argument("--max-file-mb", type=float, default=16, help="価格レベルの抽出上限 (Basic: 16, S1: 128, S2 以上: 256)")
+    parser.add_argument("--fail-oversized", action="store_true", help="上限を超えるファイルをメタデータのみとせず失敗として扱う")
+    parser.add_argument("--docs-per-minute", type=float, default=None, help="所要時間の見積もりに使用する docs/min")
+    parser.add_argument("--json", action="store_true", help="結果を JSON で出力する")
+    args = parser.parse_args()
+    if not args.spo_url and not args.site_id:
+        sys.exit("--spo-url または --site-id を指定してください")
+
+    sharepoint = SharePointAccessClass(os.getenv("SPO_APPLICATION_ID"), os.getenv("SPO_APPLICATION_SECRET"), os.getenv("SPO_TENANT_ID"))
+    site_id = args.site_id
+    if site_id is None:
+        site = next((site for site in sharepoint.get_sites().get("value", []) if site.get("webUrl") == args.spo_url), None)
+        if site is None:
+            sys.exit(f"サイトが見つかりません: {args.spo_url}")
+        site_id = site["id"]
+
+    profile = IndexingPerformanceProfile(
+        batch_size=args.batch_size,
+        index_metadata_only_for_oversized_documents=not args.fail_oversized,
+        max_file_size_mb=args.max_file_mb,
+        indexed_file_name_extensions=parse_list(args.include),
+        excluded_file_name_extensions=parse_list(args.exclude),
+    )
+    files, truncated = crawl_site_files(sharepoint, site_id, args.max_files)
+    estimate = estimate_indexing(files, profile, args.docs_per_minute)
+    estimate["truncated"] = truncated
+
+    if args.json:
+        print(json.dumps({"performance_profile": profile.model_dump(), "estimate": estimate}, ensure_ascii=False, indent=2))
+        return
+
+    print(f"ファイル数: {estimate['files']}{' (上限で打ち切り)' if truncated else ''}")
+    print(f"  インデックス対象: {estimate['indexed_files']} ({estimate['indexed_mb']} MB)")
+    print(f"  メタデータのみ (サイズ超過): {estimate['metadata_only_files']}")
+    print(f"  失敗 (サイズ超過): {estimate['failed_files']}")
+    print(f"  除外: {estimate['excluded_files']} ({estimate['excluded_mb']} MB)")
+    print(f"バッチ数: {estimate['batches']} (batch_size={profile.batch_size or 'サービス既定'})")
+    print(f"推奨 batch_size: {estimate['recommended_batch_size']}")
+    print(f"所要時間: 約 {estimate['estimated_minutes']} 分 ({estimate['docs_per_minute']} docs/min)")
+    print(f"{'拡張子':<12}{'files':>8}{'MB':>10}")
+    for extension, row in estimate["extensions"].items():
+        print(f"{extension:<12}{row['files']:>8}{row['bytes'] / 1024 / 1024:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""
+ベクトル圧縮 (スカラー量子化 / バイナリ量子化) によるインデックスサイズと再現率のトレードオフを
+サンプルベクトルを用いてローカルで見積もるツール.
+
+使用例:
+    python tools/estimate_vector_compression.py --vectors vectors.npy --queries 200 --k 3 --oversampling 1,2,4,10
+
+--vectors には (N, 次元数) の float32 配列を保存した .npy, または 1 行 1 ドキュメントの .jsonl
+(content_vector フィールドを含む. content / chunk があればテキスト重複分のサイズも見積もる) を指定する.
+"""
+import argparse
+import json
+import time
+import numpy as np
+
+
+def load_vectors(path: str, limit: int | None = None):
+    """
+    ベクトルと (存在すれば) テキストフィールドの平均バイト数を読み込む.
+    """
+    text_bytes = {"content": 0, "chunk": 0}
+    if path.endswith(".npy"):
+        vectors = np.load(path, mmap_mode="r")
+        if limit:
+            vectors = vectors[:limit]
+        return np.asarray(vectors, dtype=np.float32), None
+
+    rows = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if limit and len(rows) >= limit:
+                break
+            doc = json.loads(line)
+            if not doc.get("content_vector"):
+                continue
+            rows.append(doc["content_vector"])
+            for field in text_bytes:
+                text_bytes[field] += len((doc.get(field) or "").encode("utf-8"))
+    vectors = np.asarray(rows, dtype=np.float32)
+    average_text_bytes = {field: total / max(len(rows), 1) for field, total in text_bytes.items()}
+    return vectors, average_text_bytes
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def exact_top_k(corpus: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    scores = queries @ corpus.T
+    return np.argsort(-scores, axis=1)[:, :k]
+
+
+def scalar_quantize(vectors: np.ndarray):
+    """
+    次元ごとの最小値・最大値で int8 に量子化する (Azure AI Search の scalarQuantization 相当).
+    """
+    minimum = vectors.min(axis=0)
+    scale = np.maximum(vectors.max(axis=0) - minimum, 1e-12) / 255.0
+    codes = np.round((vectors - minimum) / scale) - 128
+    return codes.astype(np.int8), minimum, scale
+
+
+def scalar_candidates(corpus: np.ndarray, queries: np.ndarray, n_candidates: int) -> np.ndarray:
+    codes, minimum, scale = scalar_quantize(corpus)
+    # 量子化後の値を復元して内積を計算する
+    decoded = (codes.astype(np.float32) + 128) * scale + minimum
+    scores = queries @ decoded.T
+    return np.argsort(-scores, axis=1)[:, :n_candidates]
+
+
+def binary_candidates(corpus: np.ndarray, queries: np.ndarray, n_candidates: int) -> np.ndarray:
+    """
+    符号ビットのみを保持し、ハミング距離で候補を取得する (binaryQuantization 相当).
+    """
+    corpus_bits = np.packbits(corpus > 0, axis=1)
+    query_bits = np.packbits(queries > 0, axis=1)
+    distances = np.stack([
+        np.unpackbits(np.bitwise_xor(corpus_bits, q), axis=1).sum(axis=1) for q in query_bits
+    ])
+    return np.argsort(distances, axis=1, kind="stable")[:, :n_candidates]
+
+
+def rescore(corpus: np.ndarray, queries: np.ndarray, candidates: np.ndarray, k: int) -> np.ndarray:
+    """
+    候補を元のベクトルで再スコアリングして上位 k 件を返す.
+    """
+    reranked = []
+    for query, candidate_ids in zip(queries, candidates):
+        scores = corpus[candidate_ids] @ query
+        reranked.append(candidate_ids[np.argsort(-scores)[:k]])
+    return np.stack(reranked)
+
+
+def recall_at_k(truth: np.ndarray, found: np.ndarray) -> float:
+    hits = sum(len(set(t) & set(f)) for t, f in zip(truth, found))
+    return hits / truth.size
+
+
+def estimate_sizes(n_docs: int, dimensions: int, text_bytes: dict | None, hnsw_m: int = 4) -> list[tuple]:
+    """
+    1 ドキュメントあたりのバイト数から圧縮方式ごとのインデックスサイズを見積もる.
+    """
+    bytes_per_vector = {"none": dimensions * 4, "scalar": dimensions, "binary": dimensions / 8}
+    graph_bytes = hnsw_m * 2 * 4  # HNSW の近傍リスト (最下層) の概算
+    rows = []
+    for compression, vector_bytes in bytes_per_vector.items():
+        for store_raw_vector in (True, False):
+            # ベクトルインデックス (メモリ上) には圧縮後のベクトルのみが載る.
+            # stored=False は検索結果として返すための元ベクトルのコピーを削除する
+            index_bytes = vector_bytes + graph_bytes
+            stored_bytes = dimensions * 4 if store_raw_vector else 0
+            rows.append((compression, store_raw_vector, n_docs * index_bytes, n_docs * stored_bytes))
+    if text_bytes:
+        print(f"テキスト: content 平均 {text_bytes['content']:.0f} bytes, chunk 平均 {text_bytes['chunk']:.0f} bytes "
+              f"(重複排除で約 {n_docs * text_bytes['chunk'] / 2**20:.1f} MiB 削減)")
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ベクトル圧縮のサイズ・再現率の見積もり")
+    parser.add_argument("--vectors", required=True, help=".npy または .jsonl (content_vector を含む)")
+    parser.add_argument("--limit", type=int, default=None, help="読み込むベクトル数の上限")
+    parser.add_argument("--queries", type=int, default=100, help="クエリとして使うサンプル数")
+    parser.add_argument("--k", type=int, default=3, help="取得件数 (generate_answer の top と同じ値)")
+    parser.add_argument("--oversampling", default="1,2,4,10", help="カンマ区切りのオーバーサンプリング倍率")
+    parser.add_argument("--total-docs", type=int, default=None, help="サイズ見積もりに用いる総チャンク数 (省略時はサンプル数)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    vectors, text_bytes = load_vectors(args.vectors, args.limit)
+    vectors = normalize(vectors)
+    n_docs, dimensions = vectors.shape
+    rng = np.random.default_rng(args.seed)
+
+    # コーパスからクエリをサンプリングし、クエリ自身はコーパスから除く
+    query_ids = rng.choice(n_docs, size=min(args.queries, n_docs // 2), replace=False)
+    mask = np.ones(n_docs, dtype=bool)
+    mask[query_ids] = False
+    corpus, queries = vectors[mask], vectors[query_ids]
+    truth = exact_top_k(corpus, queries, args.k)
+
+    print(f"ベクトル数: {n_docs}, 次元数: {dimensions}, クエリ数: {len(queries)}, k={args.k}")
+    print("\n[サイズ見積もり]")
+    print(f"{'compression':<12}{'stored':<8}{'vector index (MiB)':>20}{'stored vectors (MiB)':>22}")
+    for compression, stored, index_bytes, stored_bytes in estimate_sizes(args.total_docs or n_docs, dimensions, text_bytes):
+        print(f"{compression:<12}{str(stored):<8}{index_bytes / 2**20:>20.1f}{stored_bytes / 2**20:>22.1f}")
+
+    print("\n[再現率]")
+    print(f"{'compression':<12}{'oversampling':>13}{'recall (no rerank)':>20}{'recall (rerank)':>17}{'ms/query':>10}")
+    for oversampling in [float(x) for x in args.oversampling.split(",")]:
+        n_candidates = max(args.k, int(np.ceil(args.k * oversampling)))
+        for compression, search in (("scalar", scalar_candidates), ("binary", binary_candidates)):
+            started = time.perf_counter()
+            candidates = search(corpus, queries, n_candidates)
+            reranked = rescore(corpus, queries, candidates, args.k)
+            elapsed_ms = (time.perf_counter() - started) * 1000 / len(queries)
+            print(f"{compression:<12}{oversampling:>13.1f}{recall_at_k(truth, candidates[:, :args.k]):>20.3f}"
+                  f"{recall_at_k(truth, reranked):>17.3f}{elapsed_ms:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+プロジェクトのインデックスからチャンク (メタデータ・本文・ベクトル) をエクスポートするツール.
+エクスポートしたファイルは estimate_vector_compression.py / sweep_vector_search.py の入力に使用する.
+
+使用例:
+    python tools/export_index_vectors.py --project myproject --output myproject.jsonl --npy myproject.npy
+
+content_vector を stored=False (IndexStorageProfile.store_raw_vector=False) で作成したインデックスからは
+ベクトルを取得できないため、エクスポートには元ベクトルを保存しているインデックスを使用する.
+"""
+import argparse
+import json
+import os
+import sys
+import numpy as np
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from indexing_service import KEY_FIELD, advance_cursor, page_query  # noqa: E402
+
+azure_search_endpoint = os.getenv("AZURE_SEARCH_ENDPOINT")
+azure_search_key = os.getenv("AZURE_SEARCH_ADMIN_KEY")
+
+EXPORT_FIELDS = [
+    KEY_FIELD, "parent_id", "documentId", "documentPath", "documentName", "documentUrl",
+    "folderName", "subfolderName", "folderPath", "last_modified", "header_1", "header_2", "header_3",
+    "content", "content_vector",
+]
+
+
+def iter_documents(index_name: str, page_size: int = 1000, fields: list[str] = EXPORT_FIELDS):
+    """
+    documentId・キーの昇順でページングしながらインデックス内の全ドキュメントを返す.
+    ($skip の上限 100,000 件を超えても取得できるよう、indexing_service.page_query の documentId の範囲フィルターでページングする)
+    """
+    url = f"{azure_search_endpoint}/indexes/{index_name}/docs/search?api-version=2024-07-01"
+    headers = {"Content-Type": "application/json", "api-key": azure_search_key}
+    select = fields if "documentId" in fields else fields + ["documentId"]
+    cursor = None
+    while True:
+        body = {
+            "search": "*",
+            "select": ",".join(select),
+            "top": page_size,
+            **page_query(cursor=cursor),
+        }
+        response = requests.post(url, headers=headers, json=body, timeout=60)
+        response.raise_for_status()
+        documents = response.json().get("value", [])
+        if not documents:
+            return
+        cursor = advance_cursor(cursor, documents)
+        for document in documents:
+            document.pop("@search.score", None)
+            yield document
+
+
+def main():
+    parser = argparse.ArgumentParser(description="インデックスのチャンクとベクトルをエクスポートする")
+    parser.add_argument("--project", required=True, help="プロジェクト名 ({project}-index を読み込む)")
+    parser.add_argument("--index", default=None, help="インデックス名を直接指定する場合")
+    parser.add_argument("--output", required=True, help="出力先の .jsonl")
+    parser.add_argument("--npy", default=None, help="ベクトルのみを (N, 次元数) の float32 配列として保存する .npy")
+    parser.add_argument("--limit", type=int, default=None, help="エクスポートする件数の上限")
+    args = parser.parse_args()
+
+    index_name = args.index or f"{args.project.lower()}-index"
+    # 共有インデックスの場合は、ローカルインデックスでプロジェクトを絞り込めるよう projectName もエクスポートする
+    fields = EXPORT_FIELDS + ["projectName"] if index_name == os.getenv("SHARED_INDEX_NAME") else EXPORT_FIELDS
+    vectors = []
+    count = 0
+    with open(args.output, "w", encoding="utf-8") as f:
+        for document in iter_documents(index_name, fields=fields):
+            if args.limit and count >= args.limit:
+                break
+            if document.get("content_vector"):
+                vectors.append(document["content_vector"])
+            f.write(json.dumps(document, ensure_ascii=False) + "\n")
+            count += 1
+    print(f"{count} 件をエクスポートしました: {args.output}")
+
+    if args.npy:
+        np.save(args.npy, np.asarray(vectors, dtype=np.float32))
+        print(f"ベクトル {len(vectors)} 件を保存しました: {args.npy}")
+
+
+if __name__ == "__main__":
+    main()
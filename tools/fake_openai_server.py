@@ -0,0 +1,202 @@
+"""
+Azure OpenAI (chat completions・embeddings) を模擬するローカルサーバー.
+複数のポートで起動し、OPENAI_POOL_CONFIG にそれぞれをエンドポイントとして指定して、
+プールの振り分け・429 / 5xx 時のフェイルオーバー・ヘッジ・残りクォータの追跡を確認するために使用する.
+
+使用例:
+    python tools/fake_openai_server.py --ports 8001 8002 8003 --tokens-per-minute 20000 \\
+        --override 8002:error_rate=0.3 --override 8003:latency=2.0
+
+    OPENAI_POOL_CONFIG='{"openai-chat": [
+        {"name": "a", "endpoint": "http://localhost:8001", "api_key": "fake", "deployment": "gpt-4o"},
+        {"name": "b", "endpoint": "http://localhost:8002", "api_key": "fake", "deployment": "gpt-4o"},
+        {"name": "c", "endpoint": "http://localhost:8003", "api_key": "fake", "deployment": "gpt-4o"}]}' \\
+    OPENAI_HEDGE_DELAY=0.5 func start
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from collections import deque
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+EMBEDDING_DIMENSIONS = 1536
+
+
+class FakeDeployment:
+    """
+    1 つのエンドポイントの挙動 (レイテンシ・エラー率・1 分あたりのトークン数・リクエスト数の上限).
+    """
+    def __init__(self, name: str, latency: float, jitter: float, error_rate: float, tokens_per_minute: int, requests_per_minute: int):
+        self.name = name
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.tokens_per_minute = tokens_per_minute
+        self.requests_per_minute = requests_per_minute
+        self.usage: deque[tuple[float, int]] = deque()
+        self.counts = {"requests": 0, "throttled": 0, "errors": 0}
+
+    def _used(self) -> tuple[int, int]:
+        now = time.monotonic()
+        while self.usage and now - self.usage[0][0] >= 60:
+            self.usage.popleft()
+        return sum(tokens for _, tokens in self.usage), len(self.usage)
+
+    def quota_headers(self) -> dict:
+        tokens, requests = self._used()
+        return {
+            "x-ratelimit-remaining-tokens": str(max(0, self.tokens_per_minute - tokens)),
+            "x-ratelimit-remaining-requests": str(max(0, self.requests_per_minute - requests)),
+        }
+
+    def admit(self, tokens: int) -> JSONResponse | None:
+        """
+        クォータを超える場合は 429 (retry-after-ms: 最も古い使用分が回復するまで)、エラー率に応じて 500 を返す.
+        """
+        self.counts["requests"] += 1
+        used_tokens, used_requests = self._used()
+        if used_tokens + tokens > self.tokens_per_minute or used_requests + 1 > self.requests_per_minute:
+            self.counts["throttled"] += 1
+            retry_after = 60 - (time.monotonic() - self.usage[0][0]) if self.usage else 1
+            return JSONResponse(
+                status_code=429,
+                content={"error": {"code": "429", "message": f"{self.name}: Rate limit is exceeded."}},
+                headers={"retry-after-ms": str(int(retry_after * 1000)), "retry-after": str(int(retry_after) + 1), **self.quota_headers()},
+            )
+        if random.random() < self.error_rate:
+            self.counts["errors"] += 1
+            return JSONResponse(status_code=500, content={"error": {"code": "500", "message": f"{self.name}: fake error"}})
+        self.usage.append((time.monotonic(), tokens))
+        return None
+
+    async def wait(self):
+        await asyncio.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+def create_app(deployment: FakeDeployment) -> FastAPI:
+    app = FastAPI()
+
+    @app.post("/openai/deployments/{name}/chat/completions")
+    async def chat_completions(name: str, request: Request):
+        body = await request.json()
+        prompt = "".join(str(message.get("content", "")) for message in body.get("messages", []))
+        answer = f"[{deployment.name}/{name}] {prompt[:40]} への回答です。"
+        prompt_tokens, completion_tokens = estimate_tokens(prompt), estimate_tokens(answer)
+        rejected = deployment.admit(prompt_tokens + body.get("max_tokens", completion_tokens))
+        if rejected:
+            return rejected
+        await deployment.wait()
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+
+        if body.get("stream"):
+            async def events():
+                for i in range(0, len(answer), 4):
+                    chunk = {
+                        "id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": name,
+                        "choices": [{"index": 0, "delta": {"content": answer[i:i + 4]}, "finish_reason": None}],
+                    }
+                    yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+                    await asyncio.sleep(0.01)
+                last = {
+                    "id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": name,
+                    "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                }
+                yield f"data: {json.dumps(last)}\n\ndata: [DONE]\n\n"
+            return StreamingResponse(events(), media_type="text/event-stream", headers=deployment.quota_headers())
+
+        return JSONResponse(headers=deployment.quota_headers(), content={
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": name,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+            "usage": usage,
+        })
+
+    @app.post("/openai/deployments/{name}/embeddings")
+    async def embeddings(name: str, request: Request):
+        body = await request.json()
+        inputs = body.get("input", [])
+        inputs = [inputs] if isinstance(inputs, (str, int)) or (inputs and isinstance(inputs[0], int)) else inputs
+        tokens = sum(len(item) if isinstance(item, list) else estimate_tokens(str(item)) for item in inputs)
+        rejected = deployment.admit(tokens)
+        if rejected:
+            return rejected
+        await deployment.wait()
+        data = []
+        for index, item in enumerate(inputs):
+            rng = random.Random(str(item))
+            data.append({"object": "embedding", "index": index, "embedding": [rng.uniform(-1, 1) for _ in range(EMBEDDING_DIMENSIONS)]})
+        return JSONResponse(headers=deployment.quota_headers(), content={
+            "object": "list", "data": data, "model": name, "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        })
+
+    @app.get("/stats")
+    async def stats():
+        return {"name": deployment.name, **deployment.counts, **deployment.quota_headers()}
+
+    return app
+
+
+def parse_overrides(values: list[str]) -> dict[int, dict]:
+    """
+    --override "8002:error_rate=0.3,latency=1.5" をポートごとの設定に変換する.
+    """
+    overrides: dict[int, dict] = {}
+    for value in values:
+        port, settings = value.split(":", 1)
+        for setting in settings.split(","):
+            key, number = setting.split("=", 1)
+            overrides.setdefault(int(port), {})[key.strip()] = float(number)
+    return overrides
+
+
+async def serve(args):
+    overrides = parse_overrides(args.override)
+    servers = []
+    for port in args.ports:
+        settings = {
+            "latency": args.latency,
+            "jitter": args.jitter,
+            "error_rate": args.error_rate,
+            "tokens_per_minute": args.tokens_per_minute,
+            "requests_per_minute": args.requests_per_minute,
+            **overrides.get(port, {}),
+        }
+        deployment = FakeDeployment(
+            f"fake-{port}", settings["latency"], settings["jitter"], settings["error_rate"],
+            int(settings["tokens_per_minute"]), int(settings["requests_per_minute"]),
+        )
+        print(f"http://{args.host}:{port}: {settings}")
+        config = uvicorn.Config(create_app(deployment), host=args.host, port=port, log_level="warning")
+        servers.append(uvicorn.Server(config))
+    await asyncio.gather(*(server.serve() for server in servers))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Azure OpenAI を模擬するローカルサーバーを複数のポートで起動する")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--ports", type=int, nargs="+", default=[8001, 8002])
+    parser.add_argument("--latency", type=float, default=0.2, help="応答までの秒数")
+    parser.add_argument("--jitter", type=float, default=0.05, help="応答までの秒数のばらつき (±秒)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="500 を返す割合")
+    parser.add_argument("--tokens-per-minute", type=int, default=100000, help="1 分あたりのトークン数の上限 (超えると 429)")
+    parser.add_argument("--requests-per-minute", type=int, default=600, help="1 分あたりのリクエスト数の上限 (超えると 429)")
+    parser.add_argument("--override", action="append", default=[], help='ポートごとの設定 (例: "8002:error_rate=0.3,latency=1.5")')
+    args = parser.parse_args()
+    asyncio.run(serve(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+SharePoint (Graph) の変更通知を模擬して /notifications/sharepoint に送信するツール.
+Graph に公開していないローカル環境 (func start / uvicorn) で、検証要求への応答と通知のまとめ処理を確認するために使用する.
+
+使用例:
+    python tools/fake_spo_notifier.py --url http://localhost:7071/notifications/sharepoint \\
+        --subscription-id <プロジェクトのレコードの change_tracking.subscription_id> --bursts 3 --per-burst 20 --interval 5
+"""
+import argparse
+import os
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import requests
+
+
+def build_notification(subscription_id: str, client_state: str, resource: str) -> dict:
+    """
+    Graph が送信する driveItem の変更通知と同じ形式の通知を作成する (変更されたファイルは含まれない).
+    """
+    return {
+        "subscriptionId": subscription_id,
+        "clientState": client_state,
+        "changeType": "updated",
+        "resource": resource,
+        "subscriptionExpirationDateTime": (datetime.now(timezone.utc) + timedelta(days=1)).isoformat(),
+        "tenantId": str(uuid.uuid4()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SharePoint の変更通知を模擬して送信する")
+    parser.add_argument("--url", default="http://localhost:7071/notifications/sharepoint")
+    parser.add_argument("--subscription-id", required=True)
+    parser.add_argument("--client-state", default=os.getenv("GRAPH_CLIENT_STATE", ""))
+    parser.add_argument("--resource", default="/sites/site-id/drive/root")
+    parser.add_argument("--bursts", type=int, default=3, help="送信する通知のまとまりの数")
+    parser.add_argument("--per-burst", type=int, default=10, help="1 回のまとまりで送信する通知数")
+    parser.add_argument("--interval", type=float, default=5.0, help="まとまりの間隔 (秒)")
+    parser.add_argument("--skip-validation", action="store_true", help="検証要求 (validationToken) を送信しない")
+    args = parser.parse_args()
+
+    if not args.skip_validation:
+        token = f"validation-{uuid.uuid4()}"
+        response = requests.post(args.url, params={"validationToken": token}, timeout=10)
+        ok = response.status_code == 200 and response.text == token
+        print(f"検証要求: {response.status_code} {'OK' if ok else 'NG: ' + response.text[:200]}")
+
+    for burst in range(args.bursts):
+        started = time.perf_counter()
+        accepted = 0
+        for _ in range(args.per_burst):
+            payload = {"value": [build_notification(args.subscription_id, args.client_state, args.resource)]}
+            response = requests.post(args.url, json=payload, timeout=10)
+            response.raise_for_status()
+            accepted += response.json().get("accepted", 0)
+        elapsed_ms = (time.perf_counter() - started) * 1000 / args.per_burst
+        print(f"まとまり {burst + 1}/{args.bursts}: {args.per_burst} 件送信, 受付 {accepted} 件, 平均応答 {elapsed_ms:.1f} ms")
+        if burst + 1 < args.bursts:
+            time.sleep(args.interval)
+
+    # 受信した通知数とまとめて処理した回数 (CHANGE_DEBOUNCE_SECONDS 経過後に反映される)
+    status = requests.get(f"{args.url.rstrip('/')}/status", timeout=10)
+    if status.ok:
+        print(f"処理状況: {status.json()}")
+
+
+if __name__ == "__main__":
+    main()
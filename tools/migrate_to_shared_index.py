@@ -0,0 +1,147 @@
+"""
+プロジェクトごとのインデックス ({project}-index) のチャンクを共有インデックス (SHARED_INDEX_NAME) にコピーするツール.
+ソースのインデックスを documentId・キーの昇順でページングしながら読み込み、projectName を付与して一定件数ごとにアップロードする
+(全件をメモリに載せないため、大きなインデックスでも使用できる).
+
+使用例:
+    SHARED_INDEX_NAME=projects-index python tools/migrate_to_shared_index.py --projects proj-a,proj-b --create-index
+
+コピー後に関数アプリの SHARED_INDEX_NAME を設定して各プロジェクトを再登録すると、インデクサーの出力先が共有インデックスに切り替わる.
+キーはソースのものをそのまま使用するため、切り替え後のインデクサーの実行では同じドキュメントが上書きされる.
+content_vector を stored=False で作成したインデックスからはベクトルを取得できないため、そのプロジェクトはスキップする
+(切り替え後にインデクサーをリセットして再実行するか、push_index で登録し直す).
+"""
+import argparse
+import os
+import sys
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from export_index_vectors import iter_documents  # noqa: E402
+from indexing_service import ProjectIndexingService, escape_odata_string  # noqa: E402
+
+azure_search_endpoint = os.getenv("AZURE_SEARCH_ENDPOINT")
+azure_search_key = os.getenv("AZURE_SEARCH_ADMIN_KEY")
+API_VERSION = "2024-07-01"
+
+
+def request(session: requests.Session, method: str, path: str, params: dict = None, **kwargs) -> requests.Response:
+    return session.request(
+        method, f"{azure_search_endpoint}{path}", params={"api-version": API_VERSION, **(params or {})}, timeout=120, **kwargs
+    )
+
+
+def get_index(session: requests.Session, index_name: str) -> dict | None:
+    response = request(session, "GET", f"/indexes('{index_name}')")
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    return response.json()
+
+
+def count_documents(session: requests.Session, index_name: str, filter_condition: str = None) -> int:
+    response = request(session, "POST", f"/indexes('{index_name}')/docs/search.post.search", json={
+        "search": "*", "filter": filter_condition, "count": True, "top": 0,
+    })
+    response.raise_for_status()
+    return response.json()["@odata.count"]
+
+
+def upload_batch(session: requests.Session, index_name: str, documents: list[dict]) -> int:
+    """
+    mergeOrUpload でアップロードし、失敗した件数を返す. 429 / 503 の場合は待機して再試行する.
+    """
+    payload = {"value": [{"@search.action": "mergeOrUpload", **document} for document in documents]}
+    for attempt in range(5):
+        response = request(session, "POST", f"/indexes('{index_name}')/docs/search.index", json=payload)
+        if response.status_code in (429, 503):
+            time.sleep(2 ** attempt)
+            continue
+        if response.status_code not in (200, 207):
+            response.raise_for_status()
+        return sum(1 for result in response.json().get("value", []) if not result.get("status"))
+    response.raise_for_status()
+    return len(documents)
+
+
+def migrate_project(session: requests.Session, project_name: str, target: str, target_fields: set[str], batch_size: int) -> dict:
+    source = f"{project_name}-index"
+    definition = get_index(session, source)
+    if definition is None:
+        return {"project": project_name, "skipped": "source index not found"}
+    source_fields = {field["name"]: field for field in definition["fields"]}
+    if source_fields.get("content_vector", {}).get("stored") is False:
+        return {"project": project_name, "skipped": "content_vector is not stored"}
+
+    # 共有インデックスにないフィールド (重複排除した chunk など) はコピーしない
+    fields = [name for name, field in source_fields.items() if name in target_fields and field.get("retrievable", True)]
+    copied, failed, batch = 0, 0, []
+    started = time.perf_counter()
+    for document in iter_documents(source, fields=fields):
+        document["projectName"] = project_name
+        batch.append(document)
+        if len(batch) >= batch_size:
+            failed += upload_batch(session, target, batch)
+            copied += len(batch)
+            batch = []
+            print(f"  {project_name}: {copied} 件 ({copied / (time.perf_counter() - started):.0f} docs/s)", flush=True)
+    if batch:
+        failed += upload_batch(session, target, batch)
+        copied += len(batch)
+    return {
+        "project": project_name,
+        "copied": copied,
+        "failed": failed,
+        "source_count": count_documents(session, source),
+        "seconds": round(time.perf_counter() - started, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="プロジェクトごとのインデックスを共有インデックスにコピーする")
+    parser.add_argument("--target", default=os.getenv("SHARED_INDEX_NAME"), help="共有インデックス名 (既定は SHARED_INDEX_NAME)")
+    parser.add_argument("--projects", default="", help="カンマ区切りのプロジェクト名 (未指定の場合は {project}-index をすべて対象にする)")
+    parser.add_argument("--batch-size", type=int, default=500, help="1 回のアップロード件数 (上限 1000)")
+    parser.add_argument("--create-index", action="store_true", help="共有インデックスがない場合に既定の設定で作成する")
+    args = parser.parse_args()
+    if not args.target:
+        sys.exit("--target または SHARED_INDEX_NAME を指定してください")
+
+    session = requests.Session()
+    session.headers.update({"Content-Type": "application/json", "api-key": azure_search_key or ""})
+
+    target_definition = get_index(session, args.target)
+    if target_definition is None:
+        if not args.create_index:
+            sys.exit(f"共有インデックス '{args.target}' がありません (--create-index で作成できます)")
+        target_definition = ProjectIndexingService().build_index_definition(args.target)
+        target_definition["name"] = args.target
+        request(session, "PUT", f"/indexes('{args.target}')", json=target_definition).raise_for_status()
+        print(f"共有インデックス '{args.target}' を作成しました")
+    target_fields = {field["name"] for field in target_definition["fields"]}
+    if "projectName" not in target_fields:
+        sys.exit(f"共有インデックス '{args.target}' に projectName フィールドがありません")
+
+    if args.projects:
+        projects = [project.lower() for project in args.projects.split(",") if project]
+    else:
+        response = request(session, "GET", "/indexes", params={"$select": "name"})
+        response.raise_for_status()
+        projects = [
+            index["name"][:-len("-index")] for index in response.json()["value"]
+            if index["name"].endswith("-index") and index["name"] != args.target
+        ]
+
+    for project_name in projects:
+        result = migrate_project(session, project_name, args.target, target_fields, min(args.batch_size, 1000))
+        if "skipped" not in result:
+            result["target_count"] = count_documents(
+                session, args.target, f"projectName eq '{escape_odata_string(project_name)}'"
+            )
+        print(result)
+
+
+if __name__ == "__main__":
+    main()
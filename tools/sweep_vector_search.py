@@ -0,0 +1,93 @@
+"""
+エクスポートしたベクトルに対してローカルの HNSW (local_ann.HnswIndex) を構築し、
+m / efConstruction / efSearch の組み合わせごとの recall@k とレイテンシを測定するツール.
+結果をもとに VectorAlgorithmProfile (プロジェクト登録時の vector_profile) を決める.
+
+使用例:
+    python tools/sweep_vector_search.py --vectors myproject.npy --m 4,8 --ef-construction 100,400 --ef-search 100,500,1000 --k 3
+"""
+import argparse
+import csv
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from local_ann import HnswIndex, exact_search, prepare_vectors  # noqa: E402
+from estimate_vector_compression import load_vectors  # noqa: E402
+
+
+def parse_ints(value: str) -> list[int]:
+    return [int(x) for x in value.split(",") if x]
+
+
+def measure(search, queries: np.ndarray, truth: list[set], k: int):
+    """
+    クエリごとに検索を実行し、recall@k と p50 / p95 レイテンシ (ms) を返す.
+    """
+    latencies, hits = [], 0
+    for query, expected in zip(queries, truth):
+        started = time.perf_counter()
+        ids, _ = search(query)
+        latencies.append((time.perf_counter() - started) * 1000)
+        hits += len(expected & set(ids[:k].tolist()))
+    return hits / (len(queries) * k), float(np.percentile(latencies, 50)), float(np.percentile(latencies, 95))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HNSW パラメータの recall@k / レイテンシのスイープ")
+    parser.add_argument("--vectors", required=True, help=".npy または .jsonl (content_vector を含む)")
+    parser.add_argument("--limit", type=int, default=None, help="使用するベクトル数の上限")
+    parser.add_argument("--queries", type=int, default=100, help="クエリとして使うサンプル数")
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--metric", default="cosine", choices=["cosine", "euclidean", "dotProduct"])
+    parser.add_argument("--m", default="4,8", help="カンマ区切りの m (4〜10)")
+    parser.add_argument("--ef-construction", default="100,400", help="カンマ区切りの efConstruction (100〜1000)")
+    parser.add_argument("--ef-search", default="100,250,500,1000", help="カンマ区切りの efSearch (100〜1000)")
+    parser.add_argument("--csv", default=None, help="結果を書き出す CSV ファイル")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    vectors, _ = load_vectors(args.vectors, args.limit)
+    rng = np.random.default_rng(args.seed)
+    query_ids = rng.choice(len(vectors), size=min(args.queries, len(vectors) // 2), replace=False)
+    mask = np.ones(len(vectors), dtype=bool)
+    mask[query_ids] = False
+    corpus, queries = vectors[mask], vectors[query_ids]
+    prepared_corpus = prepare_vectors(corpus, args.metric)
+
+    truth = [set(exact_search(prepared_corpus, q, args.k, args.metric)[0].tolist()) for q in queries]
+    print(f"ベクトル数: {len(corpus)}, 次元数: {corpus.shape[1]}, クエリ数: {len(queries)}, k={args.k}, metric={args.metric}")
+
+    rows = []
+    recall, p50, p95 = measure(lambda q: exact_search(prepared_corpus, q, args.k, args.metric), queries, truth, args.k)
+    rows.append({"kind": "exhaustiveKnn", "m": "", "ef_construction": "", "ef_search": "",
+                 "build_seconds": 0.0, "recall": recall, "p50_ms": p50, "p95_ms": p95})
+
+    for m in parse_ints(args.m):
+        for ef_construction in parse_ints(args.ef_construction):
+            index = HnswIndex(corpus.shape[1], m=m, ef_construction=ef_construction, metric=args.metric, seed=args.seed)
+            started = time.perf_counter()
+            index.add(corpus)
+            build_seconds = time.perf_counter() - started
+            for ef_search in parse_ints(args.ef_search):
+                recall, p50, p95 = measure(lambda q: index.search(q, args.k, ef_search), queries, truth, args.k)
+                rows.append({"kind": "hnsw", "m": m, "ef_construction": ef_construction, "ef_search": ef_search,
+                             "build_seconds": build_seconds, "recall": recall, "p50_ms": p50, "p95_ms": p95})
+
+    print(f"{'kind':<15}{'m':>4}{'efC':>6}{'efS':>6}{'build(s)':>10}{'recall':>8}{'p50(ms)':>9}{'p95(ms)':>9}")
+    for row in rows:
+        print(f"{row['kind']:<15}{row['m']:>4}{row['ef_construction']:>6}{row['ef_search']:>6}"
+              f"{row['build_seconds']:>10.1f}{row['recall']:>8.3f}{row['p50_ms']:>9.2f}{row['p95_ms']:>9.2f}")
+
+    if args.csv:
+        with open(args.csv, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+            writer.writeheader()
+            writer.writerows(rows)
+        print(f"結果を書き出しました: {args.csv}")
+
+
+if __name__ == "__main__":
+    main()
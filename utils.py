@@ -2,6 +2,8 @@ from azure.cosmos import CosmosClient
 import os
 import logging
 from SharePoint import SharePointAccessClass
+from indexing_service import get_index_name, shared_index_name
+from resilience import record_cosmos_response
 
 # 環境変数から設定を取得
 cosmos_endpoint = os.getenv("COSMOS_DB_ENDPOINT")
@@ -13,7 +15,7 @@ client_secret = os.getenv("SPO_APPLICATION_SECRET")
 tenant_id = os.getenv("SPO_TENANT_ID")
 
 # Cosmos DB クライアントの初期化
-cosmos_client = CosmosClient(cosmos_endpoint, cosmos_key)
+cosmos_client = CosmosClient(cosmos_endpoint, cosmos_key, raw_response_hook=record_cosmos_response)
 database = cosmos_client.get_database_client(cosmos_database_name)
 container = database.get_container_client(cosmos_container_name)
 
@@ -82,6 +84,38 @@ async def get_spo_url_by_project_name(project_name):
         print(f"Error while fetching spo_url: {e}")
         return None
 
+async def get_project_by_name(project_name):
+    """
+    指定された project_name に一致するプロジェクトのレコードを取得する (見つからない場合は None)
+    """
+    try:
+        query = "SELECT * FROM c WHERE c.project_name = @project_name"
+        parameters = [{"name": "@project_name", "value": project_name.lower()}]  # 小文字で一致させる
+
+        results = list(container.query_items(
+            query=query,
+            parameters=parameters,
+            enable_cross_partition_query=True
+        ))
+        return results[0] if results else None
+    except Exception as e:
+        logging.error(f"Error while fetching project: {e}")
+        return None
+
+def patch_project_fields(container, project: dict, *fields: str) -> dict:
+    """
+    プロジェクトのレコードのうち、指定したフィールドのみを部分更新 (patch) する.
+    レコード全体を書き戻すと、別の処理 (インデックスの再構築など) が更新した active_index / rebuild を古い値に戻してしまうため.
+    更新後のレコードで project を置き換えて返す.
+    """
+    updated = container.patch_item(
+        item=project["id"],
+        partition_key=project["project_name"],
+        patch_operations=[{"op": "set", "path": f"/{field}", "value": project[field]} for field in fields],
+    )
+    project.update(updated)
+    return project
+
 def get_site_info_by_url(sites_data, spo_url):
     return next((site for site in sites_data.get("value", []) if site.get("webUrl") == spo_url), None)
 
@@ -170,7 +204,7 @@ def delete_project_resources(
     project_name = project_name.lower()
 
     # index, Skillset, datasource ,indexer の名前を組み立て
-    index_name = f"{project_name}-index"
+    index_name = get_index_name(project_name)
     data_source_name = f"{project_name}-datasource"
     skillset_name = f"{project_name}-skillset"
     indexer_name = f"{project_name}-indexer"
@@ -194,11 +228,16 @@ def delete_project_resources(
     except Exception as e:
         logging.warning(f"Failed to delete data source '{data_source_name}': {e}")
 
-    try:
-        index_client.delete_index(index_name)
-        logging.info(f"Deleted index '{index_name}'.")
-    except Exception as e:
-        logging.warning(f"Failed to delete index '{index_name}': {e}")
+    # 共有インデックスは他のプロジェクトも使用しているため削除しない
+    # (チャンクは ProjectIndexingService.delete_project_documents で削除する)
+    if shared_index_name:
+        logging.info(f"Shared index '{index_name}' is kept.")
+    else:
+        try:
+            index_client.delete_index(index_name)
+            logging.info(f"Deleted index '{index_name}'.")
+        except Exception as e:
+            logging.warning(f"Failed to delete index '{index_name}': {e}")
 
     # クエリで project_name に一致するアイテムを検索
     query = "SELECT * FROM Projects p WHERE p.project_name = @project_name"